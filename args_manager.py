@@ -40,6 +40,61 @@ args_parser.parser.add_argument("--always-download-new-model", action='store_tru
 args_parser.parser.add_argument("--rebuild-hash-cache", help="Generates missing model and LoRA hashes.",
                                 type=int, nargs="?", metavar="CPU_NUM_THREADS", const=-1)
 
+args_parser.parser.add_argument("--fast-model-hash", action='store_true',
+                                help="Write a partial fingerprint of new models to metadata while their full sha256 "
+                                     "is calculated in the background.")
+
+args_parser.parser.add_argument("--diffusion-batch-size", type=int, default=1, metavar="BATCH_SIZE",
+                                help="Sample up to this many images of a task as one latent batch.")
+
+args_parser.parser.add_argument("--concurrent-tasks", type=int, default=1, metavar="TASK_NUM",
+                                help="Number of tasks processed side by side. Sampling is still done one task at a time, "
+                                     "saving and post-processing of one task overlaps sampling of the next.")
+
+args_parser.parser.add_argument("--task-grouping-max-skips", type=int, default=4, metavar="SKIP_NUM",
+                                help="Serve queued tasks with the models of the previous task first, "
+                                     "but never pass over a task more than this many times. 0 keeps the order.")
+
+args_parser.parser.add_argument("--cond-cache-size", type=int, default=256, metavar="SIZE_MB",
+                                help="Memory budget of the prompt conditioning cache in MB.")
+
+args_parser.parser.add_argument("--cond-cache-spill-path", type=str, default=None, metavar="PATH",
+                                help="Write conditionings evicted from the cache to this folder and reuse them later.")
+
+args_parser.parser.add_argument("--expansion-cache-size", type=int, default=100000, metavar="ENTRY_NUM",
+                                help="Number of prompt expansion results kept in expansion_cache.db in the temp path, which is "
+                                     "cleared on launch with temp_path_cleanup_on_launch. 0 disables the cache.")
+
+args_parser.parser.add_argument("--lora-cache-size", type=int, default=8, metavar="LORA_NUM",
+                                help="Number of parsed LoRA files kept in memory for fast switching between LoRAs.")
+
+args_parser.parser.add_argument("--lora-merge-cache-path", type=str, default=None, metavar="PATH",
+                                help="Save merged LoRA weights per checkpoint and LoRA stack to this folder "
+                                     "and load them instead of merging the LoRA files again.")
+
+args_parser.parser.add_argument("--lora-merge-cache-size", type=int, default=16384, metavar="SIZE_MB",
+                                help="Disk budget of the LoRA merge cache in MB, least recently used LoRA stacks "
+                                     "are removed first.")
+
+args_parser.parser.add_argument("--model-pool-size", type=int, default=0, metavar="SIZE_MB",
+                                help="Keep recently used checkpoints in RAM up to this size in MB "
+                                     "for fast switching between models. 0 disables the pool.")
+
+args_parser.parser.add_argument("--checkpoint-cache-path", type=str, default=None, metavar="PATH",
+                                help="Convert checkpoints once into separate UNet, text encoder and VAE files in their "
+                                     "target dtypes in this folder and load those instead.")
+
+args_parser.parser.add_argument("--prefetch-models", action='store_true',
+                                help="Read the models and LoRAs of the next queued task in the background "
+                                     "while the current task is running.")
+
+args_parser.parser.add_argument("--sharpness-filter-engine", type=str, default='tiled', choices=['tiled', 'unfold'],
+                                help="Implementation of the bilateral filter behind the sharpness setting. "
+                                     "tiled bounds its memory use, unfold is the original implementation.")
+
+args_parser.parser.add_argument("--api-server", action='store_true',
+                                help="Serve a headless HTTP API on the warm pipeline instead of building the Gradio UI.")
+
 args_parser.parser.set_defaults(
     disable_cuda_malloc=True,
     in_browser=True,
@@ -0,0 +1,31 @@
+import time
+
+import numpy as np
+
+from modules.async_worker import generate_images
+
+prompt = 'a handsome man, portrait, detailed face'
+seeds = [1, 2, 3, 4]
+steps = 30
+
+settings = [
+    dict(),
+    dict(cfg_truncation=0.9),
+    dict(cfg_truncation=0.8),
+    dict(cfg_truncation=0.6),
+    dict(cfg_truncation_similarity=0.99),
+    dict(cfg_truncation_similarity=0.98),
+]
+
+generate_images(prompt, seeds=seeds[:1], steps=steps)  # warm up
+
+baseline = None
+for kwargs in settings:
+    start = time.perf_counter()
+    imgs, _ = generate_images(prompt, seeds=seeds, steps=steps, **kwargs)
+    elapsed = time.perf_counter() - start
+    imgs = np.stack(imgs).astype(np.float32)
+    if baseline is None:
+        baseline = imgs
+    diff = np.abs(imgs - baseline).mean()
+    print(f'{kwargs or "full CFG"}: {elapsed / len(seeds):.2f} s/image, mean abs diff to full CFG = {diff:.2f}')
@@ -8,11 +8,15 @@
 import os
 import torch
 import math
+import hashlib
+import args_manager
 import ldm_patched.modules.model_management as model_management
 
 from transformers.generation.logits_process import LogitsProcessorList
-from transformers import AutoTokenizer, AutoModelForCausalLM, set_seed
-from modules.config import path_fooocus_expansion
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from modules.config import path_fooocus_expansion, temp_path
+from modules.expansion_cache import ExpansionCache, expansion_cache_filename
+from modules.hash_cache import sha256_from_cache
 from ldm_patched.modules.model_patcher import ModelPatcher
 
 
@@ -28,6 +32,16 @@ def safe_str(x):
     return x.strip(",. \r\n")
 
 
+def hash_model_folder(path) -> str:
+    """Fingerprints the expansion model by the sha256 of its files, which are cached in the hash cache."""
+    h = hashlib.sha256()
+    for filename in sorted(os.listdir(path)):
+        filepath = os.path.join(path, filename)
+        if os.path.isfile(filepath):
+            h.update(f'{filename}:{sha256_from_cache(filepath, allow_partial=False)}\n'.encode('utf-8'))
+    return h.hexdigest()
+
+
 def remove_pattern(x, pattern):
     for p in pattern:
         x = x.replace(p, '')
@@ -78,52 +92,116 @@ class FooocusExpansion:
         self.patcher = ModelPatcher(self.model, load_device=load_device, offload_device=offload_device)
         print(f'Fooocus Expansion engine loaded for {load_device}, use_fp16 = {use_fp16}.')
 
+        cache_size = args_manager.args.expansion_cache_size
+        self.cache = ExpansionCache(hash_model_folder(path_fooocus_expansion) if cache_size > 0 else None, cache_size,
+                                    os.path.join(temp_path, expansion_cache_filename))
+
     @torch.no_grad()
     @torch.inference_mode()
     def logits_processor(self, input_ids, scores):
-        assert scores.ndim == 2 and scores.shape[0] == 1
+        assert scores.ndim == 2 and scores.shape[0] == input_ids.shape[0]
         self.logits_bias = self.logits_bias.to(scores)
 
-        bias = self.logits_bias.clone()
-        bias[0, input_ids[0].to(bias.device).long()] = neg_inf
-        bias[0, 11] = 0
+        bias = self.logits_bias.repeat(scores.shape[0], 1)
+        bias.scatter_(1, input_ids.to(bias.device).long(), neg_inf)
+        bias[:, 11] = 0
 
         return scores + bias
 
     @torch.no_grad()
     @torch.inference_mode()
     def __call__(self, prompt, seed):
-        if prompt == '':
-            return ''
+        return self.expand_batch([prompt], [seed])[0]
+
+    @torch.no_grad()
+    @torch.inference_mode()
+    def expand_batch(self, prompts, seeds, top_k=100):
+        results = [''] * len(prompts)
+        rows = []
+
+        for i, (prompt, seed) in enumerate(zip(prompts, seeds)):
+            if prompt == '':
+                continue
+
+            seed = int(seed) % SEED_LIMIT_NUMPY
+            cached = self.cache.get(prompt, seed)
+            if cached is not None:
+                results[i] = cached
+                continue
+
+            original_prompt = prompt
+            prompt = safe_str(prompt) + ','
+            input_ids = self.tokenizer(prompt)['input_ids']
+
+            current_token_length = len(input_ids)
+            max_token_length = 75 * int(math.ceil(float(current_token_length) / 75.0))
+            max_new_tokens = max_token_length - current_token_length
+
+            if max_new_tokens == 0:
+                results[i] = prompt[:-1]
+                continue
+
+            rows.append((i, original_prompt, input_ids, max_new_tokens, seed))
+
+        if len(rows) == 0:
+            return results
 
         if self.patcher.current_device != self.patcher.load_device:
             print('Fooocus Expansion loaded by itself.')
             model_management.load_model_gpu(self.patcher)
 
-        seed = int(seed) % SEED_LIMIT_NUMPY
-        set_seed(seed)
-        prompt = safe_str(prompt) + ','
+        sequences = self.sample([(ids, max_new_tokens, seed) for _, _, ids, max_new_tokens, seed in rows], top_k)
 
-        tokenized_kwargs = self.tokenizer(prompt, return_tensors="pt")
-        tokenized_kwargs.data['input_ids'] = tokenized_kwargs.data['input_ids'].to(self.patcher.load_device)
-        tokenized_kwargs.data['attention_mask'] = tokenized_kwargs.data['attention_mask'].to(self.patcher.load_device)
+        for (i, prompt, ids, max_new_tokens, seed), new_tokens in zip(rows, sequences):
+            response = self.tokenizer.decode(ids + new_tokens, skip_special_tokens=True)
+            results[i] = safe_str(response)
+            self.cache.put(prompt, seed, results[i])
 
-        current_token_length = int(tokenized_kwargs.data['input_ids'].shape[1])
-        max_token_length = 75 * int(math.ceil(float(current_token_length) / 75.0))
-        max_new_tokens = max_token_length - current_token_length
+        return results
 
-        if max_new_tokens == 0:
-            return prompt[:-1]
+    @torch.no_grad()
+    @torch.inference_mode()
+    def sample(self, rows, top_k=100):
+        """Samples the new tokens of (input_ids, max_new_tokens, seed) rows in one batch.
+
+        Prompts are padded on the left, so that all rows sample their next token at the same position.
+        Each row draws from its own generator, so a seed gives the same tokens alone and in any batch.
+        """
+        device = self.patcher.load_device
+        # the eos token is not in the positive words, so being in the padding does not change which tokens are allowed
+        pad_token_id = self.tokenizer.eos_token_id
+        prompt_length = max(len(ids) for ids, _, _ in rows)
+
+        input_ids = torch.tensor([[pad_token_id] * (prompt_length - len(ids)) + ids for ids, _, _ in rows],
+                                 dtype=torch.long, device=device)
+        attention_mask = torch.tensor([[0] * (prompt_length - len(ids)) + [1] * len(ids) for ids, _, _ in rows],
+                                      dtype=torch.long, device=device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        generators = [torch.Generator(device=device).manual_seed(seed) for _, _, seed in rows]
+
+        sequences = input_ids
+        model_input_ids = input_ids
+        past_key_values = None
 
         # https://huggingface.co/blog/introducing-csearch
         # https://huggingface.co/docs/transformers/generation_strategies
-        features = self.model.generate(**tokenized_kwargs,
-                                       top_k=100,
-                                       max_new_tokens=max_new_tokens,
-                                       do_sample=True,
-                                       logits_processor=LogitsProcessorList([self.logits_processor]))
-
-        response = self.tokenizer.batch_decode(features, skip_special_tokens=True)
-        result = safe_str(response[0])
-
-        return result
+        for _ in range(max(max_new_tokens for _, max_new_tokens, _ in rows)):
+            outputs = self.model(input_ids=model_input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                                 past_key_values=past_key_values, use_cache=True)
+            past_key_values = outputs.past_key_values
+
+            scores = self.logits_processor(sequences, outputs.logits[:, -1, :].clone())
+            kth_score = torch.topk(scores, min(top_k, scores.shape[-1]))[0][..., -1, None]
+            scores = scores.masked_fill(scores < kth_score, -float('inf'))
+            probs = torch.nn.functional.softmax(scores, dim=-1)
+
+            next_tokens = torch.cat([torch.multinomial(probs[j:j + 1], num_samples=1, generator=generator)
+                                     for j, generator in enumerate(generators)], dim=0)
+
+            sequences = torch.cat([sequences, next_tokens], dim=1)
+            model_input_ids = next_tokens
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((attention_mask.shape[0], 1))], dim=1)
+            position_ids = position_ids[:, -1:] + 1
+
+        return [sequences[j, prompt_length:prompt_length + max_new_tokens].tolist()
+                for j, (_, max_new_tokens, _) in enumerate(rows)]
@@ -149,4 +149,8 @@ config.default_base_model_name, config.checkpoint_downloads = download_models(
 config.update_files()
 init_cache(config.model_filenames, config.paths_checkpoints, config.lora_filenames, config.paths_loras)
 
-from webui import *
+if args.api_server:
+    from modules.api_server import run
+    run(host=args.listen, port=args.port or 7860)
+else:
+    from webui import *
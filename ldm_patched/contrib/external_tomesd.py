@@ -126,13 +126,12 @@ def bipartite_soft_matching_random2d(metric: torch.Tensor,
     return merge, unmerge
 
 
-def get_functions(x, ratio, original_shape):
+def get_functions(x, ratio, original_shape, max_downsample=1):
     b, c, original_h, original_w = original_shape
     original_tokens = original_h * original_w
     downsample = int(math.ceil(math.sqrt(original_tokens // x.shape[1])))
     stride_x = 2
     stride_y = 2
-    max_downsample = 1
 
     if downsample <= max_downsample:
         w = int(math.ceil(original_w / downsample))
@@ -105,6 +105,8 @@ vram_group.add_argument("--always-cpu", type=int, nargs="?", metavar="CPU_NUM_TH
 
 parser.add_argument("--always-offload-from-vram", action="store_true")
 parser.add_argument("--pytorch-deterministic", action="store_true")
+parser.add_argument("--disable-weight-streaming", action="store_true", help="Cast offloaded weights on use instead of transferring them ahead of time in lowvram mode.")
+parser.add_argument("--disable-mmap-load", action="store_true", help="Read checkpoints into memory instead of memory mapping them.")
 
 parser.add_argument("--disable-server-log", action="store_true")
 parser.add_argument("--debug-mode", action="store_true")
@@ -4,6 +4,8 @@ from ldm_patched.modules.args_parser import args
 import ldm_patched.modules.utils
 import torch
 import sys
+import time
+import weakref
 
 class VRAMState(Enum):
     DISABLED = 0    #No vram present: no need to move models to vram
@@ -265,6 +267,61 @@ print("VAE dtype:", VAE_DTYPE)
 
 current_loaded_models = []
 
+USAGE_HALF_LIFE = 300.0 #seconds after which a use counts half when choosing which model to unload
+THRASH_WINDOW = 60.0 #reloading a model this many seconds after unloading it counts as thrashing
+INFERENCE_MEMORY_RESERVE = 256 * 1024 * 1024
+
+class ModelUsage:
+    def __init__(self):
+        self.loads = 0
+        self.unloads = 0
+        self.load_time = None
+        self.last_unload = None
+        self.uses = 0.0
+        self.last_use = time.perf_counter()
+
+    def frequency(self, now=None):
+        if now is None:
+            now = time.perf_counter()
+        return self.uses * 0.5 ** ((now - self.last_use) / USAGE_HALF_LIFE)
+
+    def use(self):
+        now = time.perf_counter()
+        self.uses = self.frequency(now) + 1
+        self.last_use = now
+
+model_usage = weakref.WeakKeyDictionary()
+memory_counters = {"loads": 0, "unloads": 0, "thrash": 0, "load_bytes": 0, "load_time": 0.0}
+
+def get_model_usage(model):
+    key = getattr(model, "model", model)
+    try:
+        if key not in model_usage:
+            model_usage[key] = ModelUsage()
+        return model_usage[key]
+    except TypeError:
+        return None
+
+def load_bandwidth():
+    if memory_counters["load_time"] > 0:
+        return memory_counters["load_bytes"] / memory_counters["load_time"]
+    return 2 * 1024 * 1024 * 1024
+
+def memory_stats():
+    models = []
+    # worker threads load and unload models meanwhile
+    for loaded_model in list(current_loaded_models):
+        usage = get_model_usage(loaded_model.model)
+        models.append({
+            "name": getattr(loaded_model.model, "model", loaded_model.model).__class__.__name__,
+            "device": str(loaded_model.device),
+            "bytes": loaded_model.model_memory(),
+            "lowvram": loaded_model.model_accelerated,
+            "load_time": None if usage is None else usage.load_time,
+            "frequency": None if usage is None else usage.frequency(),
+        })
+    return dict(memory_counters, loaded_models=models)
+
 def module_size(module):
     module_mem = 0
     sd = module.state_dict()
@@ -278,6 +335,7 @@ class LoadedModel:
         self.model = model
         self.model_accelerated = False
         self.device = model.load_device
+        self.weight_streamer = None
 
     def model_memory(self):
         return self.model.model_size()
@@ -289,6 +347,8 @@ class LoadedModel:
             return self.model_memory()
 
     def model_load(self, lowvram_model_memory=0):
+        import ldm_patched.modules.ops
+
         patch_model_to = None
         if lowvram_model_memory == 0:
             patch_model_to = self.device
@@ -306,6 +366,7 @@ class LoadedModel:
         if lowvram_model_memory > 0:
             print("loading in lowvram mode", lowvram_model_memory/(1024 * 1024))
             mem_counter = 0
+            offloaded_modules = []
             for m in self.real_model.modules():
                 if hasattr(m, "ldm_patched_cast_weights"):
                     m.prev_ldm_patched_cast_weights = m.ldm_patched_cast_weights
@@ -314,19 +375,52 @@ class LoadedModel:
                     if mem_counter + module_mem < lowvram_model_memory:
                         m.to(self.device)
                         mem_counter += module_mem
+                    elif getattr(m, "weight", None) is not None:
+                        offloaded_modules.append(m)
                 elif hasattr(m, "weight"): #only modules with ldm_patched_cast_weights can be set to lowvram mode
                     m.to(self.device)
                     mem_counter += module_size(m)
                     print("lowvram: loaded module regularly", m)
 
+            if len(offloaded_modules) > 1 and not args.disable_weight_streaming:
+                self.weight_streamer = ldm_patched.modules.ops.WeightStreamer(offloaded_modules, self.device)
+
             self.model_accelerated = True
+        else:
+            self.stream_weight_casts()
 
         if is_intel_xpu() and not args.disable_ipex_hijack:
             self.real_model = torch.xpu.optimize(self.real_model.eval(), inplace=True, auto_kernel_selection=True, graph_mode=True)
 
         return self.real_model
 
+    def stream_weight_casts(self):
+        import ldm_patched.modules.ops
+
+        if self.device.type != "cpu" or getattr(self.real_model, "manual_cast_dtype", None) is None \
+                or args.disable_weight_streaming:
+            return
+
+        # weights are stored in a different dtype than the one computed in, cast the next ones on a worker thread
+        cast_modules = [m for m in self.real_model.modules() if getattr(m, "ldm_patched_cast_weights", False)
+                        and getattr(m, "weight", None) is not None]
+        if len(cast_modules) > 1:
+            self.weight_streamer = ldm_patched.modules.ops.WeightStreamer(cast_modules, self.device)
+
+    def detach_weight_streamer(self):
+        if self.weight_streamer is not None:
+            self.weight_streamer.detach()
+            self.weight_streamer = None
+
     def model_unload(self):
+        memory_counters["unloads"] += 1
+        usage = get_model_usage(self.model)
+        if usage is not None:
+            usage.unloads += 1
+            usage.last_unload = time.perf_counter()
+
+        self.detach_weight_streamer()
+
         if self.model_accelerated:
             for m in self.real_model.modules():
                 if hasattr(m, "prev_ldm_patched_cast_weights"):
@@ -344,6 +438,19 @@ class LoadedModel:
 def minimum_inference_memory():
     return (1024 * 1024 * 1024)
 
+def estimate_inference_memory(memory_required=0):
+    # the memory_required of sampling and VAE callers (model.memory_required, memory_used_decode/encode) plus a
+    # reserve, never less than the fixed minimum since those estimates do not cover everything allocated
+    return max(memory_required + INFERENCE_MEMORY_RESERVE, minimum_inference_memory())
+
+def eviction_cost(loaded_model):
+    # expected seconds spent bringing the model back: its reload time weighted by how often it has been used recently
+    usage = get_model_usage(loaded_model.model)
+    if usage is None:
+        return 0.0
+    reload_time = usage.load_time if usage.load_time is not None else loaded_model.model_memory() / load_bandwidth()
+    return reload_time * (1 + usage.frequency())
+
 def unload_model_clones(model):
     to_unload = []
     for i in range(len(current_loaded_models)):
@@ -354,19 +461,41 @@ def unload_model_clones(model):
         print("unload clone", i)
         current_loaded_models.pop(i).model_unload()
 
+def handover_model_clone(loaded_model):
+    # A clone that is fully loaded on the same device passes its weights on instead of being unloaded,
+    # the new patcher then only merges the keys whose patches changed.
+    model = loaded_model.model
+    if not hasattr(model, "repatch_from"):
+        return False
+
+    for i in range(len(current_loaded_models)):
+        other = current_loaded_models[i]
+        if model.is_clone(other.model) and other.device == loaded_model.device and not other.model_accelerated \
+                and other.model.current_device == loaded_model.device:
+            current_loaded_models.pop(i)
+            # the streamer of the old entry holds casts of the weights before repatching
+            other.detach_weight_streamer()
+            model.model_patches_to(loaded_model.device)
+            model.model_patches_to(model.model_dtype())
+            loaded_model.real_model = model.repatch_from(other.model)
+            loaded_model.stream_weight_casts()
+            other.model.current_device = other.model.offload_device
+            current_loaded_models.insert(0, loaded_model)
+            return True
+    return False
+
 def free_memory(memory_required, device, keep_loaded=[]):
     unloaded_model = False
-    for i in range(len(current_loaded_models) -1, -1, -1):
+    candidates = [m for m in reversed(current_loaded_models) if m.device == device and m not in keep_loaded]
+    # cheapest models to bring back first, least recently used first among equal costs
+    candidates.sort(key=eviction_cost)
+    for shift_model in candidates:
         if not ALWAYS_VRAM_OFFLOAD:
             if get_free_memory(device) > memory_required:
                 break
-        shift_model = current_loaded_models[i]
-        if shift_model.device == device:
-            if shift_model not in keep_loaded:
-                m = current_loaded_models.pop(i)
-                m.model_unload()
-                del m
-                unloaded_model = True
+        current_loaded_models.remove(shift_model)
+        shift_model.model_unload()
+        unloaded_model = True
 
     if unloaded_model:
         soft_empty_cache()
@@ -379,13 +508,15 @@ def free_memory(memory_required, device, keep_loaded=[]):
 def load_models_gpu(models, memory_required=0):
     global vram_state
 
-    inference_memory = minimum_inference_memory()
-    extra_mem = max(inference_memory, memory_required)
+    extra_mem = estimate_inference_memory(memory_required)
 
     models_to_load = []
     models_already_loaded = []
     for x in models:
         loaded_model = LoadedModel(x)
+        usage = get_model_usage(x)
+        if usage is not None:
+            usage.use()
 
         if loaded_model in current_loaded_models:
             index = current_loaded_models.index(loaded_model)
@@ -396,6 +527,11 @@ def load_models_gpu(models, memory_required=0):
                 print(f"Requested to load {x.model.__class__.__name__}")
             models_to_load.append(loaded_model)
 
+    for loaded_model in models_to_load[:]:
+        if handover_model_clone(loaded_model):
+            models_to_load.remove(loaded_model)
+            models_already_loaded.append(loaded_model)
+
     if len(models_to_load) == 0:
         devs = set(map(lambda a: a.device, models_already_loaded))
         for d in devs:
@@ -425,8 +561,8 @@ def load_models_gpu(models, memory_required=0):
         if lowvram_available and (vram_set_state == VRAMState.LOW_VRAM or vram_set_state == VRAMState.NORMAL_VRAM):
             model_size = loaded_model.model_memory_required(torch_dev)
             current_free_mem = get_free_memory(torch_dev)
-            lowvram_model_memory = int(max(64 * (1024 * 1024), (current_free_mem - 1024 * (1024 * 1024)) / 1.3 ))
-            if model_size > (current_free_mem - inference_memory): #only switch to lowvram if really necessary
+            lowvram_model_memory = int(max(64 * (1024 * 1024), (current_free_mem - extra_mem) / 1.3 ))
+            if model_size > (current_free_mem - extra_mem): #only switch to lowvram if really necessary
                 vram_set_state = VRAMState.LOW_VRAM
             else:
                 lowvram_model_memory = 0
@@ -434,8 +570,23 @@ def load_models_gpu(models, memory_required=0):
         if vram_set_state == VRAMState.NO_VRAM:
             lowvram_model_memory = 64 * 1024 * 1024
 
+        load_start = time.perf_counter()
+        load_bytes = loaded_model.model_memory_required(torch_dev)
         cur_loaded_model = loaded_model.model_load(lowvram_model_memory)
+        load_time = time.perf_counter() - load_start
         current_loaded_models.insert(0, loaded_model)
+
+        memory_counters["loads"] += 1
+        memory_counters["load_bytes"] += load_bytes
+        memory_counters["load_time"] += load_time
+        usage = get_model_usage(model)
+        if usage is not None:
+            usage.loads += 1
+            usage.load_time = load_time
+            if usage.last_unload is not None and load_start - usage.last_unload < THRASH_WINDOW:
+                memory_counters["thrash"] += 1
+                print(f"Model {model.model.__class__.__name__ if hasattr(model, 'model') else model.__class__.__name__} "
+                      f"reloaded {load_start - usage.last_unload:.1f} seconds after it was unloaded")
     return
 
 
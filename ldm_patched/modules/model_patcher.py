@@ -5,6 +5,24 @@ import inspect
 import ldm_patched.modules.utils
 import ldm_patched.modules.model_management
 
+class WeightDeltaRecorder:
+    def __init__(self, patches, callback):
+        # Records merged weight - original weight the first time exactly these patches are applied,
+        # callback(deltas, last) receives them chunk by chunk so that they are never all held in memory
+        self.patches = {k: list(v) for k, v in patches.items()}
+        self.callback = callback
+        self.deltas = {}
+        self.done = False
+
+    def flush(self, last=False):
+        deltas, self.deltas = self.deltas, {}
+        self.callback(deltas, last)
+
+    def matches(self, patches):
+        if self.done or patches.keys() != self.patches.keys():
+            return False
+        return all(len(patches[k]) == len(v) and all(a is b for a, b in zip(patches[k], v)) for k, v in self.patches.items())
+
 class ModelPatcher:
     def __init__(self, model, load_device, offload_device, size=0, current_device=None, weight_inplace_update=False):
         self.size = size
@@ -23,6 +41,8 @@ class ModelPatcher:
             self.current_device = current_device
 
         self.weight_inplace_update = weight_inplace_update
+        self.weight_delta_recorder = None
+        self.patch_chunk_size = 256 * 1024 * 1024
 
     def model_size(self):
         if self.size > 0:
@@ -41,6 +61,7 @@ class ModelPatcher:
         n.object_patches = self.object_patches.copy()
         n.model_options = copy.deepcopy(self.model_options)
         n.model_keys = self.model_keys
+        n.weight_delta_recorder = self.weight_delta_recorder
         return n
 
     def is_clone(self, other):
@@ -183,6 +204,10 @@ class ModelPatcher:
 
         if patch_weights:
             model_sd = self.model_state_dict()
+            recorder = self.weight_delta_recorder
+            if recorder is not None and not recorder.matches(self.patches):
+                recorder = None
+            chunk, chunk_size = {}, 0
             for key in self.patches:
                 if key not in model_sd:
                     print("could not patch. key doesn't exist in model:", key)
@@ -190,21 +215,24 @@ class ModelPatcher:
 
                 weight = model_sd[key]
 
-                inplace_update = self.weight_inplace_update
-
                 if key not in self.backup:
-                    self.backup[key] = weight.to(device=self.offload_device, copy=inplace_update)
+                    self.backup[key] = weight.to(device=self.offload_device, copy=self.weight_inplace_update)
 
-                if device_to is not None:
-                    temp_weight = ldm_patched.modules.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
-                else:
-                    temp_weight = weight.to(torch.float32, copy=True)
-                out_weight = self.calculate_weight(self.patches[key], temp_weight, key).to(weight.dtype)
-                if inplace_update:
-                    ldm_patched.modules.utils.copy_to_param(self.model, key, out_weight)
-                else:
-                    ldm_patched.modules.utils.set_attr(self.model, key, out_weight)
-                del temp_weight
+                # keys are merged in chunks, so that calculate_weights can batch them with bounded memory
+                chunk[key] = weight
+                chunk_size += weight.nelement() * 4
+                if chunk_size > self.patch_chunk_size:
+                    self.patch_weights(chunk, device_to, recorder)
+                    chunk, chunk_size = {}, 0
+                    if recorder is not None:
+                        recorder.flush()
+
+            if len(chunk) > 0:
+                self.patch_weights(chunk, device_to, recorder)
+
+            if recorder is not None:
+                recorder.done = True
+                recorder.flush(last=True)
 
             if device_to is not None:
                 self.model.to(device_to)
@@ -212,6 +240,80 @@ class ModelPatcher:
 
         return self.model
 
+    def patch_weight(self, key, weight, device_to=None, recorder=None):
+        self.patch_weights({key: weight}, device_to, recorder)
+
+    def patch_weights(self, weights, device_to=None, recorder=None):
+        temp_weights = {}
+        for key, weight in weights.items():
+            if device_to is not None:
+                temp_weights[key] = ldm_patched.modules.model_management.cast_to_device(weight, device_to, torch.float32, copy=True)
+            else:
+                temp_weights[key] = weight.to(torch.float32, copy=True)
+
+        out_weights = self.calculate_weights(self.patches, temp_weights)
+
+        for key, weight in weights.items():
+            out_weight = out_weights[key]
+            if recorder is not None:
+                # deltas are kept in the merge precision, so merging them gives the same weights as merging the patches
+                recorder.deltas[key] = (out_weight - weight.to(out_weight.device, torch.float32)).to(self.offload_device)
+            out_weight = out_weight.to(weight.dtype)
+            if self.weight_inplace_update:
+                ldm_patched.modules.utils.copy_to_param(self.model, key, out_weight)
+            else:
+                ldm_patched.modules.utils.set_attr(self.model, key, out_weight)
+        del temp_weights, out_weights
+
+    def calculate_weights(self, patches, weights):
+        return {key: self.calculate_weight(patches[key], weight, key) for key, weight in weights.items()}
+
+    def repatch_from(self, other):
+        # Takes over the patched weights of a loaded clone and only merges the keys whose patches differ,
+        # so that changing the weight of one LoRA does not re-merge the keys of all the others.
+        for k in list(other.object_patches_backup.keys()):
+            setattr(self.model, k, other.object_patches_backup[k])
+        other.object_patches_backup = {}
+
+        self.backup = other.backup
+        other.backup = {}
+
+        for k in self.object_patches:
+            if k not in self.object_patches_backup:
+                self.object_patches_backup[k] = getattr(self.model, k)
+            setattr(self.model, k, self.object_patches[k])
+
+        model_sd = self.model_state_dict()
+        changed_keys = 0
+        for key in set(self.backup.keys()) | set(self.patches.keys()):
+            if key not in model_sd:
+                continue
+
+            old_patches = other.patches.get(key, []) if key in self.backup else None
+            new_patches = self.patches.get(key, [])
+            if old_patches is not None and len(old_patches) == len(new_patches) and \
+                    all(a[0] == b[0] and a[1] is b[1] and a[2] == b[2] for a, b in zip(old_patches, new_patches)):
+                continue
+
+            changed_keys += 1
+            device = model_sd[key].device
+            if key not in self.backup:
+                self.backup[key] = model_sd[key].to(device=self.offload_device, copy=self.weight_inplace_update)
+            original = self.backup[key]
+
+            if len(new_patches) > 0:
+                self.patch_weight(key, original, device)
+            else:
+                if self.weight_inplace_update:
+                    ldm_patched.modules.utils.copy_to_param(self.model, key, original)
+                else:
+                    ldm_patched.modules.utils.set_attr(self.model, key, original.to(device))
+                del self.backup[key]
+
+        print(f'Re-patched {changed_keys} changed keys of {len(self.patches)} patched keys.')
+        self.current_device = other.current_device
+        return self.model
+
     def calculate_weight(self, patches, weight, key):
         for p in patches:
             alpha = p[0]
@@ -1,7 +1,12 @@
 import torch
 import ldm_patched.modules.model_management
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 def cast_bias_weight(s, input):
+    streamer = getattr(s, "weight_streamer", None)
+    if streamer is not None:
+        return streamer.get(s, input.dtype)
     bias = None
     non_blocking = ldm_patched.modules.model_management.device_supports_non_blocking(input.device)
     if s.bias is not None:
@@ -10,6 +15,127 @@ def cast_bias_weight(s, input):
     return weight, bias
 
 
+class WeightStreamer:
+    """Moves the weights of offloaded modules to the compute device ahead of their use.
+
+    The order in which the modules run is learned from their calls, the weights of the next `lookahead` modules
+    are transferred while the current module computes. Modules that have not run yet are assumed to follow in the
+    order they are given. Transfers run on a worker thread, on CUDA it copies the weights into a small ring of
+    pinned staging buffers and uploads them on a side stream.
+    """
+
+    def __init__(self, modules, device, lookahead=2):
+        self.modules = modules
+        self.device = device
+        self.lookahead = min(lookahead, len(modules) - 1)
+        self.pending = OrderedDict()
+        self.successors = {}
+        self.last_index = None
+        self.stream = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.staging = []
+        self.staging_index = 0
+
+        if device.type == "cuda":
+            self.stream = torch.cuda.Stream(device)
+            # weight and bias of every module in flight, plus the ones just handed out
+            self.staging = [[None, None] for _ in range(2 * (self.lookahead + 2))]
+
+        for i, m in enumerate(modules):
+            m.weight_streamer = self
+            m.weight_stream_index = i
+
+    def detach(self):
+        for m in self.modules:
+            del m.weight_streamer
+            del m.weight_stream_index
+        self.executor.shutdown(wait=True)
+        self.pending.clear()
+        self.staging = []
+
+    def stage(self, tensor, dtype):
+        if tensor.device == self.device:
+            return tensor.to(dtype=dtype)
+
+        slot = self.staging[self.staging_index]
+        self.staging_index = (self.staging_index + 1) % len(self.staging)
+        buffer, event = slot
+        if event is not None:
+            # the previous copy out of this buffer must be finished before it is overwritten
+            event.synchronize()
+
+        nbytes = tensor.nelement() * tensor.element_size()
+        if buffer is None or buffer.nelement() < nbytes:
+            buffer = torch.empty(nbytes, dtype=torch.uint8, pin_memory=True)
+        host = buffer[:nbytes].view(tensor.dtype).view(tensor.shape)
+        host.copy_(tensor)
+        out = host.to(self.device, non_blocking=True).to(dtype=dtype)
+
+        event = torch.cuda.Event()
+        event.record(self.stream)
+        slot[0], slot[1] = buffer, event
+        return out
+
+    def cast(self, m, dtype):
+        bias = None
+        if m.bias is not None:
+            bias = m.bias.to(device=self.device, dtype=dtype)
+        weight = m.weight.to(device=self.device, dtype=dtype)
+        return weight, bias
+
+    def upload(self, m, dtype):
+        # runs on the worker thread, so copying into the staging buffers stays off the thread running the model
+        with torch.cuda.stream(self.stream):
+            bias = self.stage(m.bias, dtype) if m.bias is not None else None
+            weight = self.stage(m.weight, dtype)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return weight, bias, event
+
+    def prefetch(self, index, dtype):
+        if index in self.pending:
+            return
+        m = self.modules[index]
+        fn = self.upload if self.stream is not None else self.cast
+        self.pending[index] = (dtype, self.executor.submit(fn, m, dtype))
+
+    def next_index(self, index):
+        return self.successors.get(index, (index + 1) % len(self.modules))
+
+    def get(self, m, dtype):
+        index = m.weight_stream_index
+        entry = self.pending.pop(index, None)
+
+        if self.last_index is not None:
+            self.successors[self.last_index] = index
+        self.last_index = index
+
+        next_index = index
+        for _ in range(self.lookahead):
+            next_index = self.next_index(next_index)
+            if next_index == index:
+                break
+            self.prefetch(next_index, dtype)
+        # modules that were skipped in this pass
+        while len(self.pending) > 2 * self.lookahead:
+            self.pending.popitem(last=False)
+
+        if entry is None or entry[0] != dtype:
+            return self.cast(m, dtype)
+
+        if self.stream is None:
+            return entry[1].result()
+
+        weight, bias, event = entry[1].result()
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(event)
+        # keeps the allocator from handing the memory to the side stream again while the module still uses it
+        weight.record_stream(current_stream)
+        if bias is not None:
+            bias.record_stream(current_stream)
+        return weight, bias
+
+
 class disable_weight_init:
     class Linear(torch.nn.Linear):
         ldm_patched_cast_weights = False
@@ -126,13 +126,16 @@ def cond_cat(c_list):
 
     return out
 
-def calc_cond_uncond_batch(model, cond, uncond, x_in, timestep, model_options):
-    out_cond = torch.zeros_like(x_in)
-    out_count = torch.ones_like(x_in) * 1e-37
-
-    out_uncond = torch.zeros_like(x_in)
-    out_uncond_count = torch.ones_like(x_in) * 1e-37
+def cond_active(conds, timestep_in):
+    if 'timestep_start' in conds and timestep_in[0] > conds['timestep_start']:
+        return False
+    if 'timestep_end' in conds and timestep_in[0] < conds['timestep_end']:
+        return False
+    return True
 
+def prepare_cond_batches(model, cond, uncond, x_in, timestep):
+    #Areas, masks, processed conds and the batching of them only depend on the shape of x and on which conds are active,
+    #so the result can be reused for every step of a sampling run.
     COND = 0
     UNCOND = 1
 
@@ -151,6 +154,11 @@ def calc_cond_uncond_batch(model, cond, uncond, x_in, timestep, model_options):
 
             to_run += [(p, UNCOND)]
 
+    out_count = torch.ones_like(x_in) * 1e-37
+    out_uncond_count = torch.ones_like(x_in) * 1e-37
+    entries = [[], []]
+
+    batches = []
     while len(to_run) > 0:
         first = to_run[0]
         first_shape = first[0][0].shape
@@ -170,7 +178,6 @@ def calc_cond_uncond_batch(model, cond, uncond, x_in, timestep, model_options):
                 to_batch = batch_amount
                 break
 
-        input_x = []
         mult = []
         c = []
         cond_or_uncond = []
@@ -180,17 +187,55 @@ def calc_cond_uncond_batch(model, cond, uncond, x_in, timestep, model_options):
         for x in to_batch:
             o = to_run.pop(x)
             p = o[0]
-            input_x.append(p.input_x)
-            mult.append(p.mult)
+            count = out_count if o[1] == COND else out_uncond_count
+            count[:,:,p.area[2]:p.area[0] + p.area[2],p.area[3]:p.area[1] + p.area[3]] += p.mult
+            full_area = p.area[0] == x_in.shape[2] and p.area[1] == x_in.shape[3]
+            # a weight of exactly one over the whole latent needs no multiplication
+            mult.append(None if full_area and bool((p.mult == 1.0).all()) else p.mult)
+            entries[o[1]].append(mult[-1])
             c.append(p.conditioning)
             area.append(p.area)
             cond_or_uncond.append(o[1])
             control = p.control
             patches = p.patches
 
+        batches.append({"mult": mult, "c": cond_cat(c), "cond_or_uncond": cond_or_uncond, "area": area, "control": control, "patches": patches})
+
+    #the only cond of its kind covering the whole latent with weight one is the result itself, no averaging needed
+    direct = [len(e) == 1 and e[0] is None for e in entries]
+    return {"batches": batches, "count": [out_count, out_uncond_count], "direct": direct, "refs": (model, cond, uncond)}
+
+def get_cond_batches(model, cond, uncond, x_in, timestep, model_options):
+    cache = model_options.get("cond_batch_cache", None)
+    if cache is None:
+        return prepare_cond_batches(model, cond, uncond, x_in, timestep)
+
+    active_cond = tuple(cond_active(x, timestep) for x in cond)
+    active_uncond = None if uncond is None else tuple(cond_active(x, timestep) for x in uncond)
+    key = (id(model), id(cond), id(uncond), tuple(x_in.shape), x_in.device, x_in.dtype, active_cond, active_uncond)
+    plan = cache.get(key, None)
+    if plan is None:
+        plan = prepare_cond_batches(model, cond, uncond, x_in, timestep)
+        cache[key] = plan
+    return plan
+
+def calc_cond_uncond_batch(model, cond, uncond, x_in, timestep, model_options):
+    COND = 0
+    UNCOND = 1
+
+    plan = get_cond_batches(model, cond, uncond, x_in, timestep, model_options)
+    out = [None, None]
+
+    for batch in plan["batches"]:
+        mult = batch["mult"]
+        cond_or_uncond = batch["cond_or_uncond"]
+        area = batch["area"]
+        control = batch["control"]
+        patches = batch["patches"]
+
         batch_chunks = len(cond_or_uncond)
-        input_x = torch.cat(input_x)
-        c = cond_cat(c)
+        input_x = torch.cat([x_in[:,:,a[2]:a[0] + a[2],a[3]:a[1] + a[3]] for a in area])
+        c = batch["c"].copy()
         timestep_ = torch.cat([timestep] * batch_chunks)
 
         if control is not None:
@@ -223,19 +268,21 @@ def calc_cond_uncond_batch(model, cond, uncond, x_in, timestep, model_options):
         del input_x
 
         for o in range(batch_chunks):
-            if cond_or_uncond[o] == COND:
-                out_cond[:,:,area[o][2]:area[o][0] + area[o][2],area[o][3]:area[o][1] + area[o][3]] += output[o] * mult[o]
-                out_count[:,:,area[o][2]:area[o][0] + area[o][2],area[o][3]:area[o][1] + area[o][3]] += mult[o]
-            else:
-                out_uncond[:,:,area[o][2]:area[o][0] + area[o][2],area[o][3]:area[o][1] + area[o][3]] += output[o] * mult[o]
-                out_uncond_count[:,:,area[o][2]:area[o][0] + area[o][2],area[o][3]:area[o][1] + area[o][3]] += mult[o]
-        del mult
-
-    out_cond /= out_count
-    del out_count
-    out_uncond /= out_uncond_count
-    del out_uncond_count
-    return out_cond, out_uncond
+            kind = cond_or_uncond[o]
+            if plan["direct"][kind]:
+                out[kind] = output[o]
+                continue
+            if out[kind] is None:
+                out[kind] = torch.zeros_like(x_in)
+            a = area[o]
+            out[kind][:,:,a[2]:a[0] + a[2],a[3]:a[1] + a[3]] += output[o] if mult[o] is None else output[o] * mult[o]
+
+    for kind in (COND, UNCOND):
+        if out[kind] is None:
+            out[kind] = torch.zeros_like(x_in)
+        elif not plan["direct"][kind]:
+            out[kind] /= plan["count"][kind]
+    return out[COND], out[UNCOND]
 
 #The main sampling function shared by all the samplers
 #Returns denoised
@@ -536,8 +583,12 @@ class KSAMPLER(Sampler):
         model_k = KSamplerX0Inpaint(model_wrap)
         model_k.latent_image = latent_image
         if self.inpaint_options.get("random", False): #TODO: Should this be the default?
-            generator = torch.manual_seed(extra_args.get("seed", 41) + 1)
-            model_k.noise = torch.randn(noise.shape, generator=generator, device="cpu").to(noise.dtype).to(noise.device)
+            seed = extra_args.get("seed", 41)
+            if isinstance(seed, list):
+                model_k.noise = torch.cat([torch.randn(noise[i:i + 1].shape, generator=torch.manual_seed(s + 1), device="cpu") for i, s in enumerate(seed)]).to(noise.dtype).to(noise.device)
+            else:
+                generator = torch.manual_seed(seed + 1)
+                model_k.noise = torch.randn(noise.shape, generator=generator, device="cpu").to(noise.dtype).to(noise.device)
         else:
             model_k.noise = noise
 
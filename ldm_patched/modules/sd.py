@@ -130,6 +130,21 @@ class CLIP:
             return cond, pooled
         return cond
 
+    def encode_from_tokens_batch(self, tokens_list, return_pooled=False):
+        if self.layer_idx is not None:
+            self.cond_stage_model.clip_layer(self.layer_idx)
+        else:
+            self.cond_stage_model.reset_clip_layer()
+
+        self.load_model()
+        if hasattr(self.cond_stage_model, "encode_token_weights_batch"):
+            results = self.cond_stage_model.encode_token_weights_batch(tokens_list)
+        else:
+            results = [self.cond_stage_model.encode_token_weights(tokens) for tokens in tokens_list]
+        if return_pooled:
+            return results
+        return [cond for cond, pooled in results]
+
     def encode(self, text):
         tokens = self.tokenize(text)
         return self.encode_from_tokens(tokens)
@@ -428,7 +443,7 @@ def load_checkpoint(config_path=None, ckpt_path=None, output_vae=True, output_cl
     return (ldm_patched.modules.model_patcher.ModelPatcher(model, load_device=model_management.get_torch_device(), offload_device=offload_device), clip, vae)
 
 def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None, output_model=True, vae_filename_param=None):
-    sd = ldm_patched.modules.utils.load_torch_file(ckpt_path)
+    sd = ldm_patched.modules.utils.load_torch_file(ckpt_path, mmap=True)
     sd_keys = sd.keys()
     clip = None
     clipvision = None
@@ -467,7 +482,7 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
             vae_sd = ldm_patched.modules.utils.state_dict_prefix_replace(sd, {"first_stage_model.": ""}, filter_keys=True)
             vae_sd = model_config.process_vae_state_dict(vae_sd)
         else:
-            vae_sd = ldm_patched.modules.utils.load_torch_file(vae_filename_param)
+            vae_sd = ldm_patched.modules.utils.load_torch_file(vae_filename_param, mmap=True)
             vae_filename = vae_filename_param
         vae = VAE(sd=vae_sd)
 
@@ -481,8 +496,9 @@ def load_checkpoint_guess_config(ckpt_path, output_vae=True, output_clip=True, o
             load_model_weights(w, sd)
 
     left_over = sd.keys()
-    if len(left_over) > 0:
+    if len(left_over) > 0 and output_clip and output_vae:
         print("left over keys:", left_over)
+    del sd
 
     if output_model:
         model_patcher = ldm_patched.modules.model_patcher.ModelPatcher(model, load_device=load_device, offload_device=model_management.unet_offload_device(), current_device=inital_load_device)
@@ -58,6 +58,9 @@ class ClipTokenWeightEncoder:
             return out[-1:].to(model_management.intermediate_device()), first_pooled
         return torch.cat(output, dim=-2).to(model_management.intermediate_device()), first_pooled
 
+    def encode_token_weights_batch(self, token_weight_pairs_list):
+        return [self.encode_token_weights(token_weight_pairs) for token_weight_pairs in token_weight_pairs_list]
+
 class SDClipModel(torch.nn.Module, ClipTokenWeightEncoder):
     """Uses the CLIP transformer encoder for text (from huggingface)"""
     LAYERS = [
@@ -1,16 +1,59 @@
 import torch
 import math
 import struct
+import json
+import mmap
 import ldm_patched.modules.checkpoint_pickle
 import safetensors.torch
 import numpy as np
 from PIL import Image
+from ldm_patched.modules.args_parser import args
 
-def load_torch_file(ckpt, safe_load=False, device=None):
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+def load_safetensors_mmap(ckpt):
+    # Tensors are views of a copy-on-write mapping of the file, pages are only read from disk when a tensor is used
+    # and are shared with the page cache instead of being copied into process memory.
+    with open(ckpt, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_size
+    sd = {}
+    for k, info in header.items():
+        if k == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES.get(info["dtype"])
+        if dtype is None:
+            return None
+        begin, end = info["data_offsets"]
+        offset = data_start + begin
+        element_size = torch.tensor([], dtype=dtype).element_size()
+        count = (end - begin) // element_size
+        if count == 0:
+            sd[k] = torch.empty(info["shape"], dtype=dtype)
+        elif offset % element_size != 0:
+            sd[k] = torch.frombuffer(mapped, dtype=torch.uint8, count=end - begin, offset=offset).clone().view(dtype).reshape(info["shape"])
+        else:
+            sd[k] = torch.frombuffer(mapped, dtype=dtype, count=count, offset=offset).reshape(info["shape"])
+    return sd
+
+def load_torch_file(ckpt, safe_load=False, device=None, mmap=False):
     if device is None:
         device = torch.device("cpu")
     if ckpt.lower().endswith(".safetensors"):
-        sd = safetensors.torch.load_file(ckpt, device=device.type)
+        sd = None
+        if mmap and device.type == "cpu" and not args.disable_mmap_load:
+            try:
+                sd = load_safetensors_mmap(ckpt)
+            except Exception as e:
+                print(f"Memory mapping {ckpt} failed, loading it into memory: {e}")
+        if sd is None:
+            sd = safetensors.torch.load_file(ckpt, device=device.type)
     else:
         if safe_load:
             if not 'weights_only' in torch.load.__code__.co_varnames:
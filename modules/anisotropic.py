@@ -1,3 +1,5 @@
+import functools
+
 import torch
 
 
@@ -72,6 +74,72 @@ def get_gaussian_kernel2d(
     return kernel_y * kernel_x.view(-1, 1, ksize_x)
 
 
+@functools.lru_cache(maxsize=16)
+def _cached_space_kernel(kernel_size: tuple[int, int] | int, sigma_space: float, device: Device, dtype: Dtype) -> Tensor:
+    ky, kx = _unpack_2d_ks(kernel_size)
+    return get_gaussian_kernel2d(kernel_size, sigma_space, device=device, dtype=dtype).view(-1, 1, 1, 1, kx * ky)
+
+
+def _space_kernel(kernel_size, sigma_space, device, dtype) -> Tensor:
+    ky, kx = _unpack_2d_ks(kernel_size)
+    if isinstance(sigma_space, (int, float)):
+        return _cached_space_kernel((ky, kx), float(sigma_space), device, dtype)
+    return get_gaussian_kernel2d(kernel_size, sigma_space, device=device, dtype=dtype).view(-1, 1, 1, 1, kx * ky)
+
+
+def _bilateral_blur_tiled(
+    input: Tensor,
+    guidance: Tensor | None,
+    kernel_size: tuple[int, int] | int,
+    sigma_color: float | Tensor,
+    sigma_space: tuple[float, float] | Tensor,
+    border_type: str = 'reflect',
+    color_distance_type: str = 'l1',
+    max_tile_bytes: int = 64 * 1024 * 1024,
+) -> Tensor:
+    """Same result as _bilateral_blur, the unfolded windows are built for a few rows at a time
+    so that the peak memory is bounded by max_tile_bytes instead of growing with Ky x Kx x the input size."""
+
+    if isinstance(sigma_color, Tensor):
+        sigma_color = sigma_color.to(device=input.device, dtype=input.dtype).view(-1, 1, 1, 1, 1)
+
+    ky, kx = _unpack_2d_ks(kernel_size)
+    pad_y, pad_x = _compute_zero_padding(kernel_size)
+    b, c, h, w = input.shape
+
+    padded_input = pad(input, (pad_x, pad_x, pad_y, pad_y), mode=border_type)
+    if guidance is None:
+        guidance = input
+        padded_guidance = padded_input
+    else:
+        padded_guidance = pad(guidance, (pad_x, pad_x, pad_y, pad_y), mode=border_type)
+
+    space_kernel = _space_kernel(kernel_size, sigma_space, input.device, input.dtype)
+
+    row_bytes = b * max(c, guidance.shape[1]) * w * ky * kx * input.element_size()
+    tile_rows = max(1, min(h, max_tile_bytes // max(row_bytes, 1)))
+
+    out = torch.empty_like(input)
+    for y in range(0, h, tile_rows):
+        y_end = min(h, y + tile_rows)
+        unfolded_input = padded_input[:, :, y:y_end + 2 * pad_y].unfold(2, ky, 1).unfold(3, kx, 1).flatten(-2)
+        unfolded_guidance = padded_guidance[:, :, y:y_end + 2 * pad_y].unfold(2, ky, 1).unfold(3, kx, 1).flatten(-2)
+
+        diff = unfolded_guidance - guidance[:, :, y:y_end].unsqueeze(-1)
+        if color_distance_type == "l1":
+            color_distance_sq = diff.abs().sum(1, keepdim=True).square()
+        elif color_distance_type == "l2":
+            color_distance_sq = diff.square().sum(1, keepdim=True)
+        else:
+            raise ValueError("color_distance_type only acceps l1 or l2")
+        del diff
+
+        kernel = (-0.5 / sigma_color**2 * color_distance_sq).exp_().mul_(space_kernel)
+        out[:, :, y:y_end] = (unfolded_input * kernel).sum(-1) / kernel.sum(-1)
+
+    return out
+
+
 def _bilateral_blur(
     input: Tensor,
     guidance: Tensor | None,
@@ -107,8 +175,7 @@ def _bilateral_blur(
         raise ValueError("color_distance_type only acceps l1 or l2")
     color_kernel = (-0.5 / sigma_color**2 * color_distance_sq).exp()  # (B, 1, H, W, Ky x Kx)
 
-    space_kernel = get_gaussian_kernel2d(kernel_size, sigma_space, device=input.device, dtype=input.dtype)
-    space_kernel = space_kernel.view(-1, 1, 1, 1, kx * ky)
+    space_kernel = _space_kernel(kernel_size, sigma_space, input.device, input.dtype)
 
     kernel = space_kernel * color_kernel
     out = (unfolded_input * kernel).sum(-1) / kernel.sum(-1)
@@ -126,18 +193,24 @@ def bilateral_blur(
     return _bilateral_blur(input, None, kernel_size, sigma_color, sigma_space, border_type, color_distance_type)
 
 
-def adaptive_anisotropic_filter(x, g=None):
+bilateral_engines = {
+    'tiled': _bilateral_blur_tiled,
+    'unfold': _bilateral_blur,
+}
+
+
+def adaptive_anisotropic_filter(x, g=None, engine='tiled'):
     if g is None:
         g = x
     s, m = torch.std_mean(g, dim=(1, 2, 3), keepdim=True)
     s = s + 1e-5
     guidance = (g - m) / s
-    y = _bilateral_blur(x, guidance,
-                        kernel_size=(13, 13),
-                        sigma_color=3.0,
-                        sigma_space=3.0,
-                        border_type='reflect',
-                        color_distance_type='l1')
+    y = bilateral_engines[engine](x, guidance,
+                                  kernel_size=(13, 13),
+                                  sigma_color=3.0,
+                                  sigma_space=3.0,
+                                  border_type='reflect',
+                                  color_distance_type='l1')
     return y
 
 
@@ -0,0 +1,221 @@
+import json
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+
+import args_manager
+import ldm_patched.modules.model_management
+import modules.async_worker as worker
+from modules import flags
+from modules.task_queue import TaskQueue, TaskEvents
+from modules.util import encode_image
+
+max_finished_jobs = 256
+media_types = {'png': 'image/png', 'jpeg': 'image/jpeg', 'jpg': 'image/jpeg', 'webp': 'image/webp'}
+
+
+class JobRequest(BaseModel):
+    prompt: str
+    negative_prompt: str = ''
+    seed: int = -1
+    image_number: int = 1
+    aspect_ratio: str = '1152×896'
+    output_format: str = 'png'
+    steps: int = 30
+    cfg_scale: float = 7.0
+    sharpness: float = 2.0
+    cfg_truncation: float = 1.0
+    cfg_truncation_similarity: float = 0.0
+    deep_cache: bool = False
+    attention_reduction: str = flags.attention_reduction_none
+    priority: int = 0
+
+
+class BatchRequest(BaseModel):
+    jobs: list[JobRequest]
+
+
+class ApiJob:
+    def __init__(self, request: JobRequest):
+        self.id = uuid.uuid4().hex
+        self.request = request
+        self.status = 'queued'
+        self.progress = 0
+        self.events = TaskEvents()
+        self.images = []
+        self.seeds = []
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'progress': self.progress,
+            'seeds': self.seeds,
+            'parameters': {
+                'steps': self.request.steps,
+                'guidance_scale': self.request.cfg_scale,
+                'sharpness': self.request.sharpness,
+                'cfg_truncation': self.request.cfg_truncation,
+                'cfg_truncation_similarity': self.request.cfg_truncation_similarity,
+                'deep_cache': self.request.deep_cache,
+                'attention_reduction': self.request.attention_reduction,
+            },
+            'images': [f'/v1/jobs/{self.id}/images/{i}' for i in range(len(self.images))],
+            'error': self.error,
+        }
+
+
+jobs = OrderedDict()
+jobs_lock = threading.Lock()
+job_queue = TaskQueue()
+
+
+def submit(request: JobRequest) -> ApiJob:
+    if request.output_format.lower() not in media_types:
+        raise HTTPException(status_code=400, detail=f'Unsupported output format {request.output_format}.')
+    if request.image_number < 1:
+        raise HTTPException(status_code=400, detail='image_number must be at least 1.')
+    if request.attention_reduction not in flags.attention_reduction_methods:
+        raise HTTPException(status_code=400, detail=f'Unsupported attention reduction {request.attention_reduction}.')
+
+    job = ApiJob(request)
+    with jobs_lock:
+        jobs[job.id] = job
+    job_queue.put(job, priority=request.priority)
+    return job
+
+
+def get_job(job_id) -> ApiJob:
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Job {job_id} not found.')
+    return job
+
+
+def forget_finished_jobs():
+    with jobs_lock:
+        finished = [job_id for job_id, job in jobs.items() if job.finished is not None]
+        for job_id in finished[:max(0, len(finished) - max_finished_jobs)]:
+            del jobs[job_id]
+
+
+def process_job(job: ApiJob):
+    request = job.request
+    job.status = 'running'
+    job.events.append(['status', job.to_dict()])
+
+    def callback(done, total, step, total_steps):
+        batch_size = min(total - done, max(1, args_manager.args.diffusion_batch_size))
+        job.progress = int(100 * (done + (step + 1) / total_steps * batch_size) / total)
+        job.events.append(['progress', {'progress': job.progress, 'step': step + 1, 'total_steps': total_steps}])
+
+    try:
+        seeds = [request.seed + i if request.seed >= 0 else -1 for i in range(request.image_number)]
+        job.images, job.seeds = worker.generate_images(
+            request.prompt, request.negative_prompt, seeds=seeds, aspect_ratio=request.aspect_ratio,
+            steps=request.steps, cfg_scale=request.cfg_scale, sharpness=request.sharpness,
+            cfg_truncation=request.cfg_truncation, cfg_truncation_similarity=request.cfg_truncation_similarity,
+            deep_cache_interval=flags.Performance.DEEP_CACHE.deep_cache_interval() if request.deep_cache else 0,
+            attention_reduction_method=request.attention_reduction, callback=callback)
+        job.progress = 100
+        job.status = 'finished'
+    except Exception as e:
+        traceback.print_exc()
+        job.error = str(e)
+        job.status = 'failed'
+
+    job.finished = time.time()
+    job.events.append(['finish', job.to_dict()])
+    forget_finished_jobs()
+
+
+def job_loop():
+    while True:
+        process_job(job_queue.get())
+
+
+app = FastAPI(title='Fooocus API')
+
+
+@app.post('/v1/jobs')
+def create_job(request: JobRequest):
+    return submit(request).to_dict()
+
+
+@app.post('/v1/jobs/batch')
+def create_jobs(request: BatchRequest):
+    return {'jobs': [submit(job_request).to_dict() for job_request in request.jobs]}
+
+
+@app.get('/v1/jobs/{job_id}')
+def read_job(job_id: str):
+    return get_job(job_id).to_dict()
+
+
+@app.delete('/v1/jobs/{job_id}')
+def cancel_job(job_id: str):
+    job = get_job(job_id)
+    if not job_queue.cancel(job):
+        raise HTTPException(status_code=409, detail=f'Job {job_id} is already {job.status}.')
+    job.status = 'cancelled'
+    job.finished = time.time()
+    job.events.append(['finish', job.to_dict()])
+    return job.to_dict()
+
+
+@app.get('/v1/jobs/{job_id}/events')
+def stream_job(job_id: str):
+    """Server-sent events with the progress of a job, meant for one consumer per job."""
+    job = get_job(job_id)
+
+    def event_stream():
+        if job.finished is not None and len(job.events) == 0:
+            yield f'event: finish\ndata: {json.dumps(job.to_dict())}\n\n'
+            return
+        while True:
+            event = job.events.get(timeout=15)
+            if event is None:
+                yield ': keep-alive\n\n'
+                continue
+            flag, product = event
+            yield f'event: {flag}\ndata: {json.dumps(product)}\n\n'
+            if flag == 'finish':
+                return
+
+    return StreamingResponse(event_stream(), media_type='text/event-stream')
+
+
+@app.get('/v1/stats')
+def read_stats():
+    return {'queued': len(job_queue), 'cond_cache': worker.pipeline.cond_cache.stats(),
+            'model_pool': worker.pipeline.model_pool.stats(),
+            'model_management': ldm_patched.modules.model_management.memory_stats()}
+
+
+@app.get('/v1/jobs/{job_id}/images/{index}')
+def read_image(job_id: str, index: int, output_format: str = None):
+    job = get_job(job_id)
+    if not 0 <= index < len(job.images):
+        raise HTTPException(status_code=404, detail=f'Job {job_id} has no image {index}.')
+    output_format = (output_format or job.request.output_format).lower()
+    if output_format not in media_types:
+        raise HTTPException(status_code=400, detail=f'Unsupported output format {output_format}.')
+    return Response(content=encode_image(job.images[index], output_format), media_type=media_types[output_format])
+
+
+def run(host='127.0.0.1', port=7860):
+    import uvicorn
+
+    threading.Thread(target=job_loop, daemon=True).start()
+    print(f'Fooocus API server running on http://{host}:{port}')
+    uvicorn.run(app, host=host, port=port)
@@ -1,7 +1,9 @@
 import threading
 
+import args_manager
 from extras.inpaint_mask import generate_mask_from_image, SAMOptions
-from modules.patch import PatchSettings, patch_settings, patch_all
+from modules.patch import PatchSettings, set_patch_settings, patch_all
+from modules.task_queue import TaskQueue, TaskEvents
 import modules.config
 
 patch_all()
@@ -12,15 +14,18 @@ class AsyncTask:
         from modules.flags import Performance, MetadataScheme, ip_list, disabled
         from modules.util import get_enabled_loras
         from modules.config import default_max_lora_number
-        import args_manager
 
         self.args = args.copy()
-        self.yields = []
+        self.yields = TaskEvents()
         self.results = []
         self.last_stop = False
         self.processing = False
 
         self.performance_loras = []
+        self.patch_settings = None
+        self.postprocess_executor = None
+        self.pipeline_guard = None
+        self.diffusion_batch_size = args_manager.args.diffusion_batch_size
 
         if len(args) == 0:
             return
@@ -64,6 +69,9 @@ class AsyncTask:
         self.adm_scaler_negative = args.pop()
         self.adm_scaler_end = args.pop()
         self.adaptive_cfg = args.pop()
+        self.cfg_truncation = args.pop()
+        self.cfg_truncation_similarity = args.pop()
+        self.attention_reduction = args.pop()
         self.clip_skip = args.pop()
         self.sampler_name = args.pop()
         self.scheduler_name = args.pop()
@@ -158,7 +166,15 @@ class AsyncTask:
         self.images_to_enhance_count = 0
         self.enhance_stats = {}
 
-async_tasks = []
+    def model_signature(self):
+        """Tasks with the same signature run on the same models without reloading or re-patching."""
+        if len(self.args) == 0:
+            return None
+        return (self.base_model_name, self.refiner_model_name, self.vae_name, str(self.loras),
+                self.performance_selection, self.clip_skip)
+
+
+async_tasks = TaskQueue(signature=AsyncTask.model_signature, max_skips=args_manager.args.task_grouping_max_skips)
 
 
 class EarlyReturnException(BaseException):
@@ -170,6 +186,7 @@ def worker():
 
     import os
     import traceback
+    import args_manager
     import math
     import numpy as np
     import torch
@@ -180,6 +197,7 @@ def worker():
     import cv2
     import modules.default_pipeline as pipeline
     import modules.core as core
+    import modules.attention_reduction as attention_reduction
     import modules.flags as flags
     import modules.patch
     import ldm_patched.modules.model_management
@@ -200,6 +218,9 @@ def worker():
     from modules.upscaler import perform_upscale
     from modules.flags import Performance
     from modules.meta_parser import get_metadata_parser
+    from modules.hash_cache import prefetch_sha256
+    from concurrent.futures import ThreadPoolExecutor
+    from contextlib import ExitStack
 
     pid = os.getpid()
     print(f'Started worker with PID {pid}')
@@ -217,14 +238,21 @@ def worker():
         print(f'[Fooocus] {text}')
         async_task.yields.append(['preview', (number, text, None)])
 
-    def yield_result(async_task, imgs, progressbar_index, black_out_nsfw, censor=True, do_not_show_finished_images=False):
-        if not isinstance(imgs, list):
-            imgs = [imgs]
+    def run_postprocessing(async_task, fn, *args):
+        # CPU-only work such as saving images runs in order on the task's own thread,
+        # so that sampling of the next image or task does not wait for it.
+        if async_task.postprocess_executor is None:
+            return fn(*args)
 
-        if censor and (modules.config.default_black_out_nsfw or black_out_nsfw):
-            progressbar(async_task, progressbar_index, 'Checking for NSFW content ...')
-            imgs = default_censor(imgs)
+        def job():
+            try:
+                return fn(*args)
+            except:
+                traceback.print_exc()
+
+        return async_task.postprocess_executor.submit(job)
 
+    def publish_result(async_task, imgs, do_not_show_finished_images=False):
         async_task.results = async_task.results + imgs
 
         if do_not_show_finished_images:
@@ -233,6 +261,17 @@ def worker():
         async_task.yields.append(['results', async_task.results])
         return
 
+    def yield_result(async_task, imgs, progressbar_index, black_out_nsfw, censor=True, do_not_show_finished_images=False):
+        if not isinstance(imgs, list):
+            imgs = [imgs]
+
+        if censor and (modules.config.default_black_out_nsfw or black_out_nsfw):
+            progressbar(async_task, progressbar_index, 'Checking for NSFW content ...')
+            imgs = default_censor(imgs)
+
+        run_postprocessing(async_task, publish_result, async_task, imgs, do_not_show_finished_images)
+        return
+
     def build_image_wall(async_task):
         results = []
 
@@ -278,11 +317,19 @@ def worker():
         return
 
     def process_task(all_steps, async_task, callback, controlnet_canny_path, controlnet_cpds_path, current_task_id,
-                     denoising_strength, final_scheduler_name, goals, initial_latent, steps, switch, positive_cond,
-                     negative_cond, task, loras, tiled, use_expansion, width, height, base_progress, preparation_steps,
-                     total_count, show_intermediate_results, persist_image=True):
+                     denoising_strength, final_scheduler_name, goals, initial_latent, steps, switch, task_batch, loras,
+                     tiled, use_expansion, width, height, base_progress, preparation_steps, total_count,
+                     show_intermediate_results, persist_image=True):
         if async_task.last_stop is not False:
-            ldm_patched.modules.model_management.interrupt_current_processing()
+            raise ldm_patched.modules.model_management.InterruptProcessingException()
+        # a batch of several tasks is sampled as one batched latent, one seed per image
+        if len(task_batch) > 1:
+            positive_cond = pipeline.batch_conds([task['c'] for task in task_batch])
+            negative_cond = pipeline.batch_conds([task['uc'] for task in task_batch])
+            image_seed = [task['task_seed'] for task in task_batch]
+        else:
+            positive_cond, negative_cond = task_batch[0]['c'], task_batch[0]['uc']
+            image_seed = task_batch[0]['task_seed']
         if 'cn' in goals:
             for cn_flag, cn_path in [
                 (flags.cn_canny, controlnet_canny_path),
@@ -299,7 +346,7 @@ def worker():
             switch=switch,
             width=width,
             height=height,
-            image_seed=task['task_seed'],
+            image_seed=image_seed,
             callback=callback,
             sampler_name=async_task.sampler_name,
             scheduler_name=final_scheduler_name,
@@ -311,28 +358,41 @@ def worker():
             disable_preview=async_task.disable_preview
         )
         del positive_cond, negative_cond  # Save memory
-        if inpaint_worker.current_task is not None:
-            imgs = [inpaint_worker.current_task.post_process(x) for x in imgs]
-        current_progress = int(base_progress + (100 - preparation_steps) / float(all_steps) * steps)
+        inpaint_task = inpaint_worker.get_current_task()
+        if inpaint_task is not None:
+            imgs = [inpaint_task.post_process(x) for x in imgs]
+        current_progress = int(base_progress + (100 - preparation_steps) / float(all_steps) * steps * len(task_batch))
         if modules.config.default_black_out_nsfw or async_task.black_out_nsfw:
             progressbar(async_task, current_progress, 'Checking for NSFW content ...')
             imgs = default_censor(imgs)
-        progressbar(async_task, current_progress, f'Saving image {current_task_id + 1}/{total_count} to system ...')
-        img_paths = save_and_log(async_task, height, imgs, task, use_expansion, width, loras, persist_image)
-        yield_result(async_task, img_paths, current_progress, async_task.black_out_nsfw, False,
-                     do_not_show_finished_images=not show_intermediate_results or async_task.disable_intermediate_results)
+
+        def save_and_publish():
+            paths = []
+            for i, (img, task) in enumerate(zip(imgs, task_batch)):
+                progressbar(async_task, current_progress, f'Saving image {current_task_id + i + 1}/{total_count} to system ...')
+                paths += save_and_log(async_task, height, [img], task, use_expansion, width, loras, persist_image)
+            publish_result(async_task, paths,
+                           do_not_show_finished_images=not show_intermediate_results or async_task.disable_intermediate_results)
+            return paths
+
+        # img_paths is a future when images are saved in the background
+        img_paths = run_postprocessing(async_task, save_and_publish)
 
         return imgs, img_paths, current_progress
 
     def apply_patch_settings(async_task):
-        patch_settings[pid] = PatchSettings(
+        async_task.patch_settings = PatchSettings(
             async_task.sharpness,
             async_task.adm_scaler_end,
             async_task.adm_scaler_positive,
             async_task.adm_scaler_negative,
             async_task.controlnet_softness,
-            async_task.adaptive_cfg
+            async_task.adaptive_cfg,
+            async_task.cfg_truncation,
+            async_task.cfg_truncation_similarity,
+            async_task.performance_selection.deep_cache_interval()
         )
+        set_patch_settings(async_task.patch_settings)
 
     def save_and_log(async_task, height, imgs, task, use_expansion, width, loras, persist_image=True) -> list:
         img_paths = []
@@ -348,9 +408,9 @@ def worker():
                  ('Guidance Scale', 'guidance_scale', async_task.cfg_scale),
                  ('Sharpness', 'sharpness', async_task.sharpness),
                  ('ADM Guidance', 'adm_guidance', str((
-                     modules.patch.patch_settings[pid].positive_adm_scale,
-                     modules.patch.patch_settings[pid].negative_adm_scale,
-                     modules.patch.patch_settings[pid].adm_scaler_end))),
+                     async_task.patch_settings.positive_adm_scale,
+                     async_task.patch_settings.negative_adm_scale,
+                     async_task.patch_settings.adm_scaler_end))),
                  ('Base Model', 'base_model', async_task.base_model_name),
                  ('Refiner Model', 'refiner_model', async_task.refiner_model_name),
                  ('Refiner Switch', 'refiner_switch', async_task.refiner_switch)]
@@ -360,9 +420,16 @@ def worker():
                     d.append(('Overwrite Switch', 'overwrite_switch', async_task.overwrite_switch))
                 if async_task.refiner_swap_method != flags.refiner_swap_method:
                     d.append(('Refiner Swap Method', 'refiner_swap_method', async_task.refiner_swap_method))
-            if modules.patch.patch_settings[pid].adaptive_cfg != modules.config.default_cfg_tsnr:
+            if async_task.patch_settings.adaptive_cfg != modules.config.default_cfg_tsnr:
                 d.append(
-                    ('CFG Mimicking from TSNR', 'adaptive_cfg', modules.patch.patch_settings[pid].adaptive_cfg))
+                    ('CFG Mimicking from TSNR', 'adaptive_cfg', async_task.patch_settings.adaptive_cfg))
+            if async_task.patch_settings.cfg_truncation < 1.0:
+                d.append(('CFG Truncation', 'cfg_truncation', async_task.patch_settings.cfg_truncation))
+            if async_task.patch_settings.cfg_truncation_similarity > 0:
+                d.append(('CFG Truncation Similarity', 'cfg_truncation_similarity',
+                          async_task.patch_settings.cfg_truncation_similarity))
+            if async_task.attention_reduction != flags.attention_reduction_none:
+                d.append(('Attention Reduction', 'attention_reduction', async_task.attention_reduction))
 
             if async_task.clip_skip > 1:
                 d.append(('CLIP Skip', 'clip_skip', async_task.clip_skip))
@@ -483,23 +550,24 @@ def worker():
         if not skip_apply_outpaint:
             inpaint_image, inpaint_mask = apply_outpaint(async_task, inpaint_image, inpaint_mask)
 
-        inpaint_worker.current_task = inpaint_worker.InpaintWorker(
+        inpaint_task = inpaint_worker.InpaintWorker(
             image=inpaint_image,
             mask=inpaint_mask,
             use_fill=denoising_strength > 0.99,
             k=inpaint_respective_field
         )
+        inpaint_worker.set_current_task(inpaint_task)
         if async_task.debugging_inpaint_preprocessor:
-            yield_result(async_task, inpaint_worker.current_task.visualize_mask_processing(), 100,
+            yield_result(async_task, inpaint_task.visualize_mask_processing(), 100,
                          async_task.black_out_nsfw, do_not_show_finished_images=True)
             raise EarlyReturnException
 
         if advance_progress:
             current_progress += 1
         progressbar(async_task, current_progress, 'VAE Inpaint encoding ...')
-        inpaint_pixel_fill = core.numpy_to_pytorch(inpaint_worker.current_task.interested_fill)
-        inpaint_pixel_image = core.numpy_to_pytorch(inpaint_worker.current_task.interested_image)
-        inpaint_pixel_mask = core.numpy_to_pytorch(inpaint_worker.current_task.interested_mask)
+        inpaint_pixel_fill = core.numpy_to_pytorch(inpaint_task.interested_fill)
+        inpaint_pixel_image = core.numpy_to_pytorch(inpaint_task.interested_image)
+        inpaint_pixel_mask = core.numpy_to_pytorch(inpaint_task.interested_mask)
         candidate_vae, candidate_vae_swap = pipeline.get_candidate_vae(
             steps=async_task.steps,
             switch=switch,
@@ -524,10 +592,10 @@ def worker():
         latent_fill = core.encode_vae(
             vae=candidate_vae,
             pixels=inpaint_pixel_fill)['samples']
-        inpaint_worker.current_task.load_latent(
+        inpaint_task.load_latent(
             latent_fill=latent_fill, latent_mask=latent_mask, latent_swap=latent_swap)
         if inpaint_parameterized:
-            pipeline.final_unet = inpaint_worker.current_task.patch(
+            pipeline.final_unet = inpaint_task.patch(
                 inpaint_head_model_path=inpaint_head_model_path,
                 inpaint_latent=latent_inpaint,
                 inpaint_latent_mask=latent_mask,
@@ -537,7 +605,7 @@ def worker():
             initial_latent = {'samples': latent_fill}
         B, C, H, W = latent_fill.shape
         height, width = H * 8, W * 8
-        final_height, final_width = inpaint_worker.current_task.image.shape[:2]
+        final_height, final_width = inpaint_task.image.shape[:2]
         print(f'Final resolution is {str((final_width, final_height))}, latent is {str((width, height))}.')
 
         return denoising_strength, initial_latent, width, height, current_progress
@@ -663,6 +731,14 @@ def worker():
                                     loras=loras, base_model_additional_loras=base_model_additional_loras,
                                     use_synthetic_refiner=use_synthetic_refiner, vae_name=async_task.vae_name)
         pipeline.set_clip_skip(async_task.clip_skip)
+        if async_task.save_metadata_to_images:
+            # hashes for metadata are calculated in the background while sampling
+            prefetch_sha256(pipeline.model_base.filename)
+            if pipeline.model_refiner.filename is not None:
+                prefetch_sha256(pipeline.model_refiner.filename)
+            for lora_name, lora_weight in loras:
+                if lora_name != 'None':
+                    prefetch_sha256(modules.util.get_file_from_folder_list(lora_name, modules.config.paths_loras))
         if advance_progress:
             current_progress += 1
         progressbar(async_task, current_progress, 'Processing prompts ...')
@@ -732,26 +808,29 @@ def worker():
         if use_expansion:
             if advance_progress:
                 current_progress += 1
-            for i, t in enumerate(tasks):
-
-                progressbar(async_task, current_progress, f'Preparing Fooocus text #{i + 1} ...')
-                expansion = pipeline.final_expansion(t['task_prompt'], t['task_seed'])
+            progressbar(async_task, current_progress, 'Preparing Fooocus text ...')
+            expansions = pipeline.final_expansion.expand_batch([t['task_prompt'] for t in tasks],
+                                                               [t['task_seed'] for t in tasks])
+            for t, expansion in zip(tasks, expansions):
                 print(f'[Prompt Expansion] {expansion}')
                 t['expansion'] = expansion
                 t['positive'] = copy.deepcopy(t['positive']) + [expansion]  # Deep copy.
         if advance_progress:
             current_progress += 1
+        # Positive and negative texts of all images are encoded together in a few batches
+        use_negative = abs(float(async_task.cfg_scale) - 1.0) >= 1e-4
+        progressbar(async_task, current_progress, 'Encoding prompts ...')
+        texts_list = [t['positive'] for t in tasks]
+        pool_top_k_list = [t['positive_top_k'] for t in tasks]
+        if use_negative:
+            texts_list += [t['negative'] for t in tasks]
+            pool_top_k_list += [t['negative_top_k'] for t in tasks]
+        conds = pipeline.clip_encode_batch(texts_list, pool_top_k_list)
         for i, t in enumerate(tasks):
-            progressbar(async_task, current_progress, f'Encoding positive #{i + 1} ...')
-            t['c'] = pipeline.clip_encode(texts=t['positive'], pool_top_k=t['positive_top_k'])
+            t['c'] = conds[i]
+            t['uc'] = conds[len(tasks) + i] if use_negative else pipeline.clone_cond(t['c'])
         if advance_progress:
             current_progress += 1
-        for i, t in enumerate(tasks):
-            if abs(float(async_task.cfg_scale) - 1.0) < 1e-4:
-                t['uc'] = pipeline.clone_cond(t['c'])
-            else:
-                progressbar(async_task, current_progress, f'Encoding negative #{i + 1} ...')
-                t['uc'] = pipeline.clip_encode(texts=t['negative'], pool_top_k=t['negative_top_k'])
         return tasks, use_expansion, loras, current_progress
 
     def apply_freeu(async_task):
@@ -764,6 +843,14 @@ def worker():
             async_task.freeu_s2
         )
 
+    def apply_attention_reduction(async_task):
+        print(f'{async_task.attention_reduction} is enabled!')
+        apply = attention_reduction.apply_tome if async_task.attention_reduction == flags.attention_reduction_tome \
+            else attention_reduction.apply_hypertile
+        pipeline.final_unet = apply(pipeline.final_unet)
+        if pipeline.final_refiner_unet is not None:
+            pipeline.final_refiner_unet = apply(pipeline.final_refiner_unet)
+
     def patch_discrete(unet, scheduler_name):
         return core.opModelSamplingDiscrete.patch(unet, scheduler_name, False)[0]
 
@@ -1010,6 +1097,8 @@ def worker():
         #     apply_control_nets(async_task, height, ip_adapter_face_path, ip_adapter_path, width)
         if async_task.freeu_enabled:
             apply_freeu(async_task)
+        if async_task.attention_reduction != flags.attention_reduction_none:
+            apply_attention_reduction(async_task)
         patch_samplers(async_task)
         if 'inpaint' in goals:
             denoising_strength, initial_latent, width, height, current_progress = apply_inpaint(
@@ -1020,8 +1109,8 @@ def worker():
         imgs, img_paths, current_progress = process_task(all_steps, async_task, callback, controlnet_canny_path,
                                                          controlnet_cpds_path, current_task_id, denoising_strength,
                                                          final_scheduler_name, goals, initial_latent, steps, switch,
-                                                         task_enhance['c'], task_enhance['uc'], task_enhance, loras,
-                                                         tiled, use_expansion, width, height, current_progress,
+                                                         [task_enhance], loras, tiled, use_expansion, width, height,
+                                                         current_progress,
                                                          preparation_steps, total_count, show_intermediate_results,
                                                          persist_image)
 
@@ -1033,7 +1122,7 @@ def worker():
                         prompt, negative_prompt, final_scheduler_name, height, img, preparation_steps, switch, tiled,
                         total_count, use_expansion, use_style, use_synthetic_refiner, width, persist_image=True):
         # reset inpaint worker to prevent tensor size issues and not mix upscale and inpainting
-        inpaint_worker.current_task = None
+        inpaint_worker.set_current_task(None)
 
         current_progress = int(base_progress + (100 - preparation_steps) / float(all_steps) * (done_steps_upscaling + done_steps_inpainting))
         goals_enhance = []
@@ -1098,6 +1187,9 @@ def worker():
             set_hyper_sd_defaults(async_task, current_progress, advance_progress=True)
 
         print(f'[Parameters] Adaptive CFG = {async_task.adaptive_cfg}')
+        print(f'[Parameters] CFG Truncation = {async_task.cfg_truncation}, '
+              f'similarity = {async_task.cfg_truncation_similarity}')
+        print(f'[Parameters] Attention Reduction = {async_task.attention_reduction}')
         print(f'[Parameters] CLIP Skip = {async_task.clip_skip}')
         print(f'[Parameters] Sharpness = {async_task.sharpness}')
         print(f'[Parameters] ControlNet Softness = {async_task.controlnet_softness}')
@@ -1120,7 +1212,7 @@ def worker():
 
         skip_prompt_processing = False
 
-        inpaint_worker.current_task = None
+        inpaint_worker.set_current_task(None)
         inpaint_parameterized = async_task.inpaint_engine != 'None'
         inpaint_image = None
         inpaint_mask = None
@@ -1142,6 +1234,10 @@ def worker():
                 goals, inpaint_head_model_path, inpaint_image, inpaint_mask, inpaint_parameterized, ip_adapter_face_path,
                 ip_adapter_path, ip_negative_path, skip_prompt_processing, use_synthetic_refiner)
 
+        # Everything below uses the models and pipeline state shared by the whole process, only one task may use
+        # them at a time. The preparation above, including downloads and input image checks, overlaps other tasks.
+        async_task.pipeline_guard.enter_context(pipeline.pipeline_lock)
+
         # Load or unload CNs
         progressbar(async_task, current_progress, 'Loading control models ...')
         pipeline.refresh_controlnets([controlnet_canny_path, controlnet_cpds_path])
@@ -1212,6 +1308,8 @@ def worker():
 
         if async_task.freeu_enabled:
             apply_freeu(async_task)
+        if async_task.attention_reduction != flags.attention_reduction_none:
+            apply_attention_reduction(async_task)
 
         # async_task.steps can have value of uov steps here when upscale has been applied
         steps, _, _, _ = apply_overrides(async_task, async_task.steps, height, width)
@@ -1266,33 +1364,49 @@ def worker():
 
         preparation_steps = current_progress
         total_count = async_task.image_number
+        current_batch_size = 1
 
         def callback(step, x0, x, total_steps, y):
+            # stop and skip are flags of this task, the global interrupt would also stop the other running tasks
+            if async_task.last_stop is not False:
+                raise ldm_patched.modules.model_management.InterruptProcessingException()
             if step == 0:
                 async_task.callback_steps = 0
-            async_task.callback_steps += (100 - preparation_steps) / float(all_steps)
+            async_task.callback_steps += (100 - preparation_steps) / float(all_steps) * current_batch_size
+            if current_batch_size > 1:
+                image_label = f'images {current_task_id + 1}-{current_task_id + current_batch_size}/{total_count}'
+            else:
+                image_label = f'image {current_task_id + 1}/{total_count}'
             async_task.yields.append(['preview', (
                 int(current_progress + async_task.callback_steps),
-                f'Sampling step {step + 1}/{total_steps}, image {current_task_id + 1}/{total_count} ...', y)])
+                f'Sampling step {step + 1}/{total_steps}, {image_label} ...', y)])
 
         show_intermediate_results = len(tasks) > 1 or async_task.should_enhance
         persist_image = not async_task.should_enhance or not async_task.save_final_enhanced_image_only
 
-        for current_task_id, task in enumerate(tasks):
-            progressbar(async_task, current_progress, f'Preparing task {current_task_id + 1}/{async_task.image_number} ...')
+        diffusion_batch_size = max(1, async_task.diffusion_batch_size)
+        task_batches = [tasks[i:i + diffusion_batch_size] for i in range(0, len(tasks), diffusion_batch_size)]
+
+        for batch_index, task_batch in enumerate(task_batches):
+            current_task_id = batch_index * diffusion_batch_size
+            current_batch_size = len(task_batch)
+            if current_batch_size > 1:
+                progressbar(async_task, current_progress, f'Preparing tasks {current_task_id + 1}-{current_task_id + current_batch_size}/{async_task.image_number} ...')
+            else:
+                progressbar(async_task, current_progress, f'Preparing task {current_task_id + 1}/{async_task.image_number} ...')
             execution_start_time = time.perf_counter()
 
             try:
                 imgs, img_paths, current_progress = process_task(all_steps, async_task, callback, controlnet_canny_path,
                                                                  controlnet_cpds_path, current_task_id,
                                                                  denoising_strength, final_scheduler_name, goals,
-                                                                 initial_latent, async_task.steps, switch, task['c'],
-                                                                 task['uc'], task, loras, tiled, use_expansion, width,
-                                                                 height, current_progress, preparation_steps,
+                                                                 initial_latent, async_task.steps, switch, task_batch,
+                                                                 loras, tiled, use_expansion, width, height,
+                                                                 current_progress, preparation_steps,
                                                                  async_task.image_number, show_intermediate_results,
                                                                  persist_image)
 
-                current_progress = int(preparation_steps + (100 - preparation_steps) / float(all_steps) * async_task.steps * (current_task_id + 1))
+                current_progress = int(preparation_steps + (100 - preparation_steps) / float(all_steps) * async_task.steps * (current_task_id + current_batch_size))
                 images_to_enhance += imgs
 
             except ldm_patched.modules.model_management.InterruptProcessingException:
@@ -1304,10 +1418,13 @@ def worker():
                     print('User stopped')
                     break
 
-            del task['c'], task['uc']  # Save memory
+            for task in task_batch:
+                del task['c'], task['uc']  # Save memory
             execution_time = time.perf_counter() - execution_start_time
             print(f'Generating and saving time: {execution_time:.2f} seconds')
 
+        current_batch_size = 1
+
         if not async_task.should_enhance:
             print(f'[Enhance] Skipping, preconditions aren\'t met')
             stop_processing(async_task, processing_start_time)
@@ -1462,23 +1579,38 @@ def worker():
         stop_processing(async_task, processing_start_time)
         return
 
-    while True:
-        time.sleep(0.01)
-        if len(async_tasks) > 0:
-            task = async_tasks.pop(0)
-
-            try:
+    def process_task_safe(task):
+        task.postprocess_executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            # the handler takes the pipeline lock once it starts using the models, it is released when it returns
+            with ExitStack() as task.pipeline_guard:
                 handler(task)
-                if task.generate_image_grid:
-                    build_image_wall(task)
-                task.yields.append(['finish', task.results])
+            task.postprocess_executor.shutdown(wait=True)
+            if task.generate_image_grid:
+                build_image_wall(task)
+            task.yields.append(['finish', task.results])
+            with pipeline.pipeline_lock:
                 pipeline.prepare_text_encoder(async_call=True)
-            except:
-                traceback.print_exc()
-                task.yields.append(['finish', task.results])
-            finally:
-                if pid in modules.patch.patch_settings:
-                    del modules.patch.patch_settings[pid]
+        except:
+            traceback.print_exc()
+            task.postprocess_executor.shutdown(wait=True)
+            task.yields.append(['finish', task.results])
+        finally:
+            set_patch_settings(None)
+            inpaint_worker.set_current_task(None)
+
+    def task_loop():
+        while True:
+            process_task_safe(async_tasks.get())
+
+    if args_manager.args.prefetch_models:
+        from modules.prefetch import Prefetcher
+        Prefetcher(async_tasks).start()
+
+    for _ in range(max(1, args_manager.args.concurrent_tasks) - 1):
+        threading.Thread(target=task_loop, daemon=True).start()
+
+    task_loop()
     pass
 
 
@@ -1487,11 +1619,94 @@ threading.Thread(target=worker, daemon=True).start()
 import modules.patch
 import os
 import time
-import cv2
 import numpy as np
+import args_manager
 from modules.config import path_outputs, default_base_model_name
-from modules.patch import PatchSettings, patch_settings
+from modules.util import encode_image
+from modules.patch import PatchSettings, set_patch_settings
+import modules.attention_reduction as attention_reduction
 import modules.default_pipeline as pipeline
+import modules.flags as flags
+
+
+def generate_images(
+        prompt,
+        negative_prompt="",
+        seeds=(-1,),
+        aspect_ratio="1152×896",
+        steps=30,
+        cfg_scale=7.0,
+        sharpness=2.0,
+        cfg_truncation=1.0,
+        cfg_truncation_similarity=0.0,
+        deep_cache_interval=0,
+        attention_reduction_method=flags.attention_reduction_none,
+        callback=None
+):
+    """Generates one image per seed on the warm pipeline and returns them as RGB arrays."""
+    width, height = [int(x) for x in aspect_ratio.replace('×', ' ').split()[:2]]
+    seeds = [seed if seed >= 0 else int(time.time() % 1e9) + i for i, seed in enumerate(seeds)]
+    batch_size = max(1, args_manager.args.diffusion_batch_size)
+    imgs = []
+
+    with pipeline.pipeline_lock:
+        # Only reload and re-patch models when the previous task changed them
+        pipeline.ensure_everything(
+            refiner_model_name="None",
+            base_model_name=default_base_model_name,
+            loras=[]
+        )
+        pipeline.set_clip_skip(modules.config.default_clip_skip)
+        # the patched model is replaced again by the next ensure_everything since it is no longer the warm one
+        if attention_reduction_method == flags.attention_reduction_tome:
+            pipeline.final_unet = attention_reduction.apply_tome(pipeline.final_unet)
+        elif attention_reduction_method == flags.attention_reduction_hypertile:
+            pipeline.final_unet = attention_reduction.apply_hypertile(pipeline.final_unet)
+
+        # Configure patch settings for this thread
+        set_patch_settings(PatchSettings(
+            sharpness=sharpness,
+            adm_scaler_end=0.3,
+            controlnet_softness=0.25,
+            adaptive_cfg=cfg_scale,
+            cfg_truncation=cfg_truncation,
+            cfg_truncation_similarity=cfg_truncation_similarity,
+            deep_cache_interval=deep_cache_interval
+        ))
+
+        try:
+            # Process prompts
+            positive_cond = pipeline.clip_encode([prompt], 1)
+            negative_cond = pipeline.clip_encode([negative_prompt], 1)
+
+            for i in range(0, len(seeds), batch_size):
+                batch_seeds = seeds[i:i + batch_size]
+
+                def batch_callback(step, x0, x, total_steps, y, done=i):
+                    if callback is not None:
+                        callback(done, len(seeds), step, total_steps)
+
+                # Generate images
+                imgs += pipeline.process_diffusion(
+                    positive_cond=positive_cond,
+                    negative_cond=negative_cond,
+                    steps=steps,
+                    switch=steps,
+                    width=width,
+                    height=height,
+                    image_seed=batch_seeds if len(batch_seeds) > 1 else batch_seeds[0],
+                    callback=batch_callback,
+                    sampler_name="dpmpp_2m_sde_gpu",
+                    scheduler_name="karras",
+                    cfg_scale=cfg_scale,
+                    tiled=False,
+                    disable_preview=True
+                )
+        finally:
+            # Cleanup patch settings
+            set_patch_settings(None)
+
+    return [img.astype(np.uint8) for img in imgs], seeds
 
 
 def generate_image(
@@ -1502,59 +1717,26 @@ def generate_image(
         output_format="png",
         steps=30,
         cfg_scale=7.0,
-        sharpness=2.0
+        sharpness=2.0,
+        cfg_truncation=1.0,
+        cfg_truncation_similarity=0.0,
+        deep_cache_interval=0,
+        attention_reduction_method=flags.attention_reduction_none
 ):
-    # Get current process ID
-    pid = os.getpid()
-
     # Set up paths and initial configuration
     os.makedirs(path_outputs, exist_ok=True)
-    width, height = [int(x) for x in aspect_ratio.replace('×', ' ').split()]
-    seed = seed if seed >= 0 else int(time.time() % 1e9)
-
-    # Initialize pipeline
-    pipeline.refresh_everything(
-        refiner_model_name="None",
-        base_model_name=default_base_model_name,
-        loras=[]
-    )
-
-    # Configure patch settings using PID
-    patch_settings[pid] = PatchSettings(
-        sharpness=sharpness,
-        adm_scaler_end=0.3,
-        controlnet_softness=0.25,
-        adaptive_cfg=cfg_scale
-    )
-
-    # Process prompts
-    positive_cond = pipeline.clip_encode([prompt], 1)
-    negative_cond = pipeline.clip_encode([negative_prompt], 1)
-
-    # Generate image
-    imgs = pipeline.process_diffusion(
-        positive_cond=positive_cond,
-        negative_cond=negative_cond,
-        steps=steps,
-        switch=steps,
-        width=width,
-        height=height,
-        image_seed=seed,
-        callback=lambda *args: None,  # Dummy callback
-        sampler_name="dpmpp_2m_sde_gpu",
-        scheduler_name="karras",
-        cfg_scale=cfg_scale,
-        tiled=False
-    )
+
+    imgs, _ = generate_images(prompt, negative_prompt, seeds=[seed], aspect_ratio=aspect_ratio,
+                              steps=steps, cfg_scale=cfg_scale, sharpness=sharpness,
+                              cfg_truncation=cfg_truncation, cfg_truncation_similarity=cfg_truncation_similarity,
+                              deep_cache_interval=deep_cache_interval,
+                              attention_reduction_method=attention_reduction_method)
 
     # Convert and save image
-    img = imgs[0].astype(np.uint8)
     timestamp = int(time.time())
     filename = f"output_{timestamp}.{output_format}"
     output_path = os.path.join(path_outputs, filename)
-    cv2.imwrite(output_path, cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
-
-    # Cleanup patch settings
-    del patch_settings[pid]
+    with open(output_path, 'wb') as f:
+        f.write(encode_image(imgs[0], output_format))
 
-    return output_path
\ No newline at end of file
+    return output_path
@@ -0,0 +1,98 @@
+import math
+
+import torch
+from einops import rearrange
+
+from ldm_patched.contrib.external_hypertile import random_divisor
+from ldm_patched.contrib.external_tomesd import get_functions
+
+
+def first_attention_level(model):
+    # SDXL has no transformer blocks in its highest resolution level, SD 1.5 has
+    transformer_depth = model.model.model_config.unet_config.get('transformer_depth', [1])
+    return 0 if transformer_depth[0] > 0 else 1
+
+
+def tome_ratio(width, height):
+    """Share of the tokens merged in self attention, images with more pixels hold more redundant tokens."""
+    return round(min(0.5, 0.3 * width * height / (1024 * 1024)), 2)
+
+
+def hypertile_tile_size(width, height, level):
+    """Side of the attention tiles in tokens, the highest resolution attention layers are split in about 2x2 tiles."""
+    return max(32, min(width, height) // (8 * 2 ** level) // 2)
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def apply_tome(model):
+    """Merges redundant tokens before self attention of the highest resolution transformer blocks.
+
+    The merge ratio is tuned to the resolution of every UNet call, so crops and upscales use their own ratio.
+    """
+    max_downsample = 2 ** first_attention_level(model)
+    unmerge = []
+
+    def tome_in(q, k, v, extra_options):
+        shape = extra_options['original_shape']
+        ratio = tome_ratio(shape[-1] * 8, shape[-2] * 8)
+        m, u = get_functions(q, ratio, shape, max_downsample=max_downsample)
+        unmerge.append(u)
+        return m(q), k, v
+
+    def tome_out(n, extra_options):
+        return unmerge.pop()(n)
+
+    m = model.clone()
+    m.set_model_attn1_patch(tome_in)
+    m.set_model_attn1_output_patch(tome_out)
+    return m
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def apply_hypertile(model):
+    """Splits self attention of the highest resolution transformer blocks into tiles attended separately.
+
+    The tile size is tuned to the resolution of every UNet call, tiles are chosen deterministically.
+    """
+    level = first_attention_level(model)
+    tiles = []
+
+    def hypertile_in(q, k, v, extra_options):
+        shape = extra_options['original_shape']
+        h, w = shape[-2] // 2 ** level, shape[-1] // 2 ** level
+        if q.shape[1] != h * w:
+            tiles.append(None)
+            return q, k, v
+
+        tile_size = hypertile_tile_size(shape[-1] * 8, shape[-2] * 8, level)
+        nh = random_divisor(h, tile_size, 1)
+        nw = random_divisor(w, tile_size, 1)
+        if nh * nw == 1:
+            tiles.append(None)
+            return q, k, v
+
+        tiles.append((nh, nw, h, w))
+
+        def tile(x):
+            return rearrange(x, "b (nh h nw w) c -> (b nh nw) (h w) c", h=h // nh, w=w // nw, nh=nh, nw=nw)
+
+        # keys and values are the same tokens in self attention, they are tiled alike
+        q_tiles = tile(q)
+        k_tiles = q_tiles if k is q else tile(k)
+        v_tiles = k_tiles if v is k else tile(v)
+        return q_tiles, k_tiles, v_tiles
+
+    def hypertile_out(out, extra_options):
+        tile = tiles.pop()
+        if tile is None:
+            return out
+        nh, nw, h, w = tile
+        out = rearrange(out, "(b nh nw) hw c -> b nh nw hw c", nh=nh, nw=nw)
+        return rearrange(out, "b nh nw (h w) c -> b (nh h nw w) c", h=h // nh, w=w // nw)
+
+    m = model.clone()
+    m.set_model_attn1_patch(hypertile_in)
+    m.set_model_attn1_output_patch(hypertile_out)
+    return m
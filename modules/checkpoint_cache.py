@@ -0,0 +1,220 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import safetensors.torch
+import torch
+
+import args_manager
+import ldm_patched.modules.model_detection as model_detection
+import ldm_patched.modules.model_management as model_management
+import ldm_patched.modules.model_patcher
+import ldm_patched.modules.utils
+from ldm_patched.modules.sd import CLIP, VAE
+from modules.hash_cache import file_stat
+
+cache_version = 2
+config_filename = 'config.json'
+module_prefixes = ('model.diffusion_model.', 'first_stage_model.', 'cond_stage_model.', 'conditioner.', 'model_ema.')
+
+saving_folders = set()
+saving_lock = threading.Lock()
+
+
+def is_enabled():
+    return args_manager.args.checkpoint_cache_path is not None
+
+
+def cache_folder(ckpt_filename):
+    # checkpoints with the same file name in different model folders get their own copies
+    name = os.path.splitext(os.path.basename(ckpt_filename))[0]
+    path_hash = hashlib.sha256(os.path.abspath(ckpt_filename).encode('utf-8')).hexdigest()[:10]
+    return os.path.join(args_manager.args.checkpoint_cache_path, f'{name}-{path_hash}')
+
+
+def read_config(folder):
+    try:
+        with open(os.path.join(folder, config_filename), 'rt', encoding='utf-8') as fp:
+            config = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if config.get('version') != cache_version:
+        return None
+    return config
+
+
+def load_file(folder, filename):
+    return ldm_patched.modules.utils.load_torch_file(os.path.join(folder, filename), mmap=True)
+
+
+def load_files(folder, filenames):
+    sd = {}
+    for filename in filenames:
+        sd.update(load_file(folder, filename))
+    return sd
+
+
+def load(ckpt_filename, output_vae=True, output_clip=True, embedding_directory=None):
+    """Loads a checkpoint from its converted copy, returns (unet, clip, vae) or None if there is no valid copy.
+
+    The converted files hold the state dicts of the UNet, text encoders and VAE in their target dtypes,
+    so no model detection, key conversion or casting is needed and the files are only memory mapped.
+    """
+    folder = cache_folder(ckpt_filename)
+    config = read_config(folder)
+    if config is None:
+        return None
+
+    parts = config['parts']
+    if 'unet' not in parts or (output_vae and 'vae' not in parts) or (output_clip and 'clip' not in parts):
+        return None
+
+    if config['source_stat'] != file_stat(ckpt_filename):
+        print(f'[Checkpoint Cache] {ckpt_filename} changed, converting it again')
+        return None
+
+    parameters = config['parameters']
+    unet_dtype = model_management.unet_dtype(model_params=parameters)
+    load_device = model_management.get_torch_device()
+    manual_cast_dtype = model_management.unet_manual_cast(unet_dtype, load_device)
+
+    model_config = model_detection.model_config_from_unet_config(dict(config['unet_config'], dtype=unet_dtype))
+    if model_config is None:
+        return None
+    model_config.set_manual_cast(manual_cast_dtype)
+
+    unet_sd = load_files(folder, parts['unet'])
+    # model types are detected from markers like v_pred and from some of the UNet weights
+    sd = load_file(folder, config['extra'])
+    sd.update({f'model.diffusion_model.{k}': v for k, v in unet_sd.items()})
+
+    inital_load_device = model_management.unet_inital_load_device(parameters, unet_dtype)
+    model = model_config.get_model(sd, 'model.diffusion_model.', device=inital_load_device)
+    m, u = model.diffusion_model.load_state_dict(unet_sd, strict=False)
+    if len(m) > 0:
+        print('unet missing:', m)
+    del sd, unet_sd
+
+    clip = None
+    if output_clip:
+        clip_target = model_config.clip_target()
+        if clip_target is not None:
+            clip = CLIP(clip_target, embedding_directory=embedding_directory)
+            clip.cond_stage_model.load_state_dict(load_files(folder, parts['clip']), strict=False)
+
+    vae = None
+    if output_vae:
+        vae = VAE(sd=load_files(folder, parts['vae']))
+
+    model_patcher = ldm_patched.modules.model_patcher.ModelPatcher(model, load_device=load_device, offload_device=model_management.unet_offload_device(), current_device=inital_load_device)
+    if inital_load_device != torch.device('cpu'):
+        model_management.load_model_gpu(model_patcher)
+
+    print(f'[Checkpoint Cache] Loaded converted {ckpt_filename}')
+    return model_patcher, clip, vae
+
+
+def state_dict_to_save(module, source_sd):
+    """Takes the weights from the source checkpoint in the dtypes of the loaded module.
+
+    The loaded module itself is only read for its keys and dtypes, its weights may be patched with LoRAs meanwhile.
+    Keys missing in the checkpoint, like buffers initialized by the module, are copied from the module.
+    """
+    sd = {}
+    for k, v in module.state_dict().items():
+        source = source_sd.get(k)
+        if source is None or source.shape != v.shape:
+            source = v
+        sd[k] = source.detach().to(device='cpu', dtype=v.dtype).contiguous()
+    return sd
+
+
+def save_state_dict(sd, folder, filename):
+    temp_filename = os.path.join(folder, f'{filename}.tmp')
+    safetensors.torch.save_file(sd, temp_filename)
+    os.replace(temp_filename, os.path.join(folder, filename))
+
+
+def save(ckpt_filename, unet, clip, vae):
+    """Converts the parts of a checkpoint missing in its converted copy on a background thread."""
+    if unet is None:
+        return
+
+    folder = cache_folder(ckpt_filename)
+    with saving_lock:
+        if folder in saving_folders:
+            return
+        saving_folders.add(folder)
+
+    threading.Thread(target=save_parts, args=(ckpt_filename, folder, unet, clip, vae), daemon=True).start()
+
+
+def save_parts(ckpt_filename, folder, unet, clip, vae):
+    try:
+        source_stat = file_stat(ckpt_filename)
+        config = read_config(folder)
+        if config is None or config['source_stat'] != source_stat:
+            shutil.rmtree(folder, ignore_errors=True)
+            config = None
+        os.makedirs(folder, exist_ok=True)
+
+        parts = {} if config is None else config['parts']
+        if 'unet' in parts and ('clip' in parts or clip is None) and ('vae' in parts or vae is None):
+            return
+
+        model_config = unet.model.model_config
+        source_sd = ldm_patched.modules.utils.load_torch_file(ckpt_filename, mmap=True)
+
+        if 'unet' not in parts:
+            save_state_dict({k: v.contiguous() for k, v in source_sd.items() if not k.startswith(module_prefixes)},
+                            folder, 'extra.safetensors')
+            unet_sd = ldm_patched.modules.utils.state_dict_prefix_replace(
+                source_sd, {'model.diffusion_model.': ''}, filter_keys=True)
+            unet_sd = model_config.process_unet_state_dict(unet_sd)
+            save_state_dict(state_dict_to_save(unet.model.diffusion_model, unet_sd), folder, 'unet.safetensors')
+            parts['unet'] = ['unet.safetensors']
+            del unet_sd
+
+        if vae is not None and 'vae' not in parts:
+            vae_sd = ldm_patched.modules.utils.state_dict_prefix_replace(
+                source_sd, {'first_stage_model.': ''}, filter_keys=True)
+            vae_sd = model_config.process_vae_state_dict(vae_sd)
+            save_state_dict(state_dict_to_save(vae.first_stage_model, vae_sd), folder, 'vae.safetensors')
+            parts['vae'] = ['vae.safetensors']
+            del vae_sd
+
+        if clip is not None and 'clip' not in parts:
+            clip_sd = ldm_patched.modules.utils.state_dict_prefix_replace(
+                model_config.process_clip_state_dict(dict(source_sd)), {'cond_stage_model.': ''}, filter_keys=True)
+            clip_sd = state_dict_to_save(clip.cond_stage_model, clip_sd)
+            # one file per text encoder, e.g. clip_l and clip_g for SDXL
+            encoders = sorted(set(k.split('.', 1)[0] for k in clip_sd))
+            for encoder in encoders:
+                save_state_dict({k: v for k, v in clip_sd.items() if k.split('.', 1)[0] == encoder},
+                                folder, f'{encoder}.safetensors')
+            parts['clip'] = [f'{encoder}.safetensors' for encoder in encoders]
+            del clip_sd
+
+        del source_sd
+
+        config = {
+            'version': cache_version,
+            'source': os.path.abspath(ckpt_filename),
+            'source_stat': source_stat,
+            'parameters': sum(v.nelement() for v in unet.model.diffusion_model.state_dict().values()),
+            'unet_config': {k: v for k, v in model_config.unet_config.items() if k != 'dtype'},
+            'parts': parts,
+            'extra': 'extra.safetensors',
+        }
+        temp_filename = os.path.join(folder, f'{config_filename}.tmp')
+        with open(temp_filename, 'wt', encoding='utf-8') as fp:
+            json.dump(config, fp, indent=4)
+        os.replace(temp_filename, os.path.join(folder, config_filename))
+        print(f'[Checkpoint Cache] Saved converted {ckpt_filename} to {folder}')
+    except Exception as e:
+        print(f'[Checkpoint Cache] Converting {ckpt_filename} failed: {e}')
+    finally:
+        with saving_lock:
+            saving_folders.discard(folder)
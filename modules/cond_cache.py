@@ -0,0 +1,109 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+import ldm_patched.modules.model_management as model_management
+
+
+def tensor_bytes(value) -> int:
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_bytes(v) for v in value)
+    return 0
+
+
+class CondCache:
+    """LRU cache of text encoder outputs bounded by their size in bytes.
+
+    Keys must identify the text encoder weights, so entries stay valid when switching models back and forth.
+    Evicted entries are written to spill_path if it is set and read back on the next miss.
+    """
+
+    def __init__(self, max_bytes, spill_path=None):
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spill_hits = 0
+
+        if self.spill_path is not None:
+            os.makedirs(self.spill_path, exist_ok=True)
+
+    def spill_filename(self, key):
+        return os.path.join(self.spill_path, hashlib.sha256(repr(key).encode('utf-8')).hexdigest() + '.pt')
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        if self.spill_path is not None:
+            filename = self.spill_filename(key)
+            if os.path.exists(filename):
+                try:
+                    value = tuple(torch.load(filename, map_location=model_management.intermediate_device(),
+                                             weights_only=True))
+                except Exception as e:
+                    print(f'[Cond Cache] Failed to load {filename}: {e}')
+                    value = None
+                if value is not None:
+                    with self.lock:
+                        self.spill_hits += 1
+                        self.hits += 1
+                    self.put(key, value)
+                    return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        size = tensor_bytes(value)
+        if size > self.max_bytes:
+            return
+
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.size -= tensor_bytes(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_key, evicted_value = self.entries.popitem(last=False)
+                self.size -= tensor_bytes(evicted_value)
+                self.evictions += 1
+                evicted.append((evicted_key, evicted_value))
+
+        if self.spill_path is not None:
+            for evicted_key, evicted_value in evicted:
+                filename = self.spill_filename(evicted_key)
+                if not os.path.exists(filename):
+                    torch.save([v.cpu() if isinstance(v, torch.Tensor) else v for v in evicted_value], filename)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'spill_hits': self.spill_hits,
+            }
@@ -568,6 +568,12 @@ default_cfg_tsnr = get_config_item_or_set_default(
     validator=lambda x: isinstance(x, numbers.Number),
     expected_type=numbers.Number
 )
+default_attention_reduction = get_config_item_or_set_default(
+    key='default_attention_reduction',
+    default_value=modules.flags.attention_reduction_none,
+    validator=lambda x: x in modules.flags.attention_reduction_methods,
+    expected_type=str
+)
 default_clip_skip = get_config_item_or_set_default(
     key='default_clip_skip',
     default_value=2,
@@ -733,6 +739,7 @@ possible_preset_keys = {
     "default_cfg_scale": "guidance_scale",
     "default_sample_sharpness": "sharpness",
     "default_cfg_tsnr": "adaptive_cfg",
+    "default_attention_reduction": "attention_reduction",
     "default_clip_skip": "clip_skip",
     "default_sampler": "sampler",
     "default_scheduler": "scheduler",
@@ -885,60 +892,60 @@ def downloading_sdxl_hyper_sd_lora():
     return modules.flags.PerformanceLoRA.HYPER_SD.value
 
 
-def downloading_controlnet_canny():
-    load_file_from_url(
-        url='https://huggingface.co/lllyasviel/misc/resolve/main/control-lora-canny-rank128.safetensors',
-        model_dir=path_controlnet,
-        file_name='control-lora-canny-rank128.safetensors'
-    )
-    return os.path.join(path_controlnet, 'control-lora-canny-rank128.safetensors')
+controlnet_canny_filename = 'control-lora-canny-rank128.safetensors'
+controlnet_cpds_filename = 'fooocus_xl_cpds_128.safetensors'
+ip_adapter_filenames = {
+    'ip': 'ip-adapter-plus_sdxl_vit-h.bin',
+    'face': 'ip-adapter-plus-face_sdxl_vit-h.bin'
+}
 
 
-def downloading_controlnet_cpds():
-    load_file_from_url(
-        url='https://huggingface.co/lllyasviel/misc/resolve/main/fooocus_xl_cpds_128.safetensors',
-        model_dir=path_controlnet,
-        file_name='fooocus_xl_cpds_128.safetensors'
-    )
-    return os.path.join(path_controlnet, 'fooocus_xl_cpds_128.safetensors')
+def controlnet_canny_path():
+    return os.path.join(path_controlnet, controlnet_canny_filename)
 
 
-def downloading_ip_adapters(v):
+def controlnet_cpds_path():
+    return os.path.join(path_controlnet, controlnet_cpds_filename)
+
+
+def ip_adapter_paths(v):
+    """Paths of the clip vision model, the negative embedding and the IP-Adapter, which may not be downloaded yet."""
     assert v in ['ip', 'face']
+    return [os.path.join(path_clip_vision, 'clip_vision_vit_h.safetensors'),
+            os.path.join(path_controlnet, 'fooocus_ip_negative.safetensors'),
+            os.path.join(path_controlnet, ip_adapter_filenames[v])]
 
-    results = []
 
+def downloading_controlnet_canny():
     load_file_from_url(
-        url='https://huggingface.co/lllyasviel/misc/resolve/main/clip_vision_vit_h.safetensors',
-        model_dir=path_clip_vision,
-        file_name='clip_vision_vit_h.safetensors'
+        url=f'https://huggingface.co/lllyasviel/misc/resolve/main/{controlnet_canny_filename}',
+        model_dir=path_controlnet,
+        file_name=controlnet_canny_filename
     )
-    results += [os.path.join(path_clip_vision, 'clip_vision_vit_h.safetensors')]
+    return controlnet_canny_path()
+
 
+def downloading_controlnet_cpds():
     load_file_from_url(
-        url='https://huggingface.co/lllyasviel/misc/resolve/main/fooocus_ip_negative.safetensors',
+        url=f'https://huggingface.co/lllyasviel/misc/resolve/main/{controlnet_cpds_filename}',
         model_dir=path_controlnet,
-        file_name='fooocus_ip_negative.safetensors'
+        file_name=controlnet_cpds_filename
     )
-    results += [os.path.join(path_controlnet, 'fooocus_ip_negative.safetensors')]
+    return controlnet_cpds_path()
 
-    if v == 'ip':
-        load_file_from_url(
-            url='https://huggingface.co/lllyasviel/misc/resolve/main/ip-adapter-plus_sdxl_vit-h.bin',
-            model_dir=path_controlnet,
-            file_name='ip-adapter-plus_sdxl_vit-h.bin'
-        )
-        results += [os.path.join(path_controlnet, 'ip-adapter-plus_sdxl_vit-h.bin')]
 
-    if v == 'face':
+def downloading_ip_adapters(v):
+    assert v in ['ip', 'face']
+
+    for filepath in ip_adapter_paths(v):
+        file_name = os.path.basename(filepath)
         load_file_from_url(
-            url='https://huggingface.co/lllyasviel/misc/resolve/main/ip-adapter-plus-face_sdxl_vit-h.bin',
-            model_dir=path_controlnet,
-            file_name='ip-adapter-plus-face_sdxl_vit-h.bin'
+            url=f'https://huggingface.co/lllyasviel/misc/resolve/main/{file_name}',
+            model_dir=os.path.dirname(filepath),
+            file_name=file_name
         )
-        results += [os.path.join(path_controlnet, 'ip-adapter-plus-face_sdxl_vit-h.bin')]
 
-    return results
+    return ip_adapter_paths(v)
 
 
 def downloading_upscale_model():
@@ -9,15 +9,17 @@ import ldm_patched.modules.model_patcher
 import ldm_patched.modules.utils
 import ldm_patched.modules.controlnet
 import modules.sample_hijack
+import modules.lora_merge_cache
+import modules.checkpoint_cache
 import ldm_patched.modules.samplers
 import ldm_patched.modules.latent_formats
 
-from ldm_patched.modules.sd import load_checkpoint_guess_config
+from ldm_patched.modules.sd import load_checkpoint_guess_config, VAE
 from ldm_patched.contrib.external import VAEDecode, EmptyLatentImage, VAEEncode, VAEEncodeTiled, VAEDecodeTiled, \
     ControlNetApplyAdvanced
 from ldm_patched.contrib.external_freelunch import FreeU_V2
 from ldm_patched.modules.sample import prepare_mask
-from modules.lora import match_lora
+from modules.lora import load_lora_patches, key_map_signature
 from modules.util import get_file_from_folder_list
 from ldm_patched.modules.lora import model_lora_keys_unet, model_lora_keys_clip
 from modules.config import path_embeddings
@@ -33,6 +35,9 @@ opFreeU = FreeU_V2()
 opModelSamplingDiscrete = ModelSamplingDiscrete()
 opModelSamplingContinuousEDM = ModelSamplingContinuousEDM()
 
+# text encoder keys of kohya and diffusers LoRA files
+lora_clip_key_prefixes = ('lora_te', 'text_encoder')
+
 
 class StableDiffusionModel:
     def __init__(self, unet=None, vae=None, clip=None, clip_vision=None, filename=None, vae_filename=None):
@@ -57,6 +62,8 @@ class StableDiffusionModel:
             self.lora_key_map_clip = model_lora_keys_clip(self.clip.cond_stage_model, self.lora_key_map_clip)
             self.lora_key_map_clip.update({x: x for x in self.clip.cond_stage_model.state_dict().keys()})
 
+        self.lora_key_map_signature = key_map_signature([self.lora_key_map_unet, self.lora_key_map_clip])
+
     @torch.no_grad()
     @torch.inference_mode()
     def refresh_loras(self, loras):
@@ -92,10 +99,33 @@ class StableDiffusionModel:
         self.unet_with_lora = self.unet.clone() if self.unet is not None else None
         self.clip_with_lora = self.clip.clone() if self.clip is not None else None
 
+        # Merged weights of a LoRA stack can be loaded from the cache instead of merging the LoRA files again
+        patchers = {'unet': self.unet_with_lora, 'clip': self.clip_with_lora.patcher if self.clip_with_lora is not None else None}
+        uncached_parts = {}
+        for part, patcher in patchers.items():
+            if patcher is None:
+                continue
+            if len(loras_to_load) == 0 or not modules.lora_merge_cache.is_enabled():
+                uncached_parts[part] = None
+                continue
+            key = modules.lora_merge_cache.merge_key(self.filename, loras_to_load, part)
+            cached_patches = modules.lora_merge_cache.load_deltas(key)
+            if cached_patches is None:
+                uncached_parts[part] = key
+                continue
+            loaded_keys = patcher.add_patches(cached_patches, 1.0)
+            print(f'Loaded merged LoRAs for {part} [{self.filename}] from cache with {len(loaded_keys)} keys.')
+
+        if len(uncached_parts) == 0:
+            return
+
         for lora_filename, weight in loras_to_load:
-            lora_unmatch = ldm_patched.modules.utils.load_torch_file(lora_filename, safe_load=False)
-            lora_unet, lora_unmatch = match_lora(lora_unmatch, self.lora_key_map_unet)
-            lora_clip, lora_unmatch = match_lora(lora_unmatch, self.lora_key_map_clip)
+            lora_unet, lora_clip, lora_unmatch = load_lora_patches(lora_filename, self.lora_key_map_unet,
+                                                                   self.lora_key_map_clip, self.lora_key_map_signature)
+
+            if self.clip is None:
+                # models loaded without text encoders, like the refiner, can only match the UNet keys
+                lora_unmatch = [k for k in lora_unmatch if not k.startswith(lora_clip_key_prefixes)]
 
             if len(lora_unmatch) > 12:
                 # model mismatch
@@ -103,9 +133,9 @@ class StableDiffusionModel:
 
             if len(lora_unmatch) > 0:
                 print(f'Loaded LoRA [{lora_filename}] for model [{self.filename}] '
-                      f'with unmatched keys {list(lora_unmatch.keys())}')
+                      f'with unmatched keys {lora_unmatch}')
 
-            if self.unet_with_lora is not None and len(lora_unet) > 0:
+            if self.unet_with_lora is not None and len(lora_unet) > 0 and 'unet' in uncached_parts:
                 loaded_keys = self.unet_with_lora.add_patches(lora_unet, weight)
                 print(f'Loaded LoRA [{lora_filename}] for UNet [{self.filename}] '
                       f'with {len(loaded_keys)} keys at weight {weight}.')
@@ -113,7 +143,7 @@ class StableDiffusionModel:
                     if item not in loaded_keys:
                         print("UNet LoRA key skipped: ", item)
 
-            if self.clip_with_lora is not None and len(lora_clip) > 0:
+            if self.clip_with_lora is not None and len(lora_clip) > 0 and 'clip' in uncached_parts:
                 loaded_keys = self.clip_with_lora.add_patches(lora_clip, weight)
                 print(f'Loaded LoRA [{lora_filename}] for CLIP [{self.filename}] '
                       f'with {len(loaded_keys)} keys at weight {weight}.')
@@ -121,6 +151,10 @@ class StableDiffusionModel:
                     if item not in loaded_keys:
                         print("CLIP LoRA key skipped: ", item)
 
+        for part, key in uncached_parts.items():
+            if key is not None:
+                modules.lora_merge_cache.record_deltas(patchers[part], key)
+
 
 @torch.no_grad()
 @torch.inference_mode()
@@ -143,9 +177,21 @@ def apply_controlnet(positive, negative, control_net, image, strength, start_per
 
 @torch.no_grad()
 @torch.inference_mode()
-def load_model(ckpt_filename, vae_filename=None):
+def load_model(ckpt_filename, vae_filename=None, output_clip=True):
+    if modules.checkpoint_cache.is_enabled():
+        # a separate VAE file replaces the one of the checkpoint, it is not part of the converted copy
+        converted = modules.checkpoint_cache.load(ckpt_filename, output_vae=vae_filename is None, output_clip=output_clip,
+                                                  embedding_directory=path_embeddings)
+        if converted is not None:
+            unet, clip, vae = converted
+            if vae_filename is not None:
+                vae = VAE(sd=ldm_patched.modules.utils.load_torch_file(vae_filename, mmap=True))
+            return StableDiffusionModel(unet=unet, clip=clip, vae=vae, filename=ckpt_filename, vae_filename=vae_filename)
+
     unet, clip, vae, vae_filename, clip_vision = load_checkpoint_guess_config(ckpt_filename, embedding_directory=path_embeddings,
-                                                                vae_filename_param=vae_filename)
+                                                                vae_filename_param=vae_filename, output_clip=output_clip)
+    if modules.checkpoint_cache.is_enabled():
+        modules.checkpoint_cache.save(ckpt_filename, unet, clip, vae if vae_filename is None else None)
     return StableDiffusionModel(unet=unet, clip=clip, vae=vae, clip_vision=clip_vision, filename=ckpt_filename, vae_filename=vae_filename)
 
 
@@ -253,7 +299,8 @@ def get_previewer(model):
         with torch.no_grad():
             x_sample = x0.to(VAE_approx_model.current_type)
             x_sample = VAE_approx_model(x_sample) * 127.5 + 127.5
-            x_sample = einops.rearrange(x_sample, 'b c h w -> b h w c')[0]
+            # batched samples are previewed side by side
+            x_sample = einops.rearrange(x_sample, 'b c h w -> h (b w) c')
             x_sample = x_sample.cpu().numpy().clip(0, 255).astype(np.uint8)
             return x_sample
 
@@ -272,8 +319,13 @@ def ksampler(model, positive, negative, latent, seed=None, steps=30, cfg=7.0, sa
 
     latent_image = latent["samples"]
 
+    # a list of seeds means one seed per sample of a batched latent, the sampler draws its noise per sample as well
     if disable_noise:
         noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
+    elif isinstance(seed, list):
+        assert len(seed) == latent_image.shape[0]
+        noise = torch.cat([ldm_patched.modules.sample.prepare_noise(latent_image[i:i + 1], s)
+                           for i, s in enumerate(seed)], dim=0)
     else:
         batch_inds = latent["batch_index"] if "batch_index" in latent else None
         noise = ldm_patched.modules.sample.prepare_noise(latent_image, seed, batch_inds)
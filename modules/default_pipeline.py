@@ -1,5 +1,8 @@
 import modules.core as core
 import os
+import args_manager
+import math
+import threading
 import torch
 import modules.patch
 import modules.config
@@ -9,6 +12,8 @@ import ldm_patched.modules.latent_formats
 import modules.inpaint_worker
 import extras.vae_interpose as vae_interpose
 from extras.expansion import FooocusExpansion
+from modules.cond_cache import CondCache
+from modules.model_pool import ModelPool
 
 from ldm_patched.modules.model_base import SDXL, SDXLRefiner
 from modules.sample_hijack import clip_separate
@@ -26,6 +31,15 @@ final_refiner_unet = None
 final_refiner_vae = None
 
 loaded_ControlNets = {}
+loaded_pipeline_key = None
+
+cond_cache = CondCache(max_bytes=args_manager.args.cond_cache_size * 1024 * 1024,
+                       spill_path=args_manager.args.cond_cache_spill_path)
+
+model_pool = ModelPool(max_bytes=args_manager.args.model_pool_size * 1024 * 1024)
+
+# Held by whoever refreshes, patches or samples with the models above.
+pipeline_lock = threading.RLock()
 
 
 @torch.no_grad()
@@ -71,9 +85,17 @@ def refresh_base_model(name, vae_name=None):
     if model_base.filename == filename and model_base.vae_filename == vae_filename:
         return
 
+    key = ('base', filename, vae_filename)
+    model = model_pool.get(key)
+    if model is not None:
+        model_base = model
+        print(f'Base model reused from model pool: {model_base.filename}')
+        return
+
     model_base = core.load_model(filename, vae_filename)
     print(f'Base model loaded: {model_base.filename}')
     print(f'VAE loaded: {model_base.vae_filename}')
+    add_to_model_pool(key, model_base)
     return
 
 
@@ -93,7 +115,15 @@ def refresh_refiner_model(name):
         print(f'Refiner unloaded.')
         return
 
-    model_refiner = core.load_model(filename)
+    key = ('refiner', filename)
+    model = model_pool.get(key)
+    if model is not None:
+        model_refiner = model
+        print(f'Refiner model reused from model pool: {model_refiner.filename}')
+        return
+
+    # the refiner never encodes prompts, so its text encoder is not read from the file at all
+    model_refiner = core.load_model(filename, output_clip=False)
     print(f'Refiner model loaded: {model_refiner.filename}')
 
     if isinstance(model_refiner.unet.model, SDXL):
@@ -105,9 +135,28 @@ def refresh_refiner_model(name):
     else:
         model_refiner.clip = None
 
+    add_to_model_pool(key, model_refiner)
     return
 
 
+def model_size(model):
+    size = 0
+    if model.unet is not None:
+        size += ldm_patched.modules.model_management.module_size(model.unet.model)
+    if model.clip is not None:
+        size += ldm_patched.modules.model_management.module_size(model.clip.cond_stage_model)
+    if model.vae is not None:
+        size += ldm_patched.modules.model_management.module_size(model.vae.first_stage_model)
+    return size
+
+
+def add_to_model_pool(key, model):
+    if model_pool.max_bytes <= 0:
+        return
+    for evicted_key in model_pool.put(key, model, model_size(model)):
+        print(f'Model evicted from model pool: {evicted_key[1]}')
+
+
 @torch.no_grad()
 @torch.inference_mode()
 def synthesize_refiner_model():
@@ -145,14 +194,17 @@ def refresh_loras(loras, base_model_additional_loras=None):
 @torch.no_grad()
 @torch.inference_mode()
 def clip_encode_single(clip, text, verbose=False):
-    cached = clip.fcs_cond_cache.get(text, None)
+    model_key = getattr(clip, 'fcs_model_key', None)
+    key = (model_key, clip.layer_idx, text)
+    cached = cond_cache.get(key) if model_key is not None else None
     if cached is not None:
         if verbose:
             print(f'[CLIP Cached] {text}')
         return cached
     tokens = clip.tokenize(text)
     result = clip.encode_from_tokens(tokens, return_pooled=True)
-    clip.fcs_cond_cache[text] = result
+    if model_key is not None:
+        cond_cache.put(key, result)
     if verbose:
         print(f'[CLIP Encoded] {text}')
     return result
@@ -179,26 +231,93 @@ def clone_cond(conds):
 
 @torch.no_grad()
 @torch.inference_mode()
-def clip_encode(texts, pool_top_k=1):
+def batch_conds(conds_list):
+    # Stack per-sample conds into one batched cond, row i belongs to sample i.
+    # Token lengths are repeated up to their lcm, which leaves cross attention unchanged.
+    cond_list = []
+    pooled_list = []
+
+    for conds in conds_list:
+        assert len(conds) == 1
+        c, p = conds[0]
+        cond_list.append(c)
+        pooled_list.append(p['pooled_output'])
+
+    max_length = math.lcm(*[int(c.shape[1]) for c in cond_list])
+    cond_list = [c.repeat(1, max_length // int(c.shape[1]), 1) for c in cond_list]
+
+    return [[torch.cat(cond_list, dim=0), {"pooled_output": torch.cat(pooled_list, dim=0)}]]
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def clip_encode_texts(clip, texts, max_batch_chunks=32):
+    # Uncached texts are tokenized and encoded in a few batches, grouped by their number of 77-token chunks.
+    model_key = getattr(clip, 'fcs_model_key', None)
+    results = {}
+    tokens = {}
+
+    for text in dict.fromkeys(texts):
+        cached = cond_cache.get((model_key, clip.layer_idx, text)) if model_key is not None else None
+        if cached is not None:
+            results[text] = cached
+        else:
+            tokens[text] = clip.tokenize(text)
+
+    groups = {}
+    for text, text_tokens in tokens.items():
+        chunks = len(next(iter(text_tokens.values()))) if isinstance(text_tokens, dict) else len(text_tokens)
+        groups.setdefault(chunks, []).append(text)
+
+    for chunks, group in groups.items():
+        step = max(1, max_batch_chunks // max(1, chunks))
+        for i in range(0, len(group), step):
+            batch = group[i:i + step]
+            encoded = clip.encode_from_tokens_batch([tokens[text] for text in batch], return_pooled=True)
+            for text, result in zip(batch, encoded):
+                results[text] = result
+                if model_key is not None:
+                    cond_cache.put((model_key, clip.layer_idx, text), result)
+
+    return [results[text] for text in texts]
+
+
+@torch.no_grad()
+@torch.inference_mode()
+def clip_encode_batch(texts_list, pool_top_k_list):
     global final_clip
 
     if final_clip is None:
-        return None
-    if not isinstance(texts, list):
-        return None
-    if len(texts) == 0:
-        return None
+        return [None] * len(texts_list)
 
-    cond_list = []
-    pooled_acc = 0
+    valid_texts = [texts for texts in texts_list if isinstance(texts, list) and len(texts) > 0]
+    encoded = clip_encode_texts(final_clip, [text for texts in valid_texts for text in texts])
+    encoded = iter(encoded)
+
+    results = []
+    for texts, pool_top_k in zip(texts_list, pool_top_k_list):
+        if not isinstance(texts, list) or len(texts) == 0:
+            results.append(None)
+            continue
+
+        cond_list = []
+        pooled_acc = 0
+
+        for i in range(len(texts)):
+            cond, pooled = next(encoded)
+            cond_list.append(cond)
+            if i < pool_top_k:
+                pooled_acc += pooled
+
+        results.append([[torch.cat(cond_list, dim=1), {"pooled_output": pooled_acc}]])
+
+    return results
 
-    for i, text in enumerate(texts):
-        cond, pooled = clip_encode_single(final_clip, text)
-        cond_list.append(cond)
-        if i < pool_top_k:
-            pooled_acc += pooled
 
-    return [[torch.cat(cond_list, dim=1), {"pooled_output": pooled_acc}]]
+@torch.no_grad()
+@torch.inference_mode()
+def clip_encode(texts, pool_top_k=1):
+    return clip_encode_batch([texts], [pool_top_k])[0]
 
 
 @torch.no_grad()
@@ -215,7 +334,7 @@ def set_clip_skip(clip_skip: int):
 @torch.no_grad()
 @torch.inference_mode()
 def clear_all_caches():
-    final_clip.fcs_cond_cache = {}
+    cond_cache.clear()
 
 
 @torch.no_grad()
@@ -233,7 +352,9 @@ def prepare_text_encoder(async_call=True):
 @torch.inference_mode()
 def refresh_everything(refiner_model_name, base_model_name, loras,
                        base_model_additional_loras=None, use_synthetic_refiner=False, vae_name=None):
-    global final_unet, final_clip, final_vae, final_refiner_unet, final_refiner_vae, final_expansion
+    global final_unet, final_clip, final_vae, final_refiner_unet, final_refiner_vae, final_expansion, loaded_pipeline_key
+
+    loaded_pipeline_key = None
 
     final_unet = None
     final_clip = None
@@ -259,14 +380,38 @@ def refresh_everything(refiner_model_name, base_model_name, loras,
     final_refiner_unet = model_refiner.unet_with_lora
     final_refiner_vae = model_refiner.vae
 
+    if final_clip is not None:
+        # Conds are cached across model switches, keyed by text encoder weights and LoRAs
+        final_clip.fcs_model_key = (model_base.filename, model_base.visited_loras)
+
     if final_expansion is None:
         final_expansion = FooocusExpansion()
 
     prepare_text_encoder(async_call=True)
-    clear_all_caches()
+    loaded_pipeline_key = (refiner_model_name, base_model_name, str(loras),
+                           str(base_model_additional_loras), use_synthetic_refiner, vae_name)
     return
 
 
+@torch.no_grad()
+@torch.inference_mode()
+def ensure_everything(refiner_model_name, base_model_name, loras,
+                      base_model_additional_loras=None, use_synthetic_refiner=False, vae_name=None):
+    """Like refresh_everything, but keeps the warm pipeline if it already matches and has not been patched since."""
+    key = (refiner_model_name, base_model_name, str(loras),
+           str(base_model_additional_loras), use_synthetic_refiner, vae_name)
+
+    if loaded_pipeline_key == key \
+            and final_unet is model_base.unet_with_lora and final_clip is model_base.clip_with_lora \
+            and final_refiner_unet is model_refiner.unet_with_lora:
+        return False
+
+    refresh_everything(refiner_model_name, base_model_name, loras,
+                       base_model_additional_loras=base_model_additional_loras,
+                       use_synthetic_refiner=use_synthetic_refiner, vae_name=vae_name)
+    return True
+
+
 refresh_everything(
     refiner_model_name=modules.config.default_refiner_model_name,
     base_model_name=modules.config.default_base_model_name,
@@ -339,6 +484,10 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
 
     assert refiner_swap_method in ['joint', 'separate', 'vae']
 
+    patch_settings = modules.patch.get_patch_settings()
+    patch_settings.cfg_truncated_sigma = None
+    patch_settings.deep_cache = {}
+
     if final_refiner_vae is not None and final_refiner_unet is not None:
         # Refiner Use Different VAE (then it is SD15)
         if denoise > 0.9:
@@ -358,10 +507,16 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
 
     print(f'[Sampler] refiner_swap_method = {refiner_swap_method}')
 
+    # a list of seeds samples one batched latent, one seed per image
+    batch_size = len(image_seed) if isinstance(image_seed, list) else 1
+
     if latent is None:
-        initial_latent = core.generate_empty_latent(width=width, height=height, batch_size=1)
+        initial_latent = core.generate_empty_latent(width=width, height=height, batch_size=batch_size)
     else:
         initial_latent = latent
+        if initial_latent['samples'].shape[0] != batch_size:
+            initial_latent = initial_latent.copy()
+            initial_latent['samples'] = initial_latent['samples'][:1].repeat(batch_size, 1, 1, 1)
 
     minmax_sigmas = calculate_sigmas(sampler=sampler_name, scheduler=scheduler_name, model=final_unet.model, steps=steps, denoise=denoise)
     sigma_min, sigma_max = minmax_sigmas[minmax_sigmas > 0].min(), minmax_sigmas.max()
@@ -443,10 +598,11 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
         decoded_latent = core.decode_vae(vae=target_model, latent_image=sampled_latent, tiled=tiled)
 
     if refiner_swap_method == 'vae':
-        modules.patch.patch_settings[os.getpid()].eps_record = 'vae'
+        modules.patch.get_patch_settings().eps_record = 'vae'
 
-        if modules.inpaint_worker.current_task is not None:
-            modules.inpaint_worker.current_task.unswap()
+        inpaint_task = modules.inpaint_worker.get_current_task()
+        if inpaint_task is not None:
+            inpaint_task.unswap()
 
         sampled_latent = core.ksampler(
             model=target_unet,
@@ -481,10 +637,10 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
                                   denoise=denoise)[switch:] * k_sigmas
         len_sigmas = len(sigmas) - 1
 
-        noise_mean = torch.mean(modules.patch.patch_settings[os.getpid()].eps_record, dim=1, keepdim=True)
+        noise_mean = torch.mean(modules.patch.get_patch_settings().eps_record, dim=1, keepdim=True)
 
-        if modules.inpaint_worker.current_task is not None:
-            modules.inpaint_worker.current_task.swap()
+        if inpaint_task is not None:
+            inpaint_task.swap()
 
         sampled_latent = core.ksampler(
             model=target_model,
@@ -492,7 +648,7 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
             negative=clip_separate(negative_cond, target_model=target_model.model, target_clip=target_clip),
             latent=sampled_latent,
             steps=len_sigmas, start_step=0, last_step=len_sigmas, disable_noise=False, force_full_denoise=True,
-            seed=image_seed+1,
+            seed=[s + 1 for s in image_seed] if isinstance(image_seed, list) else image_seed + 1,
             denoise=denoise,
             callback_function=callback,
             cfg=cfg_scale,
@@ -511,5 +667,6 @@ def process_diffusion(positive_cond, negative_cond, steps, switch, width, height
         decoded_latent = core.decode_vae(vae=target_model, latent_image=sampled_latent, tiled=tiled)
 
     images = core.pytorch_to_numpy(decoded_latent)
-    modules.patch.patch_settings[os.getpid()].eps_record = None
+    patch_settings.eps_record = None
+    patch_settings.deep_cache = {}
     return images
@@ -0,0 +1,81 @@
+import sqlite3
+import threading
+import time
+
+expansion_cache_filename = 'expansion_cache.db'
+
+
+class ExpansionCache:
+    """Persistent results of prompt expansion keyed by (prompt, seed), for one version of the expansion model.
+
+    Reads do not write, the access times of hits are collected and written together with the next put or after
+    every flush_interval hits.
+    """
+
+    flush_interval = 64
+
+    def __init__(self, model_hash, max_entries, filename):
+        self.max_entries = max_entries
+        self.model_hash = model_hash
+        self.lock = threading.Lock()
+        self.connection = None
+        self.puts = 0
+        self.used = {}
+
+        if self.max_entries <= 0:
+            return
+
+        try:
+            self.connection = sqlite3.connect(filename, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS expansions ('
+                                    'model_hash TEXT, prompt TEXT, seed INTEGER, result TEXT, used REAL, '
+                                    'PRIMARY KEY (model_hash, prompt, seed))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS expansions_used ON expansions (used)')
+            # results of other versions of the model are no longer valid
+            self.connection.execute('DELETE FROM expansions WHERE model_hash != ?', (self.model_hash,))
+            self.connection.commit()
+        except Exception as e:
+            print(f'[Expansion Cache] Loading failed: {e}')
+            self.connection = None
+
+    def get(self, prompt, seed):
+        if self.connection is None:
+            return None
+
+        with self.lock:
+            try:
+                row = self.connection.execute('SELECT result FROM expansions WHERE model_hash = ? AND prompt = ? AND seed = ?',
+                                              (self.model_hash, prompt, seed)).fetchone()
+                if row is None:
+                    return None
+                self.used[(prompt, seed)] = time.time()
+                if len(self.used) >= self.flush_interval:
+                    self.write_used()
+                    self.connection.commit()
+                return row[0]
+            except Exception as e:
+                print(f'[Expansion Cache] Reading failed: {e}')
+                return None
+
+    def put(self, prompt, seed, result):
+        if self.connection is None:
+            return
+
+        with self.lock:
+            try:
+                self.write_used()
+                self.connection.execute('INSERT OR REPLACE INTO expansions VALUES (?, ?, ?, ?, ?)',
+                                        (self.model_hash, prompt, seed, result, time.time()))
+                self.puts += 1
+                if self.puts % 64 == 0:
+                    self.connection.execute('DELETE FROM expansions WHERE rowid IN (SELECT rowid FROM expansions '
+                                            'ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+                self.connection.commit()
+            except Exception as e:
+                print(f'[Expansion Cache] Saving failed: {e}')
+
+    def write_used(self):
+        if len(self.used) > 0:
+            self.connection.executemany('UPDATE expansions SET used = ? WHERE model_hash = ? AND prompt = ? AND seed = ?',
+                                        [(used, self.model_hash, prompt, seed) for (prompt, seed), used in self.used.items()])
+            self.used = {}
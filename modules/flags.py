@@ -67,6 +67,11 @@ default_vae = 'Default (model)'
 
 refiner_swap_method = 'joint'
 
+attention_reduction_none = 'None'
+attention_reduction_tome = 'Token Merging'
+attention_reduction_hypertile = 'HyperTile'
+attention_reduction_methods = [attention_reduction_none, attention_reduction_tome, attention_reduction_hypertile]
+
 default_input_image_tab = 'uov_tab'
 input_image_tab_ids = ['uov_tab', 'ip_tab', 'inpaint_tab', 'describe_tab', 'enhance_tab', 'metadata_tab']
 
@@ -142,6 +147,7 @@ class Steps(IntEnum):
     EXTREME_SPEED = 8
     LIGHTNING = 4
     HYPER_SD = 4
+    DEEP_CACHE = 30
 
     @classmethod
     def keys(cls) -> list:
@@ -154,6 +160,12 @@ class StepsUOV(IntEnum):
     EXTREME_SPEED = 8
     LIGHTNING = 4
     HYPER_SD = 4
+    DEEP_CACHE = 18
+
+
+class DeepCacheInterval(IntEnum):
+    # full UNet passes are run every n steps, the steps in between reuse the deep features
+    DEEP_CACHE = 3
 
 
 class Performance(Enum):
@@ -162,6 +174,7 @@ class Performance(Enum):
     EXTREME_SPEED = 'Extreme Speed'
     LIGHTNING = 'Lightning'
     HYPER_SD = 'Hyper-SD'
+    DEEP_CACHE = 'Deep Cache'
 
     @classmethod
     def list(cls) -> list:
@@ -189,3 +202,6 @@ class Performance(Enum):
 
     def lora_filename(self) -> str | None:
         return PerformanceLoRA[self.name].value if self.name in PerformanceLoRA.__members__ else None
+
+    def deep_cache_interval(self) -> int:
+        return DeepCacheInterval[self.name].value if self.name in DeepCacheInterval.__members__ else 0
@@ -1,25 +1,99 @@
 import json
 import os
+import threading
 from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import cpu_count
 
 import args_manager
-from modules.util import sha256, HASH_SHA256_LENGTH, get_file_from_folder_list
+from modules.util import sha256, calculate_partial_sha256, HASH_SHA256_LENGTH, get_file_from_folder_list
 
 hash_cache_filename = 'hash_cache.txt'
 hash_cache = {}
+hash_cache_lock = threading.RLock()
+hash_futures = {}
+hash_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='hash_cache')
 
 
-def sha256_from_cache(filepath):
-    global hash_cache
-    if filepath not in hash_cache:
+def file_stat(filepath) -> dict:
+    stat = os.stat(filepath)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'inode': stat.st_ino}
+
+
+def is_entry_valid(filepath, entry) -> bool:
+    try:
+        stat = file_stat(filepath)
+    except OSError:
+        return False
+    return all(entry.get(k) == v for k, v in stat.items())
+
+
+def get_cached_entry(filepath):
+    with hash_cache_lock:
+        entry = hash_cache.get(filepath)
+        if entry is not None and not is_entry_valid(filepath, entry):
+            print(f'[Cache] {filepath} changed, hash will be recalculated')
+            del hash_cache[filepath]
+            entry = None
+        return entry
+
+
+def calculate_and_cache(filepath):
+    try:
         print(f"[Cache] Calculating sha256 for {filepath}")
+        stat = file_stat(filepath)
         hash_value = sha256(filepath)
         print(f"[Cache] sha256 for {filepath}: {hash_value}")
-        hash_cache[filepath] = hash_value
-        save_cache_to_file(filepath, hash_value)
 
-    return hash_cache[filepath]
+        with hash_cache_lock:
+            entry = dict(hash_cache.get(filepath, {}), hash=hash_value, **stat)
+            hash_cache[filepath] = entry
+            save_cache_to_file(filepath, entry)
+    finally:
+        with hash_cache_lock:
+            hash_futures.pop(filepath, None)
+
+    return hash_value
+
+
+def prefetch_sha256(filepath):
+    """Starts hashing a file on the background pool, returns the future of the hash."""
+    with hash_cache_lock:
+        entry = get_cached_entry(filepath)
+        if entry is not None and 'hash' in entry:
+            return None
+        if filepath not in hash_futures:
+            hash_futures[filepath] = hash_executor.submit(calculate_and_cache, filepath)
+        return hash_futures[filepath]
+
+
+def sha256_from_cache(filepath, allow_partial=None):
+    if allow_partial is None:
+        allow_partial = args_manager.args.fast_model_hash
+
+    entry = get_cached_entry(filepath)
+    if entry is not None and 'hash' in entry:
+        return entry['hash']
+
+    future = prefetch_sha256(filepath)
+    if future is None:
+        return get_cached_entry(filepath)['hash']
+
+    if not allow_partial:
+        return future.result()
+
+    # Use a fingerprint of a few blocks until the full hash has been computed in the background
+    with hash_cache_lock:
+        entry = hash_cache.get(filepath)
+        if entry is not None and 'partial' in entry:
+            return entry['partial']
+
+    partial_value = calculate_partial_sha256(filepath)[:HASH_SHA256_LENGTH]
+    with hash_cache_lock:
+        entry = hash_cache.get(filepath)
+        if entry is not None and 'hash' in entry:
+            return entry['hash']
+        hash_cache[filepath] = dict(partial=partial_value, **file_stat(filepath))
+    return partial_value
 
 
 def load_cache_from_file():
@@ -30,32 +104,44 @@ def load_cache_from_file():
             with open(hash_cache_filename, 'rt', encoding='utf-8') as fp:
                 for line in fp:
                     entry = json.loads(line)
-                    for filepath, hash_value in entry.items():
-                        if not os.path.exists(filepath) or not isinstance(hash_value, str) and len(hash_value) != HASH_SHA256_LENGTH:
+                    for filepath, value in entry.items():
+                        if not os.path.exists(filepath):
+                            print(f'[Cache] Skipping invalid cache entry: {filepath}')
+                            continue
+                        if isinstance(value, str):
+                            # entries written before file stats were recorded, trusted as they are
+                            value = dict(hash=value, **file_stat(filepath))
+                        if not isinstance(value, dict) or not isinstance(value.get('hash'), str) \
+                                or len(value['hash']) != HASH_SHA256_LENGTH:
                             print(f'[Cache] Skipping invalid cache entry: {filepath}')
                             continue
-                        hash_cache[filepath] = hash_value
+                        if not is_entry_valid(filepath, value):
+                            print(f'[Cache] Skipping outdated cache entry: {filepath}')
+                            hash_cache.pop(filepath, None)
+                            continue
+                        hash_cache[filepath] = value
     except Exception as e:
         print(f'[Cache] Loading failed: {e}')
 
 
-def save_cache_to_file(filename=None, hash_value=None):
+def save_cache_to_file(filename=None, entry=None):
     global hash_cache
 
-    if filename is not None and hash_value is not None:
-        items = [(filename, hash_value)]
-        mode = 'at'
-    else:
-        items = sorted(hash_cache.items())
-        mode = 'wt'
+    with hash_cache_lock:
+        if filename is not None and entry is not None:
+            items = [(filename, entry)]
+            mode = 'at'
+        else:
+            items = sorted((k, v) for k, v in hash_cache.items() if 'hash' in v)
+            mode = 'wt'
 
-    try:
-        with open(hash_cache_filename, mode, encoding='utf-8') as fp:
-            for filepath, hash_value in items:
-                json.dump({filepath: hash_value}, fp)
-                fp.write('\n')
-    except Exception as e:
-        print(f'[Cache] Saving failed: {e}')
+        try:
+            with open(hash_cache_filename, mode, encoding='utf-8') as fp:
+                for filepath, entry in items:
+                    json.dump({filepath: {k: v for k, v in entry.items() if k != 'partial'}}, fp)
+                    fp.write('\n')
+        except Exception as e:
+            print(f'[Cache] Saving failed: {e}')
 
 
 def init_cache(model_filenames, paths_checkpoints, lora_filenames, paths_loras):
@@ -72,7 +158,9 @@ def init_cache(model_filenames, paths_checkpoints, lora_filenames, paths_loras):
 def rebuild_cache(lora_filenames, model_filenames, paths_checkpoints, paths_loras, max_workers=cpu_count()):
     def thread(filename, paths):
         filepath = get_file_from_folder_list(filename, paths)
-        sha256_from_cache(filepath)
+        entry = get_cached_entry(filepath)
+        if entry is None or 'hash' not in entry:
+            calculate_and_cache(filepath)
 
     print('[Cache] Rebuilding hash cache')
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
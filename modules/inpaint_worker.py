@@ -1,3 +1,4 @@
+import contextvars
 import torch
 import numpy as np
 
@@ -20,7 +21,16 @@ class InpaintHead(torch.nn.Module):
         return torch.nn.functional.conv2d(input=x, weight=self.head)
 
 
-current_task = None
+# Inpaint task of the generation running in the current thread.
+current_task = contextvars.ContextVar('inpaint_current_task', default=None)
+
+
+def get_current_task():
+    return current_task.get()
+
+
+def set_current_task(task):
+    current_task.set(task)
 
 
 def box_blur(x, k):
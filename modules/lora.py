@@ -1,3 +1,16 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+
+from safetensors import safe_open
+
+import args_manager
+import ldm_patched.modules.utils
+
+
 def match_lora(lora, to_load):
     patch_dict = {}
     loaded_keys = set()
@@ -148,5 +161,74 @@ def match_lora(lora, to_load):
             patch_dict["{}.bias".format(to_load[x][:-len(".weight")])] = ("diff", (diff_bias,))
             loaded_keys.add(diff_bias_name)
 
-    remaining_dict = {x: y for x, y in lora.items() if x not in loaded_keys}
+    if isinstance(lora, LazyStateDict):
+        remaining_dict = lora.without(loaded_keys)
+    else:
+        remaining_dict = {x: y for x, y in lora.items() if x not in loaded_keys}
     return patch_dict, remaining_dict
+
+
+class LazyStateDict(Mapping):
+    """State dict of an open safetensors file, tensors are only read when they are accessed."""
+
+    def __init__(self, handle, keys=None):
+        self.handle = handle
+        self.key_list = list(handle.keys()) if keys is None else keys
+        self.key_set = set(self.key_list)
+
+    def __getitem__(self, key):
+        if key not in self.key_set:
+            raise KeyError(key)
+        return self.handle.get_tensor(key)
+
+    def __contains__(self, key):
+        return key in self.key_set
+
+    def __iter__(self):
+        return iter(self.key_list)
+
+    def __len__(self):
+        return len(self.key_list)
+
+    def without(self, keys):
+        return LazyStateDict(self.handle, [k for k in self.key_list if k not in keys])
+
+
+lora_cache = OrderedDict()
+lora_cache_lock = threading.Lock()
+
+
+def key_map_signature(key_maps) -> str:
+    return hashlib.sha256(json.dumps([sorted(key_map.items()) for key_map in key_maps]).encode('utf-8')).hexdigest()
+
+
+def load_lora_patches(filename, key_map_unet, key_map_clip, key_map_signature):
+    """Matches a LoRA file against the key maps of a model, returns (unet patches, clip patches, unmatched keys).
+
+    Results are kept in a small LRU cache keyed by file, modification time and key maps.
+    """
+    stat = os.stat(filename)
+    cache_key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns, key_map_signature)
+
+    with lora_cache_lock:
+        if cache_key in lora_cache:
+            lora_cache.move_to_end(cache_key)
+            return lora_cache[cache_key]
+
+    if filename.lower().endswith('.safetensors'):
+        with safe_open(filename, framework='pt', device='cpu') as f:
+            lora_unet, lora_unmatch = match_lora(LazyStateDict(f), key_map_unet)
+            lora_clip, lora_unmatch = match_lora(lora_unmatch, key_map_clip)
+    else:
+        lora_unmatch = ldm_patched.modules.utils.load_torch_file(filename, safe_load=False)
+        lora_unet, lora_unmatch = match_lora(lora_unmatch, key_map_unet)
+        lora_clip, lora_unmatch = match_lora(lora_unmatch, key_map_clip)
+
+    result = lora_unet, lora_clip, list(lora_unmatch.keys())
+
+    with lora_cache_lock:
+        lora_cache[cache_key] = result
+        while len(lora_cache) > max(0, args_manager.args.lora_cache_size):
+            lora_cache.popitem(last=False)
+
+    return result
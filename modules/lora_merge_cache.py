@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import safetensors.torch
+
+import args_manager
+import ldm_patched.modules.utils
+from ldm_patched.modules.model_patcher import WeightDeltaRecorder
+
+# deltas are written one chunk at a time, at most this many chunks wait for the disk
+max_pending_chunks = 2
+writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='lora_merge_cache')
+
+# Loaded deltas are kept, so that loading a LoRA stack again gives the same patch objects and re-patching a clone
+# only merges the keys whose patches changed. They are views of the mapped files and cost no memory of their own.
+loaded_patches = OrderedDict()
+loaded_patches_lock = threading.Lock()
+max_loaded_patches = 4
+
+
+def file_signature(filepath):
+    stat = os.stat(filepath)
+    return [os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns]
+
+
+def merge_key(model_filename, loras, part) -> str:
+    """Identifies the merged deltas of a LoRA stack on one checkpoint, changes whenever one of the files changes."""
+    signature = [file_signature(model_filename), [file_signature(f) + [w] for f, w in loras], part]
+    return hashlib.sha256(json.dumps(signature).encode('utf-8')).hexdigest()
+
+
+def cache_folder(key):
+    return os.path.join(args_manager.args.lora_merge_cache_path, key)
+
+
+def max_cache_bytes():
+    return args_manager.args.lora_merge_cache_size * 1024 * 1024
+
+
+def is_enabled():
+    return args_manager.args.lora_merge_cache_path is not None
+
+
+def load_deltas(key):
+    """Returns the cached deltas as diff patches, tensors are read from the memory mapped files."""
+    with loaded_patches_lock:
+        if key in loaded_patches:
+            loaded_patches.move_to_end(key)
+            return loaded_patches[key]
+
+    folder = cache_folder(key)
+    if not os.path.isdir(folder):
+        return None
+
+    try:
+        patches = {}
+        for filename in sorted(os.listdir(folder)):
+            sd = ldm_patched.modules.utils.load_torch_file(os.path.join(folder, filename), mmap=True)
+            patches.update({k: (v,) for k, v in sd.items()})
+        os.utime(folder)
+    except Exception as e:
+        print(f'[LoRA Cache] Loading {folder} failed: {e}')
+        return None
+
+    with loaded_patches_lock:
+        loaded_patches[key] = patches
+        while len(loaded_patches) > max_loaded_patches:
+            loaded_patches.popitem(last=False)
+    return patches
+
+
+def folder_size(folder):
+    return sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+
+
+def prune():
+    """Removes the least recently used LoRA stacks until the cache fits into its disk budget."""
+    root = args_manager.args.lora_merge_cache_path
+    folders = [os.path.join(root, f) for f in os.listdir(root) if not f.endswith('.tmp')]
+    folders = [f for f in folders if os.path.isdir(f)]
+    folders.sort(key=os.path.getmtime, reverse=True)
+
+    total = 0
+    for folder in folders:
+        try:
+            total += folder_size(folder)
+            if total > max_cache_bytes():
+                shutil.rmtree(folder)
+        except OSError:
+            pass
+
+
+class DeltaWriter:
+    """Writes the deltas of one LoRA stack as numbered safetensors files while the weights are being merged.
+
+    The files are written to a temporary folder, which replaces the cache entry once all deltas are written.
+    """
+
+    def __init__(self, key):
+        self.folder = cache_folder(key)
+        self.temp_folder = f'{self.folder}.tmp'
+        self.chunks = 0
+        self.failed = False
+        self.pending = threading.BoundedSemaphore(max_pending_chunks)
+
+    def __call__(self, deltas, last):
+        if len(deltas) > 0:
+            self.pending.acquire()
+            writer.submit(self.write, self.chunks, deltas)
+            self.chunks += 1
+        if last:
+            writer.submit(self.finish)
+
+    def write(self, index, deltas):
+        try:
+            if not self.failed:
+                os.makedirs(self.temp_folder, exist_ok=True)
+                filename = os.path.join(self.temp_folder, f'{index:05d}.safetensors')
+                safetensors.torch.save_file({k: v.contiguous() for k, v in deltas.items()}, filename)
+        except Exception as e:
+            print(f'[LoRA Cache] Saving {self.folder} failed: {e}')
+            self.failed = True
+        finally:
+            self.pending.release()
+
+    def finish(self):
+        try:
+            if self.failed or self.chunks == 0:
+                return
+            if os.path.isdir(self.folder):
+                shutil.rmtree(self.folder)
+            os.replace(self.temp_folder, self.folder)
+            print(f'[LoRA Cache] Saved merged LoRA weights to {self.folder}')
+            prune()
+        except Exception as e:
+            print(f'[LoRA Cache] Saving {self.folder} failed: {e}')
+        finally:
+            shutil.rmtree(self.temp_folder, ignore_errors=True)
+
+
+def record_deltas(patcher, key):
+    """Writes the deltas to the cache the first time the current patches of the patcher are applied.
+
+    LoRA stacks whose deltas alone exceed the disk budget are not recorded.
+    """
+    model_sd = patcher.model_state_dict()
+    size = sum(model_sd[k].nelement() * 4 for k in patcher.patches if k in model_sd)
+    if size > max_cache_bytes():
+        print(f'[LoRA Cache] Merged LoRA weights of {size // (1024 * 1024)} MB do not fit into the cache.')
+        return
+
+    patcher.weight_delta_recorder = WeightDeltaRecorder(patcher.patches, DeltaWriter(key))
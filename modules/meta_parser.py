@@ -9,7 +9,7 @@ from PIL import Image
 import fooocus_version
 import modules.config
 import modules.sdxl_styles
-from modules.flags import MetadataScheme, Performance, Steps
+from modules.flags import MetadataScheme, Performance, Steps, attention_reduction_none
 from modules.flags import SAMPLERS, CIVITAI_NO_KARRAS
 from modules.hash_cache import sha256_from_cache
 from modules.util import quote, unquote, extract_styles_from_prompt, is_json, get_file_from_folder_list
@@ -40,6 +40,10 @@ def load_parameter_button_click(raw_metadata: dict | str, is_generating: bool, i
     get_adm_guidance('adm_guidance', 'ADM Guidance', loaded_parameter_dict, results)
     get_str('refiner_swap_method', 'Refiner Swap Method', loaded_parameter_dict, results)
     get_number('adaptive_cfg', 'CFG Mimicking from TSNR', loaded_parameter_dict, results)
+    get_number('cfg_truncation', 'CFG Truncation', loaded_parameter_dict, results, default=1.0)
+    get_number('cfg_truncation_similarity', 'CFG Truncation Similarity', loaded_parameter_dict, results, default=0.0)
+    get_str('attention_reduction', 'Attention Reduction', loaded_parameter_dict, results,
+            default=attention_reduction_none)
     get_number('clip_skip', 'CLIP Skip', loaded_parameter_dict, results, cast_type=int)
     get_str('base_model', 'Base Model', loaded_parameter_dict, results)
     get_str('refiner_model', 'Refiner Model', loaded_parameter_dict, results)
@@ -349,6 +353,9 @@ class A1111MetadataParser(MetadataParser):
         'adm_guidance': 'ADM Guidance',
         'refiner_swap_method': 'Refiner Swap Method',
         'adaptive_cfg': 'Adaptive CFG',
+        'cfg_truncation': 'CFG Truncation',
+        'cfg_truncation_similarity': 'CFG Truncation Similarity',
+        'attention_reduction': 'Attention Reduction',
         'clip_skip': 'Clip skip',
         'overwrite_switch': 'Overwrite Switch',
         'freeu': 'FreeU',
@@ -494,7 +501,8 @@ class A1111MetadataParser(MetadataParser):
                 self.fooocus_to_a1111['refiner_model_hash']: self.refiner_model_hash
             }
 
-        for key in ['adaptive_cfg', 'clip_skip', 'overwrite_switch', 'refiner_swap_method', 'freeu']:
+        for key in ['adaptive_cfg', 'cfg_truncation', 'cfg_truncation_similarity', 'attention_reduction', 'clip_skip',
+                    'overwrite_switch', 'refiner_swap_method', 'freeu']:
             if key in data:
                 generation_params[self.fooocus_to_a1111[key]] = data[key]
 
@@ -2,6 +2,8 @@ import os
 import torch
 import time
 import math
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import ldm_patched.modules.model_base
 import ldm_patched.ldm.modules.diffusionmodules.openaimodel
 import ldm_patched.modules.model_management
@@ -35,18 +37,43 @@ class PatchSettings:
                  positive_adm_scale=1.5,
                  negative_adm_scale=0.8,
                  controlnet_softness=0.25,
-                 adaptive_cfg=7.0):
+                 adaptive_cfg=7.0,
+                 cfg_truncation=1.0,
+                 cfg_truncation_similarity=0.0,
+                 deep_cache_interval=0):
         self.sharpness = sharpness
         self.adm_scaler_end = adm_scaler_end
         self.positive_adm_scale = positive_adm_scale
         self.negative_adm_scale = negative_adm_scale
         self.controlnet_softness = controlnet_softness
         self.adaptive_cfg = adaptive_cfg
+        self.cfg_truncation = cfg_truncation
+        self.cfg_truncation_similarity = cfg_truncation_similarity
+        self.cfg_truncated_sigma = None
+        self.deep_cache_interval = deep_cache_interval
+        self.deep_cache = {}
+        self.sampling_step = 0
+        self.sampler_seed = None
         self.global_diffusion_progress = 0
         self.eps_record = None
+        self.brownian_tree = None
+        self.brownian_transform = None
 
 
-patch_settings = {}
+# Settings of the task running in the current thread, so several tasks can be processed side by side.
+patch_settings = contextvars.ContextVar('patch_settings', default=None)
+
+
+def get_patch_settings() -> PatchSettings:
+    settings = patch_settings.get()
+    if settings is None:
+        settings = PatchSettings()
+        patch_settings.set(settings)
+    return settings
+
+
+def set_patch_settings(settings: PatchSettings | None):
+    patch_settings.set(settings)
 
 
 def calculate_weight_patched(self, patches, weight, key):
@@ -183,10 +210,67 @@ def calculate_weight_patched(self, patches, weight, key):
     return weight
 
 
-class BrownianTreeNoiseSamplerPatched:
-    transform = None
-    tree = None
+patch_executor = ThreadPoolExecutor(max_workers=max(1, min(8, os.cpu_count() or 1)), thread_name_prefix='patch')
+
+
+def is_plain_lora(patch, weight):
+    alpha, v, strength_model = patch
+    if strength_model != 1.0 or not isinstance(v, tuple) or len(v) != 2 or v[0] != 'lora' or v[1][3] is not None:
+        return False
+    up, down = v[1][0], v[1][1]
+    return up.shape[0] * down[0].numel() == weight.numel() and up[0].numel() == down.shape[0]
+
+
+def calculate_weights_patched(self, patches, weights):
+    # Plain LoRA products of keys with the same shapes are computed with one batched matmul per group,
+    # all other patches are merged per key, on a thread pool when merging on the CPU.
+    groups = {}
+    lora_keys = []
+    other_keys = []
+
+    for key, weight in weights.items():
+        if not all(is_plain_lora(p, weight) for p in patches[key]):
+            other_keys.append(key)
+            continue
+
+        lora_keys.append(key)
+        for index, (alpha, v, _) in enumerate(patches[key]):
+            up, down, lora_alpha, _ = v[1]
+            if lora_alpha is not None:
+                alpha = alpha * lora_alpha / down.shape[0]
+            group = (up.shape[0], down.shape[0], down[0].numel(), up.dtype, down.dtype, weight.device)
+            groups.setdefault(group, []).append((key, index, alpha, up, down))
+
+    deltas = {}
+    for (_, _, _, _, _, device), entries in groups.items():
+        ups = torch.stack([e[3].reshape(e[3].shape[0], -1) for e in entries])
+        downs = torch.stack([e[4].reshape(e[4].shape[0], -1) for e in entries])
+        ups = ldm_patched.modules.model_management.cast_to_device(ups, device, torch.float32)
+        downs = ldm_patched.modules.model_management.cast_to_device(downs, device, torch.float32)
+        alphas = torch.tensor([e[2] for e in entries], device=device, dtype=torch.float32).view(-1, 1, 1)
+        products = torch.bmm(ups, downs) * alphas
+        for e, product in zip(entries, products):
+            deltas[(e[0], e[1])] = product
+
+    def merge_lora(key):
+        weight = weights[key]
+        for index in range(len(patches[key])):
+            weight += deltas[(key, index)].reshape(weight.shape).type(weight.dtype)
+        return weight
+
+    def merge_other(key):
+        return self.calculate_weight(patches[key], weights[key], key)
+
+    jobs = [(merge_lora, key) for key in lora_keys] + [(merge_other, key) for key in other_keys]
+    if len(jobs) > 1 and all(weights[key].device.type == 'cpu' for _, key in jobs):
+        results = list(patch_executor.map(lambda job: job[0](job[1]), jobs))
+    else:
+        results = [fn(key) for fn, key in jobs]
+
+    return {key: result for (_, key), result in zip(jobs, results)}
+
 
+class BrownianTreeNoiseSamplerPatched:
     @staticmethod
     def global_init(x, sigma_min, sigma_max, seed=None, transform=lambda x: x, cpu=False):
         if ldm_patched.modules.model_management.directml_enabled:
@@ -194,43 +278,58 @@ class BrownianTreeNoiseSamplerPatched:
 
         t0, t1 = transform(torch.as_tensor(sigma_min)), transform(torch.as_tensor(sigma_max))
 
-        BrownianTreeNoiseSamplerPatched.transform = transform
-        BrownianTreeNoiseSamplerPatched.tree = BatchedBrownianTree(x, t0, t1, seed, cpu=cpu)
+        settings = get_patch_settings()
+        settings.brownian_transform = transform
+        settings.brownian_tree = BatchedBrownianTree(x, t0, t1, seed, cpu=cpu)
 
     def __init__(self, *args, **kwargs):
         pass
 
     @staticmethod
     def __call__(sigma, sigma_next):
-        transform = BrownianTreeNoiseSamplerPatched.transform
-        tree = BrownianTreeNoiseSamplerPatched.tree
+        settings = get_patch_settings()
+        transform = settings.brownian_transform
+        tree = settings.brownian_tree
 
         t0, t1 = transform(torch.as_tensor(sigma)), transform(torch.as_tensor(sigma_next))
         return tree(t0, t1) / (t1 - t0).abs().sqrt()
 
 
 def compute_cfg(uncond, cond, cfg_scale, t):
-    pid = os.getpid()
-    mimic_cfg = float(patch_settings[pid].adaptive_cfg)
+    settings = get_patch_settings()
+    mimic_cfg = float(settings.adaptive_cfg)
     real_cfg = float(cfg_scale)
 
     real_eps = uncond + real_cfg * (cond - uncond)
 
-    if cfg_scale > patch_settings[pid].adaptive_cfg:
+    if cfg_scale > settings.adaptive_cfg:
         mimicked_eps = uncond + mimic_cfg * (cond - uncond)
         return real_eps * t + mimicked_eps * (1 - t)
     else:
         return real_eps
 
 
+def is_cfg_truncated(settings, model, sigma):
+    # the uncond pass is dropped after cfg_truncation of the sampling progress,
+    # or for the rest of the run once cond and uncond predictions have converged
+    sigma = float(sigma.max())
+    if settings.cfg_truncated_sigma is not None and sigma <= settings.cfg_truncated_sigma:
+        return True
+    if settings.cfg_truncation < 1.0:
+        progress = 1.0 - float(model.model_sampling.timestep(torch.tensor(sigma))) / 999.0
+        return progress >= settings.cfg_truncation
+    return False
+
+
 def patched_sampling_function(model, x, timestep, uncond, cond, cond_scale, model_options=None, seed=None):
-    pid = os.getpid()
+    settings = get_patch_settings()
 
-    if math.isclose(cond_scale, 1.0) and not model_options.get("disable_cfg1_optimization", False):
+    if (math.isclose(cond_scale, 1.0) and not model_options.get("disable_cfg1_optimization", False)) \
+            or is_cfg_truncated(settings, model, timestep):
         final_x0 = calc_cond_uncond_batch(model, cond, None, x, timestep, model_options)[0]
 
-        if patch_settings[pid].eps_record is not None:
-            patch_settings[pid].eps_record = ((x - final_x0) / timestep).cpu()
+        if settings.eps_record is not None:
+            settings.eps_record = ((x - final_x0) / timestep).cpu()
 
         return final_x0
 
@@ -239,16 +338,26 @@ def patched_sampling_function(model, x, timestep, uncond, cond, cond_scale, mode
     positive_eps = x - positive_x0
     negative_eps = x - negative_x0
 
-    alpha = 0.001 * patch_settings[pid].sharpness * patch_settings[pid].global_diffusion_progress
+    if settings.cfg_truncation_similarity > 0:
+        similarity = torch.nn.functional.cosine_similarity(
+            positive_eps.flatten(start_dim=1), negative_eps.flatten(start_dim=1), dim=1).min()
+        if float(similarity) >= settings.cfg_truncation_similarity:
+            settings.cfg_truncated_sigma = float(timestep.max())
 
-    positive_eps_degraded = anisotropic.adaptive_anisotropic_filter(x=positive_eps, g=positive_x0)
-    positive_eps_degraded_weighted = positive_eps_degraded * alpha + positive_eps * (1.0 - alpha)
+    alpha = 0.001 * settings.sharpness * settings.global_diffusion_progress
+
+    if alpha > 0:
+        positive_eps_degraded = anisotropic.adaptive_anisotropic_filter(
+            x=positive_eps, g=positive_x0, engine=ldm_patched.modules.args_parser.args.sharpness_filter_engine)
+        positive_eps_degraded_weighted = positive_eps_degraded * alpha + positive_eps * (1.0 - alpha)
+    else:
+        positive_eps_degraded_weighted = positive_eps
 
     final_eps = compute_cfg(uncond=negative_eps, cond=positive_eps_degraded_weighted,
-                            cfg_scale=cond_scale, t=patch_settings[pid].global_diffusion_progress)
+                            cfg_scale=cond_scale, t=settings.global_diffusion_progress)
 
-    if patch_settings[pid].eps_record is not None:
-        patch_settings[pid].eps_record = (final_eps / timestep).cpu()
+    if settings.eps_record is not None:
+        settings.eps_record = (final_eps / timestep).cpu()
 
     return x - final_eps
 
@@ -268,14 +377,14 @@ def sdxl_encode_adm_patched(self, **kwargs):
     height = kwargs.get("height", 1024)
     target_width = width
     target_height = height
-    pid = os.getpid()
+    settings = get_patch_settings()
 
     if kwargs.get("prompt_type", "") == "negative":
-        width = float(width) * patch_settings[pid].negative_adm_scale
-        height = float(height) * patch_settings[pid].negative_adm_scale
+        width = float(width) * settings.negative_adm_scale
+        height = float(height) * settings.negative_adm_scale
     elif kwargs.get("prompt_type", "") == "positive":
-        width = float(width) * patch_settings[pid].positive_adm_scale
-        height = float(height) * patch_settings[pid].positive_adm_scale
+        width = float(width) * settings.positive_adm_scale
+        height = float(height) * settings.positive_adm_scale
 
     def embedder(number_list):
         h = self.embedder(torch.tensor(number_list, dtype=torch.float32))
@@ -294,19 +403,50 @@ def sdxl_encode_adm_patched(self, **kwargs):
     return final_adm
 
 
+def seed_list(seed):
+    return seed if isinstance(seed, list) else [seed]
+
+
+def seeded_generators(seeds, device):
+    return [torch.Generator(device=device).manual_seed(s % constants.MAX_SEED) for s in seeds]
+
+
+def seeded_randn(generators, x, device):
+    """Draws noise shaped like x, every row from its own generator when there is one generator per row.
+
+    This gives each sample of a batch the noise it gets when its seed is sampled on its own.
+    """
+    if len(generators) == 1:
+        return torch.randn(x.size(), dtype=x.dtype, generator=generators[0], device=device)
+    assert len(generators) == x.shape[0]
+    return torch.cat([torch.randn(x[i:i + 1].size(), dtype=x.dtype, generator=generator, device=device)
+                      for i, generator in enumerate(generators)], dim=0)
+
+
+def default_noise_sampler_patched(x):
+    # ancestral noise used to come from the global generators, which prepare_noise seeds with the seed of the image
+    seed = get_patch_settings().sampler_seed
+    if seed is None:
+        return lambda sigma, sigma_next: torch.randn_like(x)
+    # seeded generators of other devices are not available on every backend, like DirectML
+    device = x.device if x.device.type == 'cuda' else 'cpu'
+    generators = seeded_generators(seed_list(seed), device)
+    return lambda sigma, sigma_next: seeded_randn(generators, x, device).to(x.device)
+
+
 def patched_KSamplerX0Inpaint_forward(self, x, sigma, uncond, cond, cond_scale, denoise_mask, model_options={}, seed=None):
-    if inpaint_worker.current_task is not None:
+    inpaint_task = inpaint_worker.get_current_task()
+    if inpaint_task is not None:
         latent_processor = self.inner_model.inner_model.process_latent_in
-        inpaint_latent = latent_processor(inpaint_worker.current_task.latent).to(x)
-        inpaint_mask = inpaint_worker.current_task.latent_mask.to(x)
+        inpaint_latent = latent_processor(inpaint_task.latent).to(x)
+        inpaint_mask = inpaint_task.latent_mask.to(x)
 
-        if getattr(self, 'energy_generator', None) is None:
+        if getattr(self, 'energy_generators', None) is None:
             # avoid bad results by using different seeds.
-            self.energy_generator = torch.Generator(device='cpu').manual_seed((seed + 1) % constants.MAX_SEED)
+            self.energy_generators = seeded_generators([s + 1 for s in seed_list(seed)], 'cpu')
 
         energy_sigma = sigma.reshape([sigma.shape[0]] + [1] * (len(x.shape) - 1))
-        current_energy = torch.randn(
-            x.size(), dtype=x.dtype, generator=self.energy_generator, device="cpu").to(x) * energy_sigma
+        current_energy = seeded_randn(self.energy_generators, x, 'cpu').to(x) * energy_sigma
         x = x * inpaint_mask + (inpaint_latent + current_energy) * (1.0 - inpaint_mask)
 
         out = self.inner_model(x, sigma,
@@ -329,7 +469,7 @@ def patched_KSamplerX0Inpaint_forward(self, x, sigma, uncond, cond, cond_scale,
 
 def timed_adm(y, timesteps):
     if isinstance(y, torch.Tensor) and int(y.dim()) == 2 and int(y.shape[1]) == 5632:
-        y_mask = (timesteps > 999.0 * (1.0 - float(patch_settings[os.getpid()].adm_scaler_end))).to(y)[..., None]
+        y_mask = (timesteps > 999.0 * (1.0 - float(get_patch_settings().adm_scaler_end))).to(y)[..., None]
         y_with_adm = y[..., :2816].clone()
         y_without_adm = y[..., 2816:].clone()
         return y_with_adm * y_mask + y_without_adm * (1.0 - y_mask)
@@ -339,7 +479,7 @@ def timed_adm(y, timesteps):
 def patched_cldm_forward(self, x, hint, timesteps, context, y=None, **kwargs):
     t_emb = ldm_patched.ldm.modules.diffusionmodules.openaimodel.timestep_embedding(timesteps, self.model_channels, repeat_only=False).to(x.dtype)
     emb = self.time_embed(t_emb)
-    pid = os.getpid()
+    settings = get_patch_settings()
 
     guided_hint = self.input_hint_block(hint, emb, context)
 
@@ -365,17 +505,40 @@ def patched_cldm_forward(self, x, hint, timesteps, context, y=None, **kwargs):
     h = self.middle_block(h, emb, context)
     outs.append(self.middle_block_out(h, emb, context))
 
-    if patch_settings[pid].controlnet_softness > 0:
+    if settings.controlnet_softness > 0:
         for i in range(10):
             k = 1.0 - float(i) / 9.0
-            outs[i] = outs[i] * (1.0 - patch_settings[pid].controlnet_softness * k)
+            outs[i] = outs[i] * (1.0 - settings.controlnet_softness * k)
 
     return outs
 
 
+# number of input and output blocks that are still computed on the steps reusing the cached deep features
+deep_cache_depth = 1
+
+
+def deep_cache_lookup(unet, x, control, transformer_options):
+    """Returns the cache slot of this UNet call and the cached deep features to reuse, if any.
+
+    Calls are told apart by the model, the input shape and the cond/uncond layout of the batch.
+    Reuse is counted in sampler steps, every UNet call of a step that runs the full pass is computed in full.
+    ControlNet and inpaint steps always run the full UNet since their residuals change every step.
+    """
+    settings = get_patch_settings()
+    if settings.deep_cache_interval < 2 or control is not None or inpaint_worker.get_current_task() is not None:
+        return None, None
+
+    key = (id(unet), tuple(x.shape), tuple(transformer_options.get("cond_or_uncond", [])))
+    slot = settings.deep_cache.setdefault(key, [None])
+    entry = slot[0]
+    if entry is None or not 0 < settings.sampling_step - entry['step'] < settings.deep_cache_interval:
+        return slot, None
+    return slot, entry
+
+
 def patched_unet_forward(self, x, timesteps=None, context=None, y=None, control=None, transformer_options={}, **kwargs):
     self.current_step = 1.0 - timesteps.to(x) / 999.0
-    patch_settings[os.getpid()].global_diffusion_progress = float(self.current_step.detach().cpu().numpy().tolist()[0])
+    get_patch_settings().global_diffusion_progress = float(self.current_step.detach().cpu().numpy().tolist()[0])
 
     y = timed_adm(y, timesteps)
 
@@ -383,6 +546,8 @@ def patched_unet_forward(self, x, timesteps=None, context=None, y=None, control=
     transformer_options["transformer_index"] = 0
     transformer_patches = transformer_options.get("patches", {})
 
+    deep_cache, deep_cache_entry = deep_cache_lookup(self, x, control, transformer_options)
+
     num_video_frames = kwargs.get("num_video_frames", self.default_num_video_frames)
     image_only_indicator = kwargs.get("image_only_indicator", self.default_image_only_indicator)
     time_context = kwargs.get("time_context", None)
@@ -400,6 +565,8 @@ def patched_unet_forward(self, x, timesteps=None, context=None, y=None, control=
 
     h = x
     for id, module in enumerate(self.input_blocks):
+        if deep_cache_entry is not None and id >= deep_cache_depth:
+            break
         transformer_options["block"] = ("input", id)
         h = forward_timestep_embed(module, h, emb, context, transformer_options, time_context=time_context, num_video_frames=num_video_frames, image_only_indicator=image_only_indicator)
         h = apply_control(h, control, 'input')
@@ -414,11 +581,18 @@ def patched_unet_forward(self, x, timesteps=None, context=None, y=None, control=
             for p in patch:
                 h = p(h, transformer_options)
 
-    transformer_options["block"] = ("middle", 0)
-    h = forward_timestep_embed(self.middle_block, h, emb, context, transformer_options, time_context=time_context, num_video_frames=num_video_frames, image_only_indicator=image_only_indicator)
-    h = apply_control(h, control, 'middle')
+    if deep_cache_entry is not None:
+        h = deep_cache_entry['features']
+    else:
+        transformer_options["block"] = ("middle", 0)
+        h = forward_timestep_embed(self.middle_block, h, emb, context, transformer_options, time_context=time_context, num_video_frames=num_video_frames, image_only_indicator=image_only_indicator)
+        h = apply_control(h, control, 'middle')
 
     for id, module in enumerate(self.output_blocks):
+        if deep_cache_entry is not None and id < len(self.output_blocks) - deep_cache_depth:
+            continue
+        if deep_cache is not None and deep_cache_entry is None and id == len(self.output_blocks) - deep_cache_depth:
+            deep_cache[0] = dict(features=h, step=get_patch_settings().sampling_step)
         transformer_options["block"] = ("output", id)
         hsp = hs.pop()
         hsp = apply_control(hsp, control, 'output')
@@ -498,11 +672,13 @@ def patch_all():
 
     ldm_patched.modules.model_management.load_models_gpu = patched_load_models_gpu
     ldm_patched.modules.model_patcher.ModelPatcher.calculate_weight = calculate_weight_patched
+    ldm_patched.modules.model_patcher.ModelPatcher.calculate_weights = calculate_weights_patched
     ldm_patched.controlnet.cldm.ControlNet.forward = patched_cldm_forward
     ldm_patched.ldm.modules.diffusionmodules.openaimodel.UNetModel.forward = patched_unet_forward
     ldm_patched.modules.model_base.SDXL.encode_adm = sdxl_encode_adm_patched
     ldm_patched.modules.samplers.KSamplerX0Inpaint.forward = patched_KSamplerX0Inpaint_forward
     ldm_patched.k_diffusion.sampling.BrownianTreeNoiseSampler = BrownianTreeNoiseSamplerPatched
+    ldm_patched.k_diffusion.sampling.default_noise_sampler = default_noise_sampler_patched
     ldm_patched.modules.samplers.sampling_function = patched_sampling_function
 
     warnings.filterwarnings(action='ignore', module='torchsde')
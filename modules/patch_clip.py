@@ -23,43 +23,60 @@ from transformers import CLIPTextModel, CLIPTextConfig, modeling_utils, CLIPVisi
 
 
 def patched_encode_token_weights(self, token_weight_pairs):
+    return patched_encode_token_weights_batch(self, [token_weight_pairs])[0]
+
+
+def patched_encode_token_weights_batch(self, token_weight_pairs_list):
+    # All chunks of all texts go through the text encoder as one batch, rows do not attend to each other.
     to_encode = list()
-    max_token_len = 0
-    has_weights = False
-    for x in token_weight_pairs:
-        tokens = list(map(lambda a: a[0], x))
-        max_token_len = max(len(tokens), max_token_len)
-        has_weights = has_weights or not all(map(lambda a: a[1] == 1.0, x))
-        to_encode.append(tokens)
-
-    sections = len(to_encode)
-    if has_weights or sections == 0:
-        to_encode.append(ldm_patched.modules.sd1_clip.gen_empty_tokens(self.special_tokens, max_token_len))
-
-    out, pooled = self.encode(to_encode)
-    if pooled is not None:
-        first_pooled = pooled[0:1].to(ldm_patched.modules.model_management.intermediate_device())
-    else:
-        first_pooled = pooled
-
-    output = []
-    for k in range(0, sections):
-        z = out[k:k + 1]
-        if has_weights:
-            original_mean = z.mean()
-            z_empty = out[-1]
-            for i in range(len(z)):
-                for j in range(len(z[i])):
-                    weight = token_weight_pairs[k][j][1]
-                    if weight != 1.0:
-                        z[i][j] = (z[i][j] - z_empty[j]) * weight + z_empty[j]
-            new_mean = z.mean()
-            z = z * (original_mean / new_mean)
-        output.append(z)
-
-    if len(output) == 0:
-        return out[-1:].to(ldm_patched.modules.model_management.intermediate_device()), first_pooled
-    return torch.cat(output, dim=-2).to(ldm_patched.modules.model_management.intermediate_device()), first_pooled
+    layouts = list()
+    for token_weight_pairs in token_weight_pairs_list:
+        start = len(to_encode)
+        max_token_len = 0
+        has_weights = False
+        for x in token_weight_pairs:
+            tokens = list(map(lambda a: a[0], x))
+            max_token_len = max(len(tokens), max_token_len)
+            has_weights = has_weights or not all(map(lambda a: a[1] == 1.0, x))
+            to_encode.append(tokens)
+
+        sections = len(to_encode) - start
+        if has_weights or sections == 0:
+            to_encode.append(ldm_patched.modules.sd1_clip.gen_empty_tokens(self.special_tokens, max_token_len))
+
+        layouts.append((start, len(to_encode), sections, has_weights, token_weight_pairs))
+
+    all_out, all_pooled = self.encode(to_encode)
+
+    results = []
+    for start, end, sections, has_weights, token_weight_pairs in layouts:
+        out = all_out[start:end]
+        if all_pooled is not None:
+            first_pooled = all_pooled[start:start + 1].to(ldm_patched.modules.model_management.intermediate_device())
+        else:
+            first_pooled = all_pooled
+
+        output = []
+        for k in range(0, sections):
+            z = out[k:k + 1]
+            if has_weights:
+                original_mean = z.mean()
+                z_empty = out[-1]
+                for i in range(len(z)):
+                    for j in range(len(z[i])):
+                        weight = token_weight_pairs[k][j][1]
+                        if weight != 1.0:
+                            z[i][j] = (z[i][j] - z_empty[j]) * weight + z_empty[j]
+                new_mean = z.mean()
+                z = z * (original_mean / new_mean)
+            output.append(z)
+
+        if len(output) == 0:
+            results.append((out[-1:].to(ldm_patched.modules.model_management.intermediate_device()), first_pooled))
+        else:
+            results.append((torch.cat(output, dim=-2).to(ldm_patched.modules.model_management.intermediate_device()), first_pooled))
+
+    return results
 
 
 def patched_SDClipModel__init__(self, max_length=77, freeze=True, layer="last", layer_idx=None,
@@ -188,6 +205,7 @@ def patched_ClipVisionModel_encode_image(self, image):
 
 def patch_all_clip():
     ldm_patched.modules.sd1_clip.ClipTokenWeightEncoder.encode_token_weights = patched_encode_token_weights
+    ldm_patched.modules.sd1_clip.ClipTokenWeightEncoder.encode_token_weights_batch = patched_encode_token_weights_batch
     ldm_patched.modules.sd1_clip.SDClipModel.__init__ = patched_SDClipModel__init__
     ldm_patched.modules.sd1_clip.SDClipModel.forward = patched_SDClipModel_forward
     ldm_patched.modules.clip_vision.ClipVisionModel.__init__ = patched_ClipVisionModel__init__
@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+import traceback
+import weakref
+
+import psutil
+
+import modules.config
+import modules.default_pipeline as pipeline
+import modules.flags as flags
+from modules.lora import load_lora_patches
+from modules.util import get_file_from_folder_list
+
+read_buffer_size = 16 * 1024 * 1024
+
+
+def warm_file(filepath):
+    """Reads a file once so that loading it later is served from the page cache instead of the disk."""
+    size = os.path.getsize(filepath)
+    if size > psutil.virtual_memory().available // 2:
+        return False
+
+    buffer = bytearray(read_buffer_size)
+    with open(filepath, 'rb', buffering=0) as f:
+        while f.readinto(buffer) > 0:
+            pass
+    return True
+
+
+def control_model_paths(task):
+    # the same conditions as the worker, files that are not downloaded yet are left to the worker
+    uses_control = task.input_image_checkbox and (task.current_tab == 'ip' or task.mixing_image_prompt_and_vary_upscale
+                                                  or task.mixing_image_prompt_and_inpaint)
+    if not uses_control:
+        return []
+
+    paths = []
+    if len(task.cn_tasks[flags.cn_canny]) > 0:
+        paths.append(modules.config.controlnet_canny_path())
+    if len(task.cn_tasks[flags.cn_cpds]) > 0:
+        paths.append(modules.config.controlnet_cpds_path())
+    if len(task.cn_tasks[flags.cn_ip]) > 0:
+        paths += modules.config.ip_adapter_paths('ip')
+    if len(task.cn_tasks[flags.cn_ip_face]) > 0:
+        paths += [path for path in modules.config.ip_adapter_paths('face') if path not in paths]
+    return [path for path in paths if os.path.isfile(path)]
+
+
+class Prefetcher:
+    """Prepares the models of the next queued task while the current task is sampling.
+
+    Checkpoint, VAE and control model files already on disk are read into the page cache, LoRA files are parsed
+    and matched against the current base model into the LoRA cache of modules.lora. Models are not loaded into
+    the model pool, that needs the pipeline lock and the memory of a second model while the current task runs.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.prefetched = weakref.WeakSet()
+
+    def start(self):
+        threading.Thread(target=self.loop, daemon=True, name='prefetch').start()
+
+    def loop(self):
+        task = None
+        while True:
+            task = self.queue.wait_first(task)
+            if task is not None and task not in self.prefetched and len(task.args) > 0:
+                self.prefetched.add(task)
+                try:
+                    self.prefetch(task)
+                except Exception:
+                    traceback.print_exc()
+
+    def warm(self, filepath):
+        if not os.path.isfile(filepath):
+            return
+        start = time.perf_counter()
+        if warm_file(filepath):
+            print(f'[Prefetch] Read {filepath} in {time.perf_counter() - start:.2f} seconds')
+
+    def prefetch(self, task):
+        vae_filename = None
+        if task.vae_name != flags.default_vae:
+            vae_filename = get_file_from_folder_list(task.vae_name, modules.config.path_vae)
+
+        base_filename = get_file_from_folder_list(task.base_model_name, modules.config.paths_checkpoints)
+        if base_filename != pipeline.model_base.filename and ('base', base_filename, vae_filename) not in pipeline.model_pool:
+            self.warm(base_filename)
+            if vae_filename is not None:
+                self.warm(vae_filename)
+
+        if task.refiner_model_name != 'None':
+            refiner_filename = get_file_from_folder_list(task.refiner_model_name, modules.config.paths_checkpoints)
+            if refiner_filename not in [pipeline.model_base.filename, pipeline.model_refiner.filename] \
+                    and ('refiner', refiner_filename) not in pipeline.model_pool:
+                self.warm(refiner_filename)
+
+        model = pipeline.model_base
+        for name, _ in task.loras:
+            if name == 'None':
+                continue
+            filepath = name if os.path.exists(name) else get_file_from_folder_list(name, modules.config.paths_loras)
+            if model.unet is not None and os.path.isfile(filepath):
+                load_lora_patches(filepath, model.lora_key_map_unet, model.lora_key_map_clip, model.lora_key_map_signature)
+
+        for filepath in control_model_paths(task):
+            self.warm(filepath)
@@ -1,4 +1,5 @@
 import os
+import threading
 import args_manager
 import modules.config
 import json
@@ -11,6 +12,7 @@ from modules.meta_parser import MetadataParser, get_exif
 from modules.util import generate_temp_filename
 
 log_cache = {}
+log_lock = threading.Lock()
 
 
 def get_current_html_path(output_format=None):
@@ -94,16 +96,6 @@ def log(img, metadata, metadata_parser: MetadataParser | None = None, output_for
     begin_part = f"<!DOCTYPE html><html><head><title>Fooocus Log {date_string}</title>{css_styles}</head><body>{js}<p>Fooocus Log {date_string} (private)</p>\n<p>Metadata is embedded if enabled in the config or developer debug mode. You can find the information for each image in line Metadata Scheme.</p><!--fooocus-log-split-->\n\n"
     end_part = f'\n<!--fooocus-log-split--></body></html>'
 
-    middle_part = log_cache.get(html_name, "")
-
-    if middle_part == "":
-        if os.path.exists(html_name):
-            existing_split = open(html_name, 'r', encoding='utf-8').read().split('<!--fooocus-log-split-->')
-            if len(existing_split) == 3:
-                middle_part = existing_split[1]
-            else:
-                middle_part = existing_split[0]
-
     div_name = only_name.replace('.', '_')
     item = f"<div id=\"{div_name}\" class=\"image-container\"><hr><table><tr>\n"
     item += f"<td><a href=\"{only_name}\" target=\"_blank\"><img src='{only_name}' onerror=\"this.closest('.image-container').style.display='none';\" loading='lazy'/></a><div>{only_name}</div></td>"
@@ -125,13 +117,25 @@ def log(img, metadata, metadata_parser: MetadataParser | None = None, output_for
     item += "</td>"
     item += "</tr></table></div>\n\n"
 
-    middle_part = item + middle_part
+    # images of several tasks may be saved at the same time
+    with log_lock:
+        middle_part = log_cache.get(html_name, "")
 
-    with open(html_name, 'w', encoding='utf-8') as f:
-        f.write(begin_part + middle_part + end_part)
+        if middle_part == "":
+            if os.path.exists(html_name):
+                existing_split = open(html_name, 'r', encoding='utf-8').read().split('<!--fooocus-log-split-->')
+                if len(existing_split) == 3:
+                    middle_part = existing_split[1]
+                else:
+                    middle_part = existing_split[0]
 
-    print(f'Image generated with private log at: {html_name}')
+        middle_part = item + middle_part
 
-    log_cache[html_name] = middle_part
+        with open(html_name, 'w', encoding='utf-8') as f:
+            f.write(begin_part + middle_part + end_part)
+
+        log_cache[html_name] = middle_part
+
+    print(f'Image generated with private log at: {html_name}')
 
     return local_temp_filename
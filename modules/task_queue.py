@@ -0,0 +1,127 @@
+import heapq
+import itertools
+import threading
+from collections import deque
+
+
+class TaskEvents:
+    """Event stream of a single task, the worker appends and the UI blocks on get()."""
+
+    def __init__(self):
+        self.events = deque()
+        self.condition = threading.Condition()
+
+    def append(self, event):
+        with self.condition:
+            self.events.append(event)
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.events) > 0, timeout=timeout):
+                return None
+            return self.events.popleft()
+
+    def peek(self):
+        with self.condition:
+            return self.events[0] if len(self.events) > 0 else None
+
+    def __len__(self):
+        return len(self.events)
+
+
+class TaskQueue:
+    """Blocking priority queue of tasks, lower priority values are served first, FIFO within a priority.
+
+    With a signature function, tasks that share the signature of the last served task are moved forward within their
+    priority, so that consecutive tasks do not have to reload models. A task is never passed over more than max_skips
+    times.
+    """
+
+    def __init__(self, signature=None, max_skips=0):
+        self.heap = []
+        self.counter = itertools.count()
+        self.cancelled = set()
+        self.condition = threading.Condition()
+        self.signature = signature
+        self.max_skips = max_skips
+        self.skips = {}
+        self.last_signature = None
+
+    def put(self, task, priority=0):
+        with self.condition:
+            heapq.heappush(self.heap, (priority, next(self.counter), task))
+            self.condition.notify_all()
+
+    def append(self, task):
+        self.put(task)
+
+    def get(self, timeout=None):
+        with self.condition:
+            while True:
+                self._drop_cancelled()
+                if len(self.heap) > 0:
+                    return self._pop()
+                if not self.condition.wait(timeout=timeout) and timeout is not None:
+                    return None
+
+    def cancel(self, task) -> bool:
+        """Removes a task that has not been started yet, returns False if it is not queued anymore."""
+        with self.condition:
+            if not any(entry[2] is task for entry in self.heap) or id(task) in self.cancelled:
+                return False
+            self.cancelled.add(id(task))
+            self.condition.notify_all()
+            return True
+
+    def pending(self) -> list:
+        with self.condition:
+            return self._pending()
+
+    def wait_first(self, last=None, timeout=None):
+        """Blocks until the first pending task is not last anymore, returns it or None when nothing is pending."""
+        with self.condition:
+            self.condition.wait_for(lambda: self._first() is not last, timeout=timeout)
+            return self._first()
+
+    def _pending(self):
+        return [entry[2] for entry in sorted(self.heap) if id(entry[2]) not in self.cancelled]
+
+    def _first(self):
+        pending = self._pending()
+        return pending[0] if len(pending) > 0 else None
+
+    def _pop(self):
+        if self.signature is None or self.max_skips <= 0 or self.last_signature is None:
+            entry = heapq.heappop(self.heap)
+        else:
+            # tasks are only grouped within the highest waiting priority, they never pass a more urgent task
+            entries = [entry for entry in sorted(self.heap) if id(entry[2]) not in self.cancelled]
+            entries = [entry for entry in entries if entry[0] == entries[0][0]]
+            entry = entries[0]
+            for candidate in entries:
+                if self.skips.get(id(candidate[2]), 0) >= self.max_skips \
+                        or self.signature(candidate[2]) == self.last_signature:
+                    entry = candidate
+                    break
+            for skipped in entries[:entries.index(entry)]:
+                self.skips[id(skipped[2])] = self.skips.get(id(skipped[2]), 0) + 1
+            self.heap.remove(entry)
+            heapq.heapify(self.heap)
+
+        task = entry[2]
+        self.skips.pop(id(task), None)
+        if self.signature is not None:
+            self.last_signature = self.signature(task)
+        self.condition.notify_all()
+        return task
+
+    def _drop_cancelled(self):
+        while len(self.heap) > 0 and id(self.heap[0][2]) in self.cancelled:
+            task = heapq.heappop(self.heap)[2]
+            self.cancelled.discard(id(task))
+            self.skips.pop(id(task), None)
+
+    def __len__(self):
+        with self.condition:
+            return len(self.heap) - len(self.cancelled)
@@ -149,6 +149,16 @@ def HWC3(x):
         return y
 
 
+def encode_image(img: np.ndarray, output_format='png') -> bytes:
+    """Encodes an RGB image in memory, without a round-trip through the outputs folder."""
+    output_format = output_format.lower()
+    extension = '.jpg' if output_format == 'jpeg' else f'.{output_format}'
+    success, buffer = cv2.imencode(extension, cv2.cvtColor(HWC3(img.astype(np.uint8)), cv2.COLOR_RGB2BGR))
+    if not success:
+        raise ValueError(f'Can not encode image as {output_format}.')
+    return buffer.tobytes()
+
+
 def remove_empty_str(items, default=None):
     items = [x for x in items if x != ""]
     if len(items) == 0 and default is not None:
@@ -204,11 +214,25 @@ def addnet_hash_safetensors(b):
 
 def calculate_sha256(filename) -> str:
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
+    buffer = memoryview(bytearray(16 * 1024 * 1024))
+
+    with open(filename, "rb", buffering=0) as f:
+        while size := f.readinto(buffer):
+            hash_sha256.update(buffer[:size])
+
+    return hash_sha256.hexdigest()
+
+
+def calculate_partial_sha256(filename, blksize=1024 * 1024) -> str:
+    """Fast fingerprint from the size and three blocks of a file, not compatible with sha256 of the whole file."""
+    hash_sha256 = hashlib.sha256()
+    size = os.path.getsize(filename)
+    hash_sha256.update(str(size).encode('utf-8'))
 
     with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(blksize), b""):
-            hash_sha256.update(chunk)
+        for offset in sorted({0, max(0, size // 2 - blksize // 2), max(0, size - blksize)}):
+            f.seek(offset)
+            hash_sha256.update(f.read(blksize))
 
     return hash_sha256.hexdigest()
 
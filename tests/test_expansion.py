@@ -0,0 +1,39 @@
+import sys
+import unittest
+from importlib.util import find_spec
+from types import SimpleNamespace
+from unittest import mock
+
+
+@unittest.skipIf(find_spec('torch') is None or find_spec('transformers') is None, 'requires torch and transformers')
+class TestExpansion(unittest.TestCase):
+    def setUp(self):
+        import torch
+        from transformers import GPT2Config, GPT2LMHeadModel
+        # args_manager parses the command line on import, which belongs to the test runner here
+        with mock.patch.object(sys, 'argv', sys.argv[:1]):
+            from extras.expansion import FooocusExpansion, neg_inf
+
+        torch.manual_seed(0)
+        self.expansion = FooocusExpansion.__new__(FooocusExpansion)
+        self.expansion.model = GPT2LMHeadModel(GPT2Config(vocab_size=64, n_positions=64, n_embd=32, n_layer=2,
+                                                          n_head=2)).eval()
+        self.expansion.tokenizer = SimpleNamespace(eos_token_id=0)
+        self.expansion.patcher = SimpleNamespace(load_device=torch.device('cpu'))
+        # like the real vocab, the padding token is outside of the positive words
+        self.expansion.logits_bias = torch.zeros((1, 64))
+        self.expansion.logits_bias[0, 0] = neg_inf
+
+    def test_batch_matches_single(self):
+        rows = [([1, 2, 3, 4, 5], 8, 7), ([6, 7], 11, 12345), ([8, 9, 10], 5, 7)]
+        batch = self.expansion.sample(rows, top_k=10)
+        for row, tokens in zip(rows, batch):
+            self.assertEqual(self.expansion.sample([row], top_k=10)[0], tokens)
+
+    def test_seed_changes_tokens(self):
+        tokens = [self.expansion.sample([([1, 2, 3], 16, seed)], top_k=10)[0] for seed in range(4)]
+        self.assertGreater(len(set(map(tuple, tokens))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
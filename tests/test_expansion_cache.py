@@ -0,0 +1,51 @@
+import os
+import tempfile
+import time
+import unittest
+
+from modules.expansion_cache import ExpansionCache
+
+
+class TestExpansionCache(unittest.TestCase):
+    def test_get_put(self):
+        with tempfile.TemporaryDirectory() as folder:
+            filename = os.path.join(folder, 'expansion_cache.db')
+
+            cache = ExpansionCache('model-a', max_entries=10, filename=filename)
+            self.assertIsNone(cache.get('cat', 1))
+            cache.put('cat', 1, 'cat, fluffy')
+            self.assertEqual(cache.get('cat', 1), 'cat, fluffy')
+            self.assertIsNone(cache.get('cat', 2))
+            cache.connection.close()
+
+            # results survive restarts
+            cache = ExpansionCache('model-a', max_entries=10, filename=filename)
+            self.assertEqual(cache.get('cat', 1), 'cat, fluffy')
+            cache.connection.close()
+
+            # and are dropped when the model changes
+            cache = ExpansionCache('model-b', max_entries=10, filename=filename)
+            self.assertIsNone(cache.get('cat', 1))
+            cache.connection.close()
+
+    def test_access_times_are_written_in_batches(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = ExpansionCache('model-a', max_entries=10, filename=os.path.join(folder, 'expansion_cache.db'))
+            cache.put('cat', 1, 'cat, fluffy')
+
+            def used():
+                return cache.connection.execute('SELECT used FROM expansions WHERE prompt = ?', ('cat',)).fetchone()[0]
+
+            first_used = used()
+            time.sleep(0.01)
+            self.assertEqual(cache.get('cat', 1), 'cat, fluffy')
+            self.assertEqual(used(), first_used)
+            cache.put('dog', 1, 'dog, happy')
+            self.assertGreater(used(), first_used)
+            cache.connection.close()
+
+    def test_disabled(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = ExpansionCache('model-a', max_entries=0, filename=os.path.join(folder, 'expansion_cache.db'))
+            cache.put('cat', 1, 'cat, fluffy')
+            self.assertIsNone(cache.get('cat', 1))
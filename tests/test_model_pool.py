@@ -0,0 +1,28 @@
+import unittest
+
+from modules.model_pool import ModelPool
+
+
+class TestModelPool(unittest.TestCase):
+    def test_lru_eviction_by_size(self):
+        pool = ModelPool(max_bytes=10)
+        pool.put('a', 'model a', 4)
+        pool.put('b', 'model b', 4)
+        self.assertEqual(pool.get('a'), 'model a')
+        # b is the least recently used model now
+        self.assertEqual(pool.put('c', 'model c', 4), ['b'])
+        self.assertIsNone(pool.get('b'))
+        self.assertEqual(pool.get('c'), 'model c')
+
+        stats = pool.stats()
+        self.assertEqual(stats['bytes'], 8)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['evictions'], 1)
+
+    def test_oversized_model_is_not_kept(self):
+        pool = ModelPool(max_bytes=10)
+        pool.put('a', 'model a', 4)
+        self.assertEqual(pool.put('a', 'large model a', 11), [])
+        self.assertIsNone(pool.get('a'))
+        self.assertEqual(pool.stats()['bytes'], 0)
@@ -0,0 +1,73 @@
+import threading
+import unittest
+
+from modules.task_queue import TaskQueue, TaskEvents
+
+
+class TestTaskQueue(unittest.TestCase):
+    def test_priority_and_fifo_order(self):
+        queue = TaskQueue()
+        queue.append('a')
+        queue.put('b', priority=-1)
+        queue.append('c')
+        self.assertEqual(queue.pending(), ['b', 'a', 'c'])
+        self.assertEqual([queue.get() for _ in range(3)], ['b', 'a', 'c'])
+
+    def test_cancel(self):
+        queue = TaskQueue()
+        first, second = object(), object()
+        queue.append(first)
+        queue.append(second)
+        self.assertTrue(queue.cancel(first))
+        self.assertFalse(queue.cancel(first))
+        self.assertEqual(len(queue), 1)
+        self.assertIs(queue.get(), second)
+        self.assertFalse(queue.cancel(second))
+
+    def test_blocking_get(self):
+        queue = TaskQueue()
+        self.assertIsNone(queue.get(timeout=0.01))
+        threading.Timer(0.05, queue.append, args=('task',)).start()
+        self.assertEqual(queue.get(timeout=5), 'task')
+
+    def test_wait_first(self):
+        queue = TaskQueue()
+        self.assertIsNone(queue.wait_first(timeout=0.01))
+        threading.Timer(0.05, queue.append, args=('a',)).start()
+        self.assertEqual(queue.wait_first(timeout=5), 'a')
+        queue.append('b')
+        threading.Timer(0.05, queue.get).start()
+        self.assertEqual(queue.wait_first('a', timeout=5), 'b')
+
+    def test_events(self):
+        events = TaskEvents()
+        self.assertIsNone(events.peek())
+        self.assertIsNone(events.get(timeout=0.01))
+        events.append(['preview', 1])
+        events.append(['finish', 2])
+        self.assertEqual(events.peek(), ['preview', 1])
+        self.assertEqual(events.get(), ['preview', 1])
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events.get(), ['finish', 2])
+
+    def test_signature_grouping(self):
+        queue = TaskQueue(signature=lambda task: task[0], max_skips=2)
+        for task in ['a1', 'b1', 'a2', 'b2', 'a3', 'a4', 'a5']:
+            queue.append(task)
+        # a-tasks are served back to back until b1 has been passed over twice
+        self.assertEqual([queue.get() for _ in range(7)], ['a1', 'a2', 'a3', 'b1', 'b2', 'a4', 'a5'])
+
+    def test_signature_grouping_keeps_priority(self):
+        queue = TaskQueue(signature=lambda task: task[0], max_skips=2)
+        queue.append('a1')
+        self.assertEqual(queue.get(), 'a1')
+        for task, priority in [('b1', -1), ('a2', 0), ('c1', -1), ('b2', -1)]:
+            queue.put(task, priority=priority)
+        # a2 shares the signature of a1 but waits behind more urgent tasks, which are grouped among themselves
+        self.assertEqual([queue.get() for _ in range(4)], ['b1', 'b2', 'c1', 'a2'])
+
+    def test_signature_grouping_disabled(self):
+        queue = TaskQueue(signature=lambda task: task[0], max_skips=0)
+        for task in ['a1', 'b1', 'a2']:
+            queue.append(task)
+        self.assertEqual([queue.get() for _ in range(3)], ['a1', 'b1', 'a2'])
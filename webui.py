@@ -18,6 +18,7 @@ import gradio as gr
 # nest_asyncio.apply()
 import gradio as gr
 import base64
+from modules.util import encode_image
 
 def image_to_base64(image_path):
     with open(image_path, "rb") as img_file:
@@ -28,8 +29,8 @@ def generate_image(prompt):
     return path  # ✅ Return only the image file path
 
 def api_generate(prompt: str):
-    path = worker.generate_image(prompt)
-    img_b64 = image_to_base64(path)
+    imgs, _ = worker.generate_images(prompt)
+    img_b64 = base64.b64encode(encode_image(imgs[0])).decode("utf-8")
     return {"img": img_b64}
 
 # Gradio UI